@@ -0,0 +1,43 @@
+import argparse
+import os
+import runpy
+import sys
+import time
+
+# runs a full rotation against the simulated motors and camera (see simulation.py) and reports the wall time
+# (simulated moves don't wait, so their duration is reported separately),
+# the number of frames captured (one per control loop iteration) and the steps each axis took.
+# usage: python benchmark_rotation.py --frame recorded_frame.jpg
+
+def run_rotation(frame_path):
+    """
+    Runs rotate_plant_anticlockwise.py with GROBOT_MOTORS=sim and a SimulatedCamera built from frame_path.
+    Returns: (seconds, simulated camera).
+    """
+    os.environ["GROBOT_MOTORS"] = "sim" # must be set before the motor modules are imported
+    import cv2
+    from camera import set_camera
+    from simulation import SimulatedCamera
+
+    simulated_camera = SimulatedCamera(cv2.imread(frame_path))
+    set_camera(simulated_camera)
+
+    sys.argv = ["rotate_plant_anticlockwise.py"]
+    start = time.perf_counter()
+    runpy.run_path("rotate_plant_anticlockwise.py", run_name="__main__")
+    return time.perf_counter() - start, simulated_camera
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a full rotation against simulated hardware.")
+    parser.add_argument('--frame', default='captured_image.jpg', help='Recorded frame the simulated camera starts from.')
+    args = parser.parse_args()
+
+    seconds, simulated_camera = run_rotation(args.frame)
+
+    from motor_driver import SIMULATED_AXES
+    from step_engine import get_step_backend
+    print(f"Rotation time: {seconds:.2f} s (plus {get_step_backend().simulated_seconds:.2f} s of simulated motor moves)")
+    print(f"Frames captured: {simulated_camera.frames_captured}")
+    for name, axis in SIMULATED_AXES.items():
+        print(f"{name:<7} steps: +{axis.steps_positive:g} / -{axis.steps_negative:g} (net {axis.position:g}, "
+              f"{simulated_camera.offset(name):+.0f} px)")
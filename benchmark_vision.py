@@ -0,0 +1,156 @@
+import argparse
+import glob
+import os
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from image_analysis import FrameAnalysis, clear_qrcode_cache, extract_holder_corners, find_qrcodes, qr_decode_calls
+
+# benchmarks the vision hot path on stored frames, so changes can be compared without the robot.
+# usage: python benchmark_vision.py --frames recorded_frames/ --downscale 4
+
+# (num_corners, quality_level, min_distance) used by rotate_plant_anticlockwise
+CORNER_SETTINGS = [(8, 0.02, 10), (8, 0.02, 20), (20, 0.04, 45)]
+
+DETECTORS = {
+    'holders': FrameAnalysis.holder_contours,
+    'legs': FrameAnalysis.leg_contours,
+    'conveyors': FrameAnalysis.conveyor_contours,
+}
+
+def load_frames(paths):
+    """
+    Loads every image in the given files/directories.
+    Returns: list of (path, image).
+    """
+    frames = []
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, '*'))) if os.path.isdir(path) else [path]
+        for file in files:
+            image = cv2.imread(file)
+            if image is not None:
+                frames.append((file, image))
+    return frames
+
+def time_detector(image, detector, downscale, repeat):
+    """
+    Runs a detector on a fresh FrameAnalysis `repeat` times (so no planes are reused between runs).
+    Returns: (mean seconds, contours from the last run).
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        contours = detector(FrameAnalysis(image, downscale=downscale))
+        durations.append(time.perf_counter() - start)
+    return float(np.mean(durations)), contours
+
+def rect_error(reference_contours, contours):
+    """
+    Matches each contour to the reference contour with the nearest bounding rect center.
+    Returns: the largest absolute difference (pixels) between matched bounding rects, or None if either is empty.
+    """
+    if not reference_contours or not contours:
+        return None
+    reference_rects = np.array([cv2.boundingRect(cnt) for cnt in reference_contours], dtype=float)
+    reference_centers = reference_rects[:, :2] + reference_rects[:, 2:] / 2
+    worst = 0.0
+    for contour in contours:
+        rect = np.array(cv2.boundingRect(contour), dtype=float)
+        center = rect[:2] + rect[2:] / 2
+        nearest = np.argmin(np.linalg.norm(reference_centers - center, axis=1))
+        worst = max(worst, float(np.max(np.abs(reference_rects[nearest] - rect))))
+    return worst
+
+def benchmark_pyramid(frames, downscale, repeat):
+    """
+    Compares full-resolution detection with the pyramid path on every frame.
+    Prints latency for both and the worst bounding-rect error of the pyramid contours.
+    """
+    print(f"{'frame':<40} {'detector':<10} {'full (ms)':>10} {'pyramid (ms)':>13} {'speedup':>8} {'max err (px)':>13}")
+    for path, image in frames:
+        for name, detector in DETECTORS.items():
+            full_time, full_contours = time_detector(image, detector, 1, repeat)
+            pyramid_time, pyramid_contours = time_detector(image, detector, downscale, repeat)
+            error = rect_error(full_contours, pyramid_contours)
+            if len(full_contours) != len(pyramid_contours):
+                print(f"  warning: {name} found {len(full_contours)} contours at full res, {len(pyramid_contours)} with pyramid")
+            print(f"{os.path.basename(path):<40} {name:<10} {full_time * 1000:>10.1f} {pyramid_time * 1000:>13.1f} "
+                  f"{full_time / pyramid_time:>7.1f}x {'-' if error is None else f'{error:.0f}':>13}")
+
+def full_frame_holder_corners(image, contour, num_corners, quality_level, min_distance):
+    # the corner extraction as it was: the outline drawn on a blank copy of the whole frame
+    approx = cv2.approxPolyDP(contour, 0.005 * cv2.arcLength(contour, True), True)
+    blank_image = np.zeros_like(image)
+    cv2.drawContours(blank_image, [approx], -1, (255, 255, 255), 1)
+    gray = cv2.cvtColor(blank_image, cv2.COLOR_BGR2GRAY)
+    corners = cv2.goodFeaturesToTrack(gray, maxCorners=num_corners, qualityLevel=quality_level, minDistance=min_distance)
+    return np.intp(corners).reshape(-1, 2) if corners is not None else []
+
+def time_corners(extract, image, contour, settings, repeat):
+    """
+    Returns: (mean seconds, peak traced memory in bytes, corners from the last run).
+    """
+    durations = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        corners = extract(image, contour, *settings)
+        durations.append(time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return float(np.mean(durations)), peak, corners
+
+def benchmark_corners(frames, repeat):
+    """
+    Compares the full-frame corner extraction with extract_holder_corners on every holder in every frame.
+    Prints latency and peak memory for both, and whether they found the same corners.
+    """
+    print(f"{'frame':<40} {'settings':<14} {'full (ms)':>10} {'crop (ms)':>10} {'full (MB)':>10} {'crop (MB)':>10} {'same':>5}")
+    for path, image in frames:
+        for contour in FrameAnalysis(image).holder_contours():
+            for settings in CORNER_SETTINGS:
+                full_time, full_peak, full_corners = time_corners(full_frame_holder_corners, image, contour, settings, repeat)
+                crop_time, crop_peak, crop_corners = time_corners(extract_holder_corners, image, contour, settings, repeat)
+                same = sorted(map(tuple, np.asarray(full_corners).tolist())) == sorted(map(tuple, np.asarray(crop_corners).tolist()))
+                print(f"{os.path.basename(path):<40} {str(settings):<14} {full_time * 1000:>10.1f} {crop_time * 1000:>10.1f} "
+                      f"{full_peak / 1e6:>10.1f} {crop_peak / 1e6:>10.2f} {'yes' if same else 'no':>5}")
+
+def check_qrcode_decodes(frames):
+    """
+    Counts the pyzbar calls per frame: find_holders decodes the crops around the holders, and the whole-frame lookups
+    made afterwards (conveyor splitting, color tuning) should reuse that result instead of decoding again.
+    Prints the calls for each frame, with a warning when a later lookup decoded again.
+    """
+    print(f"{'frame':<40} {'codes':>6} {'holders (calls)':>16} {'later lookups (calls)':>22}")
+    for path, image in frames:
+        clear_qrcode_cache()
+        start = qr_decode_calls()
+        FrameAnalysis(image).find_holders()
+        holder_calls = qr_decode_calls() - start
+        start = qr_decode_calls()
+        codes = find_qrcodes(image)
+        find_qrcodes(image)
+        later_calls = qr_decode_calls() - start
+        print(f"{os.path.basename(path):<40} {len(codes):>6} {holder_calls:>16} {later_calls:>22}")
+        if later_calls:
+            print("  warning: the frame was decoded again after find_holders")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the vision pipeline on stored frames.")
+    parser.add_argument('--frames', nargs='+', default=['captured_image.jpg'], help='Image files or directories of frames.')
+    parser.add_argument('--downscale', type=int, default=4, help='Downscale factor for the pyramid path.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement.')
+    parser.add_argument('--corners', action='store_true', help='Benchmark holder corner extraction instead of detection.')
+    parser.add_argument('--qrcodes', action='store_true', help='Count the QR decodes per frame instead of benchmarking detection.')
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames)
+    if not frames:
+        raise SystemExit("No frames found.")
+    if args.corners:
+        benchmark_corners(frames, args.repeat)
+    elif args.qrcodes:
+        check_qrcode_decodes(frames)
+    else:
+        benchmark_pyramid(frames, args.downscale, args.repeat)
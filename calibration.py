@@ -1,52 +1,63 @@
-import json
 from bottom_conveyor_motor_code import set_up_bottom_conveyor, step_bottom_conveyor_backward, step_bottom_conveyor_forward
-from image_analysis import find_leg_bottom_conveyor, find_leg_contours, find_leg_top_conveyor, get_conveyor_threshold, get_top_qr_right_conveyor, get_top_qr_left_conveyor
-import os
-import cv2
+from calibration_store import CALIBRATION_VARIABLES_PATH, get_calibration_store
+from conveyor_geometry import get_conveyor_geometry
+from image_analysis import capture_image, find_leg_bottom_conveyor, find_leg_contours, find_leg_top_conveyor, get_top_qr_right_conveyor, get_top_qr_left_conveyor
 import math
+from motor_driver import BOTTOM_AXIS, LEFT_AXIS, RIGHT_AXIS, TOP_AXIS
 from top_conveyor_motor_code import set_up_top_conveyor, step_top_conveyor_backward, step_top_conveyor_forward
 from vertical_conveyor_left_motor_code import move_left_conveyor, set_up_left_conveyor, clean_up_left_conveyor
 from vertical_conveyor_right_motor_code import move_right_conveyor, set_up_right_conveyor, clean_up_right_conveyor
 
 # File to store variables
-FILE_PATH = "calibration_variables.json"
+FILE_PATH = CALIBRATION_VARIABLES_PATH
 RIGHT_CONVEYOR_SPEED = "right_conveyor_motor_pixels_per_step"
 LEFT_CONVEYOR_SPEED = "left_conveyor_motor_pixels_per_step"
 TOP_CONVEYOR_SPEED_FORWARD = "top_conveyor_motor_pixels_per_step_forward"
 TOP_CONVEYOR_SPEED_BACKWARD = "top_conveyor_motor_pixels_per_step_backward"
 BOTTOM_CONVEYOR_SPEED_FORWARD = "bottom_conveyor_motor_pixels_per_step_forward"
 BOTTOM_CONVEYOR_SPEED_BACKWARD = "bottom_conveyor_motor_pixels_per_step_backward"
+CALIBRATION_SWEEP_KEY = "calibration_sweep" # per axis and direction: slope, intercept and residual of the last sweep (calibration_sweep.py)
+CALIBRATION_DECIMALS = 4 # of pixels per step saved - at 2 decimals an 800 step move could be out by 8 pixels
+
+# pixels per step for each axis, as (positive direction, negative direction) calibration keys
+AXIS_SPEED_KEYS = {
+    LEFT_AXIS: (LEFT_CONVEYOR_SPEED, LEFT_CONVEYOR_SPEED),
+    RIGHT_AXIS: (RIGHT_CONVEYOR_SPEED, RIGHT_CONVEYOR_SPEED),
+    TOP_AXIS: (TOP_CONVEYOR_SPEED_FORWARD, TOP_CONVEYOR_SPEED_BACKWARD),
+    BOTTOM_AXIS: (BOTTOM_CONVEYOR_SPEED_FORWARD, BOTTOM_CONVEYOR_SPEED_BACKWARD),
+}
 
 def round_down_2dp(num):
     return math.floor(num * 100) / 100
 
+def round_calibration(num):
+    return round(num, CALIBRATION_DECIMALS)
+
 # Save variables
 def save_variables(new_data):
-    # Load existing data from file (if exists)
-    data = load_variables()
-
-    # Update the existing data with the new data
-    data.update(new_data)
-
-    # Save the updated data back to the JSON file
-    with open(FILE_PATH, "w") as file:
-        json.dump(data, file, indent=4)
+    # Update the variables in new_data and write the file atomically
+    get_calibration_store().save(new_data)
 
 # Load variables
 def load_variables():
-    try:
-        with open(FILE_PATH, "r") as file:
-            return json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}  # Return empty dict if file doesn't exist or is corrupted
+    # Cached between calls until the file changes. Empty dict if the file doesn't exist or is corrupted
+    return get_calibration_store().load()
+
+def save_measurements(measurements):
+    """
+    Logs single-shot calibration measurements and saves each constant smoothed over its recent measurements.
+    Returns: dict of the values saved.
+    """
+    saved = get_calibration_store().record_and_save(measurements, rounding=round_calibration)
+    print(f"Measured {measurements}, saved {saved}")
+    return saved
 
 def calibrate_bottom_conveyor_motor(num_steps_to_test=800):
     print("Calibrating bottom conveyor motor...")
     set_up_bottom_conveyor()  # Set up the top conveyor motor
     # measure initial position
     image_path = "captured_image.jpg"
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) # read the captured image with opencv
+    image = capture_image(image_path) # capture image through the active camera backend
     leg_contours = find_leg_contours(image)
     x_original, y_original = find_leg_bottom_conveyor(leg_contours) # find the bottom leg
 
@@ -55,8 +66,7 @@ def calibrate_bottom_conveyor_motor(num_steps_to_test=800):
     step_bottom_conveyor_forward(num_steps_to_test)
 
     # measure new position
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) # read the captured image with opencv
+    image = capture_image(image_path) # capture image through the active camera backend
     leg_contours = find_leg_contours(image)
     x_new, y_new = find_leg_bottom_conveyor(leg_contours) # find the top leg
     pixels_moved_forward = abs(y_new - y_original)
@@ -65,26 +75,23 @@ def calibrate_bottom_conveyor_motor(num_steps_to_test=800):
 
     # move motor back
     step_bottom_conveyor_backward(num_steps_to_test)  # Move back to original position
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) # read the captured image with opencv
+    image = capture_image(image_path) # capture image through the active camera backend
     leg_contours = find_leg_contours(image)
     x_new, y_new = find_leg_bottom_conveyor(leg_contours) # find the top leg
     pixels_moved_backward = abs(y_new - y_original)
     pixels_moved_per_step_backward = pixels_moved_backward/num_steps_to_test
 
     # save new calibration variables
-    data = {BOTTOM_CONVEYOR_SPEED_FORWARD: round_down_2dp(pixels_moved_per_step_forward),
-            BOTTOM_CONVEYOR_SPEED_BACKWARD: round_down_2dp(pixels_moved_per_step_backward)}  # Assuming same speed for both directions
-    print(data)
-    save_variables(data)  # Save
+    data = {BOTTOM_CONVEYOR_SPEED_FORWARD: pixels_moved_per_step_forward,
+            BOTTOM_CONVEYOR_SPEED_BACKWARD: pixels_moved_per_step_backward}  # Assuming same speed for both directions
+    save_measurements(data)  # Log and save smoothed over recent calibrations
 
 def calibrate_top_conveyor_motor(num_steps_to_test=800):
     print("Calibrating top conveyor motor...")
     set_up_top_conveyor()  # Set up the top conveyor motor
     # measure initial position
     image_path = "captured_image.jpg"
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) # read the captured image with opencv
+    image = capture_image(image_path) # capture image through the active camera backend
     leg_contours = find_leg_contours(image)
     x_original, y_original = find_leg_top_conveyor(leg_contours) # find the top leg
 
@@ -93,8 +100,7 @@ def calibrate_top_conveyor_motor(num_steps_to_test=800):
     step_top_conveyor_forward(num_steps_to_test)
 
     # measure new position
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) # read the captured image with opencv
+    image = capture_image(image_path) # capture image through the active camera backend
     leg_contours = find_leg_contours(image)
     x_new, y_new = find_leg_top_conveyor(leg_contours) # find the top leg
     pixels_moved_forward = abs(y_new - y_original)
@@ -103,18 +109,16 @@ def calibrate_top_conveyor_motor(num_steps_to_test=800):
 
     # move motor back
     step_top_conveyor_backward(num_steps_to_test)  # Move back to original position
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) # read the captured image with opencv
+    image = capture_image(image_path) # capture image through the active camera backend
     leg_contours = find_leg_contours(image)
     x_new, y_new = find_leg_top_conveyor(leg_contours) # find the top leg
     pixels_moved_backward = abs(y_new - y_original)
     pixels_moved_per_step_backward = pixels_moved_backward/num_steps_to_test
 
     # save new calibration variables
-    data = {TOP_CONVEYOR_SPEED_FORWARD: round_down_2dp(pixels_moved_per_step_forward),
-            TOP_CONVEYOR_SPEED_BACKWARD: round_down_2dp(pixels_moved_per_step_backward)}  # Assuming same speed for both directions
-    print(data)
-    save_variables(data)  # Save
+    data = {TOP_CONVEYOR_SPEED_FORWARD: pixels_moved_per_step_forward,
+            TOP_CONVEYOR_SPEED_BACKWARD: pixels_moved_per_step_backward}  # Assuming same speed for both directions
+    save_measurements(data)  # Log and save smoothed over recent calibrations
 
 def calibrate_vertical_conveyor_motors(num_steps_to_test=600):  # to use, put one barcode on left conveyor and one on right conveyor somewhere in the middle
     print("Calibrating vertical conveyor motors...")
@@ -124,9 +128,8 @@ def calibrate_vertical_conveyor_motors(num_steps_to_test=600):  # to use, put on
 def calibrate_right_conveyor_motor(num_steps_to_test=600):  # to use, put one barcode on right conveyor somewhere in the middle
   # measure initial position
   image_path = "captured_image.jpg"
-  os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-  image = cv2.imread(image_path) # read the captured image with opencv
-  conveyor_threshold = get_conveyor_threshold(image)[0] # find threshold between left and right conveyor
+  image = capture_image(image_path) # capture image through the active camera backend
+  conveyor_threshold = get_conveyor_geometry(image)[0] # find threshold between left and right conveyor
   top_barcode_right_conveyor_original = get_top_qr_right_conveyor(image, conveyor_threshold)
 
   print("Original position: ", top_barcode_right_conveyor_original)
@@ -137,24 +140,21 @@ def calibrate_right_conveyor_motor(num_steps_to_test=600):  # to use, put one ba
   clean_up_right_conveyor()
 
   # measure new position
-  os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-  image = cv2.imread(image_path) # read the captured image with opencv
+  image = capture_image(image_path) # capture image through the active camera backend
   top_barcode_right_conveyor_new = get_top_qr_right_conveyor(image, conveyor_threshold)
   pixels_moved = abs(top_barcode_right_conveyor_new[1][0] - top_barcode_right_conveyor_original[1][0])
   pixels_moved_per_step = pixels_moved/num_steps_to_test
 
   # save new calibration variables
-  data = {RIGHT_CONVEYOR_SPEED: round_down_2dp(pixels_moved_per_step)}
-  print(data)
-  save_variables(data)  # Save
+  data = {RIGHT_CONVEYOR_SPEED: pixels_moved_per_step}
+  save_measurements(data)  # Log and save smoothed over recent calibrations
 
 def calibrate_left_conveyor_motor(num_steps_to_test=600):  # to use, put one barcode on left conveyor somewhere in the middle
     
     # measure initial position
     image_path = "captured_image.jpg"
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) # read the captured image with opencv
-    conveyor_threshold = get_conveyor_threshold(image)[0] # find threshold between left and right conveyor
+    image = capture_image(image_path) # capture image through the active camera backend
+    conveyor_threshold = get_conveyor_geometry(image)[0] # find threshold between left and right conveyor
     top_barcode_left_conveyor_original = get_top_qr_left_conveyor(image, conveyor_threshold)
 
     # move motor
@@ -163,17 +163,15 @@ def calibrate_left_conveyor_motor(num_steps_to_test=600):  # to use, put one bar
     clean_up_left_conveyor()
 
     # measure new position
-    os.system(f"rpicam-still --output {image_path} --nopreview") # capture image without displaying preview
-    image = cv2.imread(image_path) #
+    image = capture_image(image_path) # capture image through the active camera backend
     top_barcode_left_conveyor_new = get_top_qr_left_conveyor(image, conveyor_threshold)
     # calculate num pixels moved
     pixels_moved = abs(top_barcode_left_conveyor_new[1][0] - top_barcode_left_conveyor_original[1][0])
     pixels_moved_per_step = pixels_moved/num_steps_to_test
 
     # save new calibration variables
-    data = {"left_conveyor_motor_pixels_per_step": round_down_2dp(pixels_moved_per_step)}
-    print(data)
-    save_variables(data)  # Save
+    data = {"left_conveyor_motor_pixels_per_step": pixels_moved_per_step}
+    save_measurements(data)  # Log and save smoothed over recent calibrations
 
 if __name__ == "__main__":
     print("Running motor calibration...")
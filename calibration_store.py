@@ -0,0 +1,165 @@
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+# Calibration variables (calibration_variables.json) and the history of calibration measurements behind them.
+# The variables are cached in memory and only re-read when the file's modification time or size changes, and are written to a
+# temporary file that replaces the old one, so a crash mid-write can't leave a half-written file. Each single-shot
+# measurement is appended to CALIBRATION_HISTORY_PATH (one JSON line each) and the value saved for a motor constant is
+# smoothed over its recent measurements, so one noisy calibration doesn't throw off every PID loop that uses it.
+
+CALIBRATION_VARIABLES_PATH = "calibration_variables.json"
+CALIBRATION_HISTORY_PATH = "calibration_history.jsonl"
+SMOOTHING_WINDOW = 5 # most recent measurements of a constant the smoothed value is taken over
+EWMA_ALPHA = 0.5 # weight of the newest measurement in the exponentially weighted average
+
+MEDIAN = "median"
+EWMA = "ewma"
+
+def median_of(values, window=SMOOTHING_WINDOW):
+    return float(np.median(values[-window:]))
+
+def ewma_of(values, alpha=EWMA_ALPHA):
+    average = values[0]
+    for value in values[1:]:
+        average = alpha * value + (1 - alpha) * average
+    return float(average)
+
+SMOOTHERS = {MEDIAN: median_of, EWMA: ewma_of}
+
+def write_json_atomically(path, data, indent=None):
+    """
+    Writes `data` as JSON to a temporary file in the same directory, then replaces `path` with it, so a crash
+    mid-write leaves the old file rather than a half-written one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + "-", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as file:
+            json.dump(data, file, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temporary_path, 0o644) # mkstemp makes it readable by its owner only
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+class CalibrationStore:
+    """
+    Calibration variables and measurement history on disk.
+    - path: JSON file of variable name -> value.
+    - history_path: JSON lines file of measurements, or None not to keep one.
+    """
+
+    def __init__(self, path=CALIBRATION_VARIABLES_PATH, history_path=CALIBRATION_HISTORY_PATH):
+        self.path = path
+        self.history_path = history_path
+        self._variables = None
+        self._state = None
+        self._history = None
+        self._history_state = None
+
+    def load(self):
+        """
+        Returns: dict of the variables (a copy), re-reading the file only if it changed since it was last read or written.
+        An empty dict if the file doesn't exist or is corrupted.
+        """
+        state = _file_state(self.path)
+        if self._variables is None or state != self._state:
+            try:
+                with open(self.path, "r") as file:
+                    self._variables = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._variables = {}
+            self._state = state
+        return dict(self._variables)
+
+    def save(self, new_data):
+        """
+        Updates the variables in `new_data` and writes the file atomically.
+        """
+        variables = self.load()
+        variables.update(new_data)
+        write_json_atomically(self.path, variables, indent=4)
+        self._variables = variables
+        self._state = _file_state(self.path)
+
+    def history(self):
+        """
+        Returns: dict of variable name -> list of measured values, oldest first.
+        """
+        state = _file_state(self.history_path) if self.history_path is not None else None
+        if self._history is None or state != self._history_state:
+            self._history = {}
+            if self.history_path is not None:
+                try:
+                    with open(self.history_path, "r") as file:
+                        for line in file:
+                            try:
+                                measurement = json.loads(line)
+                                self._history.setdefault(measurement["key"], []).append(measurement["value"])
+                            except (json.JSONDecodeError, KeyError):
+                                continue # skip a line cut short by a crash mid-write
+                except FileNotFoundError:
+                    pass
+            self._history_state = state
+        return self._history
+
+    def record(self, measurements):
+        """
+        Appends each measurement in `measurements` (variable name -> value) to the history.
+        """
+        history = self.history()
+        if self.history_path is not None:
+            now = time.time()
+            with open(self.history_path, "a") as file:
+                for key, value in measurements.items():
+                    file.write(json.dumps({"time": round(now, 1), "key": key, "value": value}) + "\n")
+            self._history_state = _file_state(self.history_path)
+        for key, value in measurements.items():
+            history.setdefault(key, []).append(value)
+
+    def estimate(self, key, method=MEDIAN):
+        """
+        Returns: the smoothed value of `key` over its measurement history, or the saved value if it has none.
+        """
+        values = self.history().get(key)
+        if not values:
+            return self.load().get(key)
+        return SMOOTHERS[method](values)
+
+    def record_and_save(self, measurements, method=MEDIAN, rounding=None):
+        """
+        Records `measurements` and saves the smoothed estimate of each variable measured.
+        - rounding: applied to each estimate before it is saved, e.g. round_calibration.
+        Returns: dict of the values saved.
+        """
+        self.record(measurements)
+        smoothed = {key: self.estimate(key, method) for key in measurements}
+        if rounding is not None:
+            smoothed = {key: rounding(value) for key, value in smoothed.items()}
+        self.save(smoothed)
+        return smoothed
+
+def _file_state(path):
+    # modification time and size - either changes when the file is rewritten or appended to
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+_store = None
+
+def get_calibration_store():
+    """
+    Returns the store for calibration_variables.json in the working directory, creating it on first use.
+    """
+    global _store
+    if _store is None:
+        _store = CalibrationStore()
+    return _store
@@ -0,0 +1,289 @@
+import argparse
+import cv2
+import numpy as np
+from calibration import AXIS_SPEED_KEYS, CALIBRATION_SWEEP_KEY, load_variables, save_measurements, save_variables
+from conveyor_geometry import get_conveyor_geometry
+from image_analysis import FrameAnalysis, capture_image
+from motion_coordinator import MotionCoordinator, wait_for
+from motor_driver import BOTTOM_AXIS, LEFT_AXIS, RIGHT_AXIS, TOP_AXIS
+from tracker import ContourTracker, holder_plane, leg_plane
+
+# Calibrates an axis from a sweep of moves of several sizes in both directions, instead of dividing one move's pixels
+# by its steps. A holder (vertical conveyors) or leg (top/bottom conveyors) is found once and then tracked between
+# frames, and |pixels| = slope * |steps| + intercept is fitted per direction by least squares. The slope is the
+# pixels per step, the intercept the pixels lost to backlash each time the axis reverses (every move in the sweep
+# reverses the one before), and the residual how well the move sizes fit a straight line.
+# Each step size s is swept as -s/2, +s, -s, +s/2, so the object stays within s/2 of where it started.
+# The axes don't get in each other's way in the image - the vertical conveyors' holders are on either side of the
+# conveyor threshold, the legs are tracked on their own color - so several axes can be swept at once, moving together
+# and measured from the same frames.
+
+SWEEP_STEPS = (100, 200, 400, 800) # step sizes swept, smallest first
+DEFAULT_PIXELS_PER_STEP = 2.0 # prediction for the first move of an axis with no calibration yet
+MIN_STEP_SIZES_TO_FIT = 2 # per direction - a slope and intercept need at least two different move sizes
+EDGE_MARGIN = 2 # pixels - an object this close to the edge of the frame may be cut off, so isn't measured
+
+# direction the tracked object moves in the image for positive steps: the vertical conveyors' holders along +x (up),
+# the top conveyor's leg along -y (forward) and the bottom conveyor's leg along +y (forward)
+AXIS_PIXEL_DIRECTIONS = {LEFT_AXIS: 1, RIGHT_AXIS: 1, TOP_AXIS: -1, BOTTOM_AXIS: 1}
+DIRECTION_NAMES = {1: "positive", -1: "negative"}
+ALL_AXES = (LEFT_AXIS, RIGHT_AXIS, TOP_AXIS, BOTTOM_AXIS)
+
+def conveyor_band(frame, axis):
+    """
+    Returns: (top row, bottom row) of the conveyor `axis` moves.
+    """
+    threshold, conveyors_left, conveyors_right, _, _ = get_conveyor_geometry(frame.image, frame)
+    return (conveyors_left, threshold) if axis == LEFT_AXIS else (threshold, conveyors_right)
+
+def holder_candidates(frame, band):
+    """
+    Returns: [(contour, center x)] of the holders with their centers in `band` (see conveyor_band).
+    """
+    top, bottom = band
+    candidates = []
+    for contour in frame.holder_contours():
+        x, y, w, h = cv2.boundingRect(contour)
+        if top <= y + h / 2 < bottom:
+            candidates.append((contour, x + w / 2))
+    return candidates
+
+def leg_candidates(frame, axis):
+    """
+    Returns: [(contour, top y)] of the leg `axis` moves - the one find_leg_top_conveyor or find_leg_bottom_conveyor measures.
+    """
+    leg_contours = frame.leg_contours()
+    if not leg_contours:
+        return []
+    pick = max if axis == TOP_AXIS else min
+    contour = pick(leg_contours, key=lambda c: cv2.boundingRect(c)[0])
+    return [(contour, cv2.boundingRect(contour)[1])]
+
+# per axis: (image axis the object moves along, plane it is tracked on)
+SWEEP_TARGETS = {
+    LEFT_AXIS: ("x", holder_plane),
+    RIGHT_AXIS: ("x", holder_plane),
+    TOP_AXIS: ("y", leg_plane),
+    BOTTOM_AXIS: ("y", leg_plane),
+}
+
+class SweepTarget:
+    """
+    The holder or leg an axis's sweep measures, tracked between frames and found again with a full detection if the
+    tracker loses it. `position` is its coordinate along the image axis it moves along.
+    """
+
+    def __init__(self, axis):
+        image_axis, plane = SWEEP_TARGETS[axis]
+        self.axis = axis
+        self.tracker = ContourTracker(image_axis, plane)
+        self.band = None # conveyor band, found once - holders moving across its borders fail the saved geometry's check
+        self.box = None # bounding rect when it was found
+        self.origin = None
+        self.position = None
+
+    def candidates(self, frame):
+        if self.tracker.axis == "y":
+            return leg_candidates(frame, self.axis)
+        if self.band is None:
+            self.band = conveyor_band(frame, self.axis)
+        return holder_candidates(frame, self.band)
+
+    def find(self, image, near=None, frame=None):
+        """
+        Finds the object with a full detection - the candidate nearest `near`, or the middle of the frame, so it has
+        room to move both ways.
+        - frame: FrameAnalysis of `image`, if one is shared with other targets.
+        Returns: its position. Raises ValueError if there is none.
+        """
+        candidates = self.candidates(frame if frame is not None else FrameAnalysis(image))
+        if not candidates:
+            raise ValueError(f"Nothing to track for the {self.axis} axis calibration sweep.")
+        if near is None:
+            near = image.shape[1] / 2 if self.tracker.axis == "x" else image.shape[0] / 2
+        contour, position = min(candidates, key=lambda candidate: abs(candidate[1] - near))
+        self.tracker.seed(image, contour)
+        self.box = cv2.boundingRect(contour)
+        self.origin = self.position = position
+        return position
+
+    def locate(self, image, expected):
+        """
+        Returns: the object's position in a new frame, after a move expected to shift it by `expected` pixels, or None
+        if the tracker lost it. It is then found again, so later moves can be measured from the new position.
+        """
+        if not self.tracker.is_seeded: # the object gave no template to track - measured with full detections instead
+            return self.find(image, near=self.position + expected)
+        displacement = self.tracker.track(image, expected)
+        if displacement is None:
+            print(f"{self.axis} sweep: lost the tracked object, finding it again")
+            self.find(image, near=self.position + expected)
+            return None
+        self.position = self.origin + displacement
+        return self.position
+
+    def measurable_position(self, image):
+        """
+        Returns: the object's position, or None if it is at the edge of `image` - cut off, or held there (in simulation).
+        """
+        x, y, w, h = self.box
+        start, length, size = (x, w, image.shape[1]) if self.tracker.axis == "x" else (y, h, image.shape[0])
+        start += self.position - self.origin
+        if start <= EDGE_MARGIN or start + length >= size - EDGE_MARGIN:
+            print(f"{self.axis} sweep: tracked object at the edge of the frame, move not measured")
+            return None
+        return self.position
+
+def sweep_moves(step_sizes):
+    """
+    Returns: signed steps of the sweep's moves - -s/2, +s, -s, +s/2 for each step size s.
+    """
+    moves = []
+    for size in step_sizes:
+        moves += [-(size // 2), size, -size, size - size // 2]
+    return moves
+
+def sweep_axes(motion, axes, step_sizes=SWEEP_STEPS, pixels_per_step=None):
+    """
+    Moves `axes` through the sweep (see sweep_moves) together, measuring every axis's move from the one frame
+    captured after it. The first move isn't measured, as it may not reverse the axis's last move. Nor are moves the
+    tracker lost the object on, or that start or end with it at the edge of the frame.
+    - pixels_per_step: dict of axis -> (positive, negative) prediction used to search for the object after each move.
+    Returns: dict of axis -> array of (signed steps, signed pixels moved) rows, one per measured move.
+    """
+    pixels_per_step = pixels_per_step or {}
+    predicted = {axis: dict(zip((1, -1), pixels_per_step.get(axis, (DEFAULT_PIXELS_PER_STEP, DEFAULT_PIXELS_PER_STEP)))) for axis in axes}
+    targets = {axis: SweepTarget(axis) for axis in axes}
+    image = capture_image()
+    frame = FrameAnalysis(image)
+    positions = {}
+    for axis, target in targets.items():
+        target.find(image, frame=frame)
+        positions[axis] = target.measurable_position(image)
+
+    moves = {axis: [] for axis in axes}
+    for i, steps in enumerate(sweep_moves(step_sizes)):
+        direction = 1 if steps > 0 else -1
+        wait_for(motion.move_together({axis: steps for axis in axes}))
+        image = capture_image()
+        for axis, target in targets.items():
+            expected = AXIS_PIXEL_DIRECTIONS[axis] * steps * predicted[axis][direction]
+            lost = target.locate(image, expected) is None
+            position = target.measurable_position(image)
+            measured = not lost and i > 0 and positions[axis] is not None and position is not None
+            pixels = position - positions[axis] if measured else None
+            positions[axis] = position
+            if not measured:
+                continue
+            moves[axis].append((steps, pixels))
+            print(f"{axis} sweep: {steps} steps moved {pixels:.1f}px")
+            if pixels * AXIS_PIXEL_DIRECTIONS[axis] * direction > 0:
+                predicted[axis][direction] = abs(pixels / steps) # the next, larger moves are predicted from this one
+    return {axis: np.array(axis_moves, dtype=np.float64).reshape(-1, 2) for axis, axis_moves in moves.items()}
+
+def sweep_axis(motion, axis, step_sizes=SWEEP_STEPS, pixels_per_step=None):
+    """
+    Sweeps one axis. See sweep_axes.
+    - pixels_per_step: (positive, negative) prediction used to search for the object after each move.
+    Returns: array of (signed steps, signed pixels moved) rows, one per measured move.
+    """
+    return sweep_axes(motion, [axis], step_sizes, {axis: pixels_per_step} if pixels_per_step else None)[axis]
+
+def fit_sweep(moves):
+    """
+    Least squares fit of |pixels| = slope * |steps| + intercept, for both directions in one solve.
+    Moves measured going the wrong way (misdetections) are left out.
+    Returns: dict of direction (1 or -1) -> {"slope", "intercept", "residual" (RMS pixels), "moves"}, for each
+    direction with at least MIN_STEP_SIZES_TO_FIT move sizes.
+    """
+    moves = np.asarray(moves, dtype=np.float64).reshape(-1, 2)
+    steps, pixels = moves[:, 0], moves[:, 1]
+    pixel_direction = np.sign(np.sum(steps * pixels)) or 1.0 # which way positive steps move the object
+    directions = np.sign(steps)
+    kept = np.sign(pixels * pixel_direction) == directions
+    fitted = [direction for direction in (1, -1)
+              if len(np.unique(np.abs(steps[kept & (directions == direction)]))) >= MIN_STEP_SIZES_TO_FIT]
+    if not fitted:
+        return {}
+
+    # block diagonal design: a slope and intercept column pair per direction
+    rows = kept & np.isin(directions, fitted)
+    design = np.zeros((rows.sum(), 2 * len(fitted)))
+    for i, direction in enumerate(fitted):
+        in_direction = directions[rows] == direction
+        design[in_direction, 2 * i] = np.abs(steps[rows][in_direction])
+        design[in_direction, 2 * i + 1] = 1.0
+    measured = np.abs(pixels[rows])
+    solution, *_ = np.linalg.lstsq(design, measured, rcond=None)
+    errors = measured - design @ solution
+
+    fits = {}
+    for i, direction in enumerate(fitted):
+        in_direction = directions[rows] == direction
+        fits[direction] = {
+            "slope": float(solution[2 * i]),
+            "intercept": float(solution[2 * i + 1]),
+            "residual": float(np.sqrt(np.mean(errors[in_direction] ** 2))),
+            "moves": int(in_direction.sum()),
+        }
+    return fits
+
+def save_sweep(axis, fits):
+    """
+    Saves the fitted pixels per step as calibration measurements (smoothed with earlier calibrations), and each
+    direction's slope, intercept and residual under CALIBRATION_SWEEP_KEY.
+    Returns: dict of the pixels per step values saved.
+    """
+    positive_key, negative_key = AXIS_SPEED_KEYS[axis]
+    slopes = {direction: fit["slope"] for direction, fit in fits.items()}
+    if positive_key == negative_key: # one constant for both directions
+        measurements = {positive_key: float(np.mean(list(slopes.values())))}
+    else:
+        measurements = {key: slopes[direction] for key, direction in ((positive_key, 1), (negative_key, -1)) if direction in slopes}
+    saved = save_measurements(measurements)
+
+    sweeps = load_variables().get(CALIBRATION_SWEEP_KEY, {})
+    sweeps[axis] = {DIRECTION_NAMES[direction]: fit for direction, fit in fits.items()}
+    save_variables({CALIBRATION_SWEEP_KEY: sweeps})
+    return saved
+
+def calibrate_axes_sweep(motion, axes=ALL_AXES, step_sizes=SWEEP_STEPS):
+    """
+    Sweeps `axes` together, fits each and saves the results.
+    Returns: dict of axis -> fits (see fit_sweep), empty for an axis with too few moves measured to fit.
+    """
+    print(f"Calibrating {', '.join(axes)} conveyor motors with a sweep of {list(step_sizes)} steps...")
+    variables = load_variables()
+    pixels_per_step = {axis: tuple(variables.get(key, DEFAULT_PIXELS_PER_STEP) for key in AXIS_SPEED_KEYS[axis]) for axis in axes}
+    all_fits = {}
+    for axis, moves in sweep_axes(motion, axes, step_sizes, pixels_per_step).items():
+        fits = all_fits[axis] = fit_sweep(moves)
+        if not fits:
+            print(f"{axis} sweep: too few moves measured to fit, calibration not saved")
+            continue
+        for direction, fit in fits.items():
+            print(f"{axis} {DIRECTION_NAMES[direction]}: {fit['slope']:.4f} px/step, intercept {fit['intercept']:.1f}px, "
+                  f"residual {fit['residual']:.1f}px over {fit['moves']} moves")
+        save_sweep(axis, fits)
+    return all_fits
+
+def calibrate_axis_sweep(motion, axis, step_sizes=SWEEP_STEPS):
+    """
+    Sweeps one axis, fits it and saves the result.
+    Returns: the fits (see fit_sweep), empty if too few moves were measured to fit.
+    """
+    return calibrate_axes_sweep(motion, [axis], step_sizes)[axis]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate conveyor motors with a sweep of move sizes.")
+    parser.add_argument('--axes', nargs='+', choices=ALL_AXES, default=list(ALL_AXES), help='Axes to calibrate.')
+    parser.add_argument('--steps', nargs='+', type=int, default=list(SWEEP_STEPS), help='Step sizes to move, smallest first.')
+    parser.add_argument('--one-at-a-time', action='store_true', help='Sweep each axis on its own instead of all together.')
+    args = parser.parse_args()
+
+    with MotionCoordinator() as motion:
+        if args.one_at_a_time:
+            for axis in args.axes:
+                calibrate_axis_sweep(motion, axis, args.steps)
+        else:
+            calibrate_axes_sweep(motion, args.axes, args.steps)
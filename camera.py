@@ -0,0 +1,147 @@
+import abc
+import glob
+import os
+import time
+import cv2
+
+# Pluggable frame sources. All captures go through `get_camera()`, which is chosen with the GROBOT_CAMERA
+# environment variable:
+#   GROBOT_CAMERA=picamera2      - persistent in-process stream (default when picamera2 is installed)
+#   GROBOT_CAMERA=rpicam         - one rpicam-still subprocess per frame, read back from disk
+#   GROBOT_CAMERA=replay:<dir>   - recorded frames from a directory, for running without a camera
+#   GROBOT_CAMERA=sim:<frame>    - frames rendered from one recorded frame and the simulated motors (see simulation.py)
+#   GROBOT_CAMERA=recording:<dir> - the frames of a recorded run, in order (see recording.py)
+CAMERA_ENV_VAR = "GROBOT_CAMERA"
+REPLAY_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+class Camera(abc.ABC):
+    """
+    Interface for a frame source.
+    capture() returns a BGR numpy image, as cv2.imread would.
+    """
+
+    @abc.abstractmethod
+    def capture(self, path=None):
+        """
+        Captures a frame.
+        - path: where file-based backends write the frame. In-memory backends ignore it.
+        Returns: BGR image (numpy.ndarray).
+        """
+
+    def close(self):
+        pass
+
+class RpicamStillCamera(Camera):
+    """
+    Shells out to rpicam-still for every frame and reads the JPEG back from disk.
+    Slow (process startup, sensor warm-up, JPEG round trip) but needs nothing beyond the rpicam apps.
+    """
+
+    def __init__(self, path="captured_image.jpg"):
+        self.path = path
+
+    def capture(self, path=None):
+        path = path or self.path
+        os.system(f"rpicam-still --output {path} --nopreview")
+        return cv2.imread(path)
+
+class Picamera2Camera(Camera):
+    """
+    Keeps the sensor streaming in-process and returns frames straight from memory.
+    The sensor is started (and warmed up) once, so each capture costs only the frame copy.
+    """
+
+    def __init__(self, size=None, warm_up_seconds=1.0):
+        from picamera2 import Picamera2 # only available on the Pi
+
+        self.picam2 = Picamera2()
+        main = {"format": "RGB888"} # RGB888 is stored B, G, R - the channel order OpenCV expects
+        if size is not None:
+            main["size"] = size
+        self.picam2.configure(self.picam2.create_still_configuration(main=main))
+        self.picam2.start()
+        time.sleep(warm_up_seconds) # let exposure and white balance settle before the first frame
+
+    def capture(self, path=None):
+        return self.picam2.capture_array("main")
+
+    def close(self):
+        self.picam2.stop()
+        self.picam2.close()
+
+class ReplayCamera(Camera):
+    """
+    Serves recorded frames from a directory, in filename order.
+    Lets the whole pipeline run (and be benchmarked) on a machine with no camera.
+    - loop: start again from the first frame when the recording runs out, instead of raising.
+    """
+
+    def __init__(self, directory, loop=False):
+        self.paths = sorted(p for p in glob.glob(os.path.join(directory, '*'))
+                            if p.lower().endswith(REPLAY_IMAGE_EXTENSIONS))
+        if not self.paths:
+            raise ValueError(f"No frames to replay in {directory}")
+        self.loop = loop
+        self.index = 0
+
+    def capture(self, path=None):
+        if self.index >= len(self.paths):
+            if not self.loop:
+                raise RuntimeError("No more frames to replay.")
+            self.index = 0
+        image = cv2.imread(self.paths[self.index])
+        self.index += 1
+        return image
+
+def camera_from_spec(spec):
+    """
+    Builds a camera from a GROBOT_CAMERA style spec ("picamera2", "rpicam", "replay:<dir>", "sim:<frame>" or
+    "recording:<dir>").
+    An empty spec picks picamera2 when it is installed, otherwise rpicam-still.
+    """
+    if not spec:
+        try:
+            import picamera2
+            spec = "picamera2"
+        except ImportError:
+            spec = "rpicam"
+
+    if spec == "picamera2":
+        return Picamera2Camera()
+    if spec == "rpicam":
+        return RpicamStillCamera()
+    if spec.startswith("replay:"):
+        return ReplayCamera(spec[len("replay:"):])
+    if spec.startswith("sim:"):
+        from simulation import SimulatedCamera # imports the motor modules, so only when asked for
+        return SimulatedCamera(cv2.imread(spec[len("sim:"):]))
+    if spec.startswith("recording:"):
+        from recording import RecordingCamera # recording imports this module
+        return RecordingCamera(spec[len("recording:"):])
+    raise ValueError(f"Unknown camera backend: {spec}")
+
+_camera = None
+
+def get_camera():
+    """
+    Returns the active camera, creating it from GROBOT_CAMERA on first use.
+    """
+    global _camera
+    if _camera is None:
+        _camera = camera_from_spec(os.environ.get(CAMERA_ENV_VAR, ""))
+    return _camera
+
+def set_camera(camera):
+    """
+    Replaces the active camera (closing the previous one).
+    """
+    global _camera
+    if _camera is not None and _camera is not camera:
+        _camera.close()
+    _camera = camera
+
+def close_camera():
+    global _camera
+    if _camera is not None:
+        _camera.close()
+        _camera = None
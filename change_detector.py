@@ -0,0 +1,122 @@
+import cv2
+import numpy as np
+from image_analysis import FrameAnalysis, find_holders, holder_mask, shift_along_x
+
+# Skips the full holder detection (HSV conversion, equalization, masks, contours, QR decode) on frames where the
+# only thing that moved is the conveyor band being stepped. The new frame is compared with the previous one on
+# small gray thumbnails: if nothing changed the cached holders are reused, if only the moving band shifted along
+# the conveyor the cached holders on it are translated by the shift, and anything else runs a full detection.
+
+THUMBNAIL_SCALE = 8 # full-resolution pixels per thumbnail pixel
+PIXEL_CHANGE_THRESHOLD = 20 # gray levels - a thumbnail pixel that differs by more than this has changed
+MAX_CHANGED_FRACTION = 0.01 # fraction of changed thumbnail pixels put down to noise
+MIN_SHIFT_RESPONSE = 0.2 # phase correlation peak - below this the band's shift isn't clear
+MAX_CROSS_SHIFT = 1.0 # thumbnail pixels - a band moving across the conveyor means something else moved
+MAX_CACHED_REUSES = 3 # frames in a row the holders can be reused or translated before a full detection
+
+UNCHANGED = "unchanged"
+SHIFTED = "shifted"
+AMBIGUOUS = "ambiguous"
+
+def thumbnail(image, scale=THUMBNAIL_SCALE):
+    height, width = image.shape[:2]
+    return cv2.resize(image, (width // scale, height // scale), interpolation=cv2.INTER_AREA)
+
+class ConveyorChangeDetector:
+    """
+    Classifies how a frame changed while one conveyor moved.
+    - bands: dict of axis -> (top row, bottom row) of the conveyor band it moves, in full-resolution pixels.
+      A band moves along x.
+    """
+
+    def __init__(self, bands, scale=THUMBNAIL_SCALE):
+        self.bands = bands
+        self.scale = scale
+
+    def compare(self, previous_thumbnail, new_thumbnail, axis):
+        """
+        Compares two thumbnails (from `thumbnail`) taken before and after moving `axis`.
+        Returns: (UNCHANGED, 0), (SHIFTED, dx in full-resolution pixels) or (AMBIGUOUS, None).
+        """
+        previous = cv2.cvtColor(previous_thumbnail, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        new = cv2.cvtColor(new_thumbnail, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        changed = np.abs(new - previous) > PIXEL_CHANGE_THRESHOLD
+        if changed.mean() <= MAX_CHANGED_FRACTION:
+            return UNCHANGED, 0.0
+
+        top, bottom = (round(row / self.scale) for row in self.bands[axis])
+        outside_band = changed.sum() - changed[top:bottom].sum()
+        if outside_band > MAX_CHANGED_FRACTION * changed.size:
+            return AMBIGUOUS, None
+
+        previous_band, new_band = previous[top:bottom], new[top:bottom]
+        window = cv2.createHanningWindow((new_band.shape[1], new_band.shape[0]), cv2.CV_32F)
+        (dx, dy), response = cv2.phaseCorrelate(previous_band, new_band, window)
+        if response < MIN_SHIFT_RESPONSE or abs(dy) > MAX_CROSS_SHIFT:
+            return AMBIGUOUS, None
+
+        # the shift has to explain the whole band, apart from the strip uncovered at its edge
+        margin = int(np.ceil(abs(dx))) + 1
+        if margin >= new_band.shape[1]:
+            return AMBIGUOUS, None
+        covered = slice(margin, None) if dx > 0 else slice(0, new_band.shape[1] - margin)
+        uncovered = slice(0, margin) if dx > 0 else slice(new_band.shape[1] - margin, None)
+        # (blurred, so edges resampled by the sub-pixel shift don't count as changes)
+        residual = np.abs(cv2.GaussianBlur(shift_along_x(previous_band, dx), (5, 5), 0) - cv2.GaussianBlur(new_band, (5, 5), 0))
+        residual = residual[:, covered] > PIXEL_CHANGE_THRESHOLD
+        if residual.mean() > MAX_CHANGED_FRACTION:
+            return AMBIGUOUS, None
+
+        # a holder coming into view in the uncovered strip isn't in the cache. V is equalized with the whole
+        # thumbnail's histogram first, as holder_mask expects
+        strip = np.ascontiguousarray(new_thumbnail[top:bottom, uncovered])
+        if cv2.countNonZero(holder_mask(FrameAnalysis(new_thumbnail, downscale=1).crop_hsv_equalized(strip))):
+            return AMBIGUOUS, None
+
+        return SHIFTED, dx * self.scale
+
+class HolderCache:
+    """
+    find_holders for a loop moving one conveyor, reusing the previous frame's holders when the change detector
+    can account for what changed. Holders on the moving band are translated, the rest are reused as they are.
+    """
+
+    def __init__(self, detector, axis, detect=find_holders):
+        self.detector = detector
+        self.axis = axis
+        self.detect = detect
+        self.thumbnail = None
+        self.holders = None
+        self.reuses = 0
+
+    def find_holders(self, image):
+        new_thumbnail = thumbnail(image, self.detector.scale)
+        holders = None
+        if self.holders is not None and self.reuses < MAX_CACHED_REUSES:
+            change, dx = self.detector.compare(self.thumbnail, new_thumbnail, self.axis)
+            if change == UNCHANGED:
+                holders = self.holders
+            elif change == SHIFTED:
+                holders = self._shift_band(dx, image.shape[1])
+            print(f"Holder cache ({self.axis}): frame {change}" + (f" by {dx:.1f}px" if change == SHIFTED else ""))
+
+        if holders is None:
+            holders = self.detect(image)
+            self.reuses = 0
+        else:
+            self.reuses += 1
+        self.thumbnail = new_thumbnail
+        self.holders = holders
+        return holders
+
+    def _shift_band(self, dx, width):
+        top, bottom = self.detector.bands[self.axis]
+        holders = []
+        for holder in self.holders:
+            if top <= holder.center[1] < bottom:
+                holder = holder.translated(dx)
+                x, _, w, _ = holder.rect
+                if x < 0 or x + w > width: # moved partly out of frame - the detection would differ
+                    return None
+            holders.append(holder)
+        return holders
@@ -0,0 +1,311 @@
+import sys
+import cv2
+import numpy as np
+from calibration import load_variables, save_variables
+import image_analysis
+from image_analysis import FrameAnalysis, capture_image, conveyor_mask, decode_qrcodes, holder_mask, leg_mask, threshold_for_qrcodes
+
+# Fits the color and intensity thresholds the detectors use (holder and leg HSV ranges, the conveyor darkness
+# threshold and the QR threshold) to the current lighting, so a change of grow lights doesn't turn into failed
+# detections, retries and extra moves.
+# Pixels are labelled by a detection that worked - the bootstrap is a detection with the current thresholds - and
+# kept as running histograms per class (inside the labelled regions vs the rest of the frame). Only pixels inside a
+# detected outline that also pass the class's current mask are labelled, so the plant and QR code inside a holder's
+# outline aren't taken for holder red. Thresholds are refitted from the histograms alone, so re-tuning during a
+# rotation only costs the histograms of a downscaled frame (and two QR decodes when the QR threshold moves). A retune
+# can only widen a range or move a level a few steps at a time, and is rejected if it changes how many holders, legs
+# or QR codes are detected in the last frame observed.
+# Tuned thresholds are saved under COLOR_THRESHOLDS_KEY in calibration_variables.json and loaded at start up.
+# usage: python color_tuning.py [frame.jpg]   (captures a frame if none is given)
+
+COLOR_THRESHOLDS_KEY = "color_thresholds"
+TUNING_DOWNSCALE = 4 # full-resolution pixels per histogram pixel
+HISTOGRAM_DECAY = 0.7 # weight the running histograms keep when a new frame is observed
+MIN_LABELLED_PIXELS = 200 # downscaled pixels a class needs in a frame to be observed
+HUE_PERCENTILES = (0.01, 0.99) # fraction of a class's hues inside its fitted range
+HUE_MARGIN = 5 # hue steps added on each side of a fitted range
+LEVEL_MARGIN = 20 # levels a fitted saturation/value/gray bound is loosened by
+MIN_SATURATION_VALUE = 30 # lower S/V bounds never go below this, or gray and black would match every color
+MAX_HUE_WIDENING = 5 # hue steps a range's bounds can move outwards per retune
+MAX_LEVEL_WIDENING = 20 # levels a saturation/value/gray bound can move outwards per retune
+MAX_SHARED_LEG_FRACTION = 0.05 # of the leg mask's pixels the holder mask can match before legs count as holders
+EMPTY_HUE_RANGE = (180, 179) # the second holder range when the fitted one doesn't wrap - lower above upper matches nothing
+
+# image_analysis module constants tuned here
+TUNED_CONSTANTS = [
+    'HOLDER_COLOR_LOWER_THRESHOLD_HSV', 'HOLDER_COLOR_UPPER_THRESHOLD_HSV',
+    'HOLDER_COLOR_LOWER_THRESHOLD_HSV_2', 'HOLDER_COLOR_UPPER_THRESHOLD_HSV_2',
+    'LEG_COLOR_LOWER_THRESHOLD_HSV', 'LEG_COLOR_UPPER_THRESHOLD_HSV',
+    'CONVEYOR_DARK_THRESHOLD', 'QR_THRESHOLD',
+]
+
+def current_thresholds():
+    """
+    Returns: dict of the thresholds image_analysis is using, as saved to calibration_variables.json.
+    """
+    return {name: np.asarray(getattr(image_analysis, name)).tolist() for name in TUNED_CONSTANTS}
+
+def apply_thresholds(thresholds):
+    # sets the image_analysis constants the masks read, from a dict like current_thresholds()
+    for name, value in thresholds.items():
+        if name in TUNED_CONSTANTS:
+            setattr(image_analysis, name, np.array(value) if isinstance(value, list) else value)
+
+def load_color_thresholds():
+    """
+    Applies the thresholds saved in calibration_variables.json, if there are any.
+    Returns: True if saved thresholds were applied.
+    """
+    thresholds = load_variables().get(COLOR_THRESHOLDS_KEY)
+    if not thresholds:
+        return False
+    apply_thresholds(thresholds)
+    print("Loaded tuned color thresholds")
+    return True
+
+def save_color_thresholds():
+    save_variables({COLOR_THRESHOLDS_KEY: current_thresholds()})
+
+# ---- fitting thresholds from histograms ----
+def normalized(histogram):
+    total = histogram.sum()
+    return histogram / total if total else histogram
+
+def separating_lower_bound(inside, outside):
+    """
+    Returns: the level t for which `level >= t` best separates the inside histogram from the outside one
+    (largest difference between the fractions of each kept).
+    """
+    inside_kept = 1 - np.concatenate(([0.0], np.cumsum(normalized(inside))[:-1]))
+    outside_kept = 1 - np.concatenate(([0.0], np.cumsum(normalized(outside))[:-1]))
+    return int(np.argmax(inside_kept - outside_kept))
+
+def separating_upper_bound(inside, outside):
+    # the level t for which `level <= t` best separates inside from outside
+    return int(np.argmax(np.cumsum(normalized(inside)) - np.cumsum(normalized(outside))))
+
+def percentile_range(histogram, percentiles=HUE_PERCENTILES):
+    cdf = np.cumsum(normalized(histogram))
+    return int(np.searchsorted(cdf, percentiles[0])), int(np.searchsorted(cdf, percentiles[1]))
+
+def otsu_threshold(histogram):
+    """
+    Returns: the level splitting a bimodal histogram with the largest between-class variance (Otsu's method).
+    """
+    probabilities = normalized(histogram)
+    levels = np.arange(len(histogram))
+    weight = np.cumsum(probabilities)
+    mean = np.cumsum(probabilities * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mean[-1] * weight - mean) ** 2 / (weight * (1 - weight))
+    return int(np.nanargmax(between))
+
+def hue_histograms(hsv, mask, shift=0):
+    # histograms of hue (rotated by `shift`, so a range wrapping past 180 is contiguous), inside and outside the mask
+    hue = hsv[:, :, 0] if not shift else ((hsv[:, :, 0].astype(np.uint16) + shift) % 180).astype(np.uint8)
+    return channel_histograms(hue, mask, 180)
+
+def limit_widening(lower, upper, current_lower, current_upper, steps):
+    # bounds can tighten freely, but only move outwards by `steps` (per bound) from the current ones
+    lower = np.maximum(lower, np.asarray(current_lower) - steps)
+    upper = np.minimum(upper, np.asarray(current_upper) + steps)
+    return lower.tolist(), upper.tolist()
+
+def detection_counts(image, qrcodes=False):
+    """
+    Returns: (holders, legs, whether the holder mask takes in the legs, QR codes) detected in `image` with the
+    current thresholds. QR codes are only decoded (a full-frame decode, bypassing the cache) if `qrcodes`, else None.
+    """
+    frame = FrameAnalysis(image, downscale=TUNING_DOWNSCALE)
+    holders = frame.holder_contours()
+    legs = [contour for contour in frame.leg_contours() if cv2.contourArea(contour) > image_analysis.MIN_LEG_AREA]
+    leg_pixels = leg_mask(frame.small_hsv)
+    shared = cv2.countNonZero(cv2.bitwise_and(leg_pixels, holder_mask(frame.small_hsv_equalized)))
+    decoded = len(decode_qrcodes(threshold_for_qrcodes(frame.gray_equalized))) if qrcodes else None
+    return len(holders), len(legs), shared > MAX_SHARED_LEG_FRACTION * max(cv2.countNonZero(leg_pixels), 1), decoded
+
+def channel_histograms(channel, mask, bins=256):
+    inside = cv2.calcHist([channel], [0], mask, [bins], [0, bins]).ravel()
+    outside = cv2.calcHist([channel], [0], cv2.bitwise_not(mask), [bins], [0, bins]).ravel()
+    return inside, outside
+
+class ColorTuner:
+    """
+    Running histograms of labelled pixels, and the thresholds fitted from them.
+    observe() a frame with contours that were detected in it, then retune() to apply (and save) new thresholds.
+    Classes that haven't been observed keep their current thresholds.
+    """
+
+    def __init__(self, decay=HISTOGRAM_DECAY, scale=TUNING_DOWNSCALE):
+        self.decay = decay
+        self.scale = scale
+        self.histograms = {} # name -> (inside, outside)
+        self.image = None # last frame observed, new thresholds are checked against it
+
+    def _accumulate(self, name, inside, outside):
+        inside, outside = normalized(inside), normalized(outside)
+        if name in self.histograms:
+            old_inside, old_outside = self.histograms[name]
+            inside = self.decay * old_inside + (1 - self.decay) * inside
+            outside = self.decay * old_outside + (1 - self.decay) * outside
+        self.histograms[name] = (inside, outside)
+
+    def _label(self, shape, contours=None, rects=None, within=None):
+        # `within`: the class's current mask - only pixels passing it are labelled
+        mask = np.zeros(shape, dtype=np.uint8)
+        if contours:
+            cv2.drawContours(mask, [(np.asarray(c) // self.scale).astype(np.int32) for c in contours], -1, 255, -1)
+        for x, y, w, h in rects or []:
+            cv2.rectangle(mask, (int(x) // self.scale, int(y) // self.scale),
+                          ((int(x) + int(w)) // self.scale, (int(y) + int(h)) // self.scale), 255, -1)
+        if within is not None:
+            mask = cv2.bitwise_and(mask, within)
+        return mask if cv2.countNonZero(mask) >= MIN_LABELLED_PIXELS else None
+
+    def observe(self, image, holder_contours=None, leg_contours=None, conveyor_contours=None, qrcode_rects=None):
+        """
+        Adds the pixels inside the given contours/rects (detected in `image`) to the running histograms.
+        """
+        self.image = image
+        height, width = image.shape[:2]
+        small = cv2.resize(image, (width // self.scale, height // self.scale), interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        hsv_equalized = hsv.copy()
+        hsv_equalized[:, :, 2] = cv2.equalizeHist(hsv[:, :, 2]) # holders are masked on the equalized V
+        gray_equalized = cv2.equalizeHist(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+
+        mask = self._label(hsv.shape[:2], contours=holder_contours, within=holder_mask(hsv_equalized))
+        if mask is not None:
+            self._accumulate('holder_hue', *hue_histograms(hsv_equalized, mask, shift=90)) # red wraps around 0
+            self._accumulate('holder_saturation', *channel_histograms(hsv_equalized[:, :, 1], mask))
+            self._accumulate('holder_value', *channel_histograms(hsv_equalized[:, :, 2], mask))
+        mask = self._label(hsv.shape[:2], contours=leg_contours, within=leg_mask(hsv))
+        if mask is not None:
+            self._accumulate('leg_hue', *hue_histograms(hsv, mask))
+            self._accumulate('leg_saturation', *channel_histograms(hsv[:, :, 1], mask))
+            self._accumulate('leg_value', *channel_histograms(hsv[:, :, 2], mask))
+        mask = self._label(hsv.shape[:2], contours=conveyor_contours, within=conveyor_mask(gray_equalized))
+        if mask is not None:
+            self._accumulate('conveyor', *channel_histograms(gray_equalized, mask))
+        mask = self._label(hsv.shape[:2], rects=qrcode_rects)
+        if mask is not None:
+            self._accumulate('qrcode', *channel_histograms(gray_equalized, mask))
+
+    def thresholds(self):
+        """
+        Returns: dict of thresholds like current_thresholds(), refitted for every observed class.
+        """
+        thresholds = current_thresholds()
+        current = dict(thresholds)
+        steps = [MAX_HUE_WIDENING, MAX_LEVEL_WIDENING, MAX_LEVEL_WIDENING]
+        if 'holder_hue' in self.histograms:
+            low, high = percentile_range(self.histograms['holder_hue'][0])
+            low, high = low - 90 - HUE_MARGIN, high - 90 + HUE_MARGIN # back from the rotated hues
+            saturation = max(separating_lower_bound(*self.histograms['holder_saturation']) - LEVEL_MARGIN, MIN_SATURATION_VALUE)
+            value = max(separating_lower_bound(*self.histograms['holder_value']) - LEVEL_MARGIN, MIN_SATURATION_VALUE)
+            # a range wrapping past 0 is split in two, like the original red ranges - one that doesn't leaves the second empty
+            first = (max(low, 0), min(high, 179)) if high >= 0 else (180 + low, 180 + high)
+            second = (180 + low, 180) if low < 0 <= high else EMPTY_HUE_RANGE
+            for suffix, (hue_low, hue_high) in (('', first), ('_2', second)):
+                lower, upper = 'HOLDER_COLOR_LOWER_THRESHOLD_HSV' + suffix, 'HOLDER_COLOR_UPPER_THRESHOLD_HSV' + suffix
+                if (hue_low, hue_high) == EMPTY_HUE_RANGE: # set outright, limit_widening could turn it into a real range
+                    thresholds[lower], thresholds[upper] = [hue_low, saturation, value], [hue_high, 255, 255]
+                    continue
+                thresholds[lower], thresholds[upper] = limit_widening(
+                    [hue_low, saturation, value], [hue_high, 255, 255], current[lower], current[upper], steps)
+        if 'leg_hue' in self.histograms:
+            low, high = percentile_range(self.histograms['leg_hue'][0])
+            saturation = max(separating_lower_bound(*self.histograms['leg_saturation']) - LEVEL_MARGIN, MIN_SATURATION_VALUE)
+            value = max(separating_lower_bound(*self.histograms['leg_value']) - LEVEL_MARGIN, MIN_SATURATION_VALUE)
+            thresholds['LEG_COLOR_LOWER_THRESHOLD_HSV'], thresholds['LEG_COLOR_UPPER_THRESHOLD_HSV'] = limit_widening(
+                [max(low - HUE_MARGIN, 0), saturation, value], [min(high + HUE_MARGIN, 179), 255, 255],
+                current['LEG_COLOR_LOWER_THRESHOLD_HSV'], current['LEG_COLOR_UPPER_THRESHOLD_HSV'], steps)
+        if 'conveyor' in self.histograms:
+            dark = min(separating_upper_bound(*self.histograms['conveyor']) + LEVEL_MARGIN, 255)
+            thresholds['CONVEYOR_DARK_THRESHOLD'] = min(dark, current['CONVEYOR_DARK_THRESHOLD'] + MAX_LEVEL_WIDENING)
+        if 'qrcode' in self.histograms:
+            qr = otsu_threshold(self.histograms['qrcode'][0])
+            thresholds['QR_THRESHOLD'] = min(max(qr, current['QR_THRESHOLD'] - MAX_LEVEL_WIDENING), current['QR_THRESHOLD'] + MAX_LEVEL_WIDENING)
+        return thresholds
+
+    def keeps_detections(self, thresholds):
+        """
+        Returns: True if `thresholds` detect as many holders and legs in the last frame observed as the current ones,
+        without the holder mask taking in the legs - and, if the QR threshold changes, decode as many QR codes.
+        """
+        if self.image is None:
+            return True
+        current = current_thresholds()
+        qrcodes = thresholds['QR_THRESHOLD'] != current['QR_THRESHOLD'] # the decodes are only worth it if it changes
+        before = detection_counts(self.image, qrcodes)
+        apply_thresholds(thresholds)
+        try:
+            after = detection_counts(self.image, qrcodes)
+        finally:
+            apply_thresholds(current)
+        if after != before:
+            print(f"Rejected retuned color thresholds: (holders, legs, legs masked as holders, QR codes) {before} -> {after}")
+            return False
+        return True
+
+    def retune(self, save=True):
+        """
+        Applies thresholds refitted from the running histograms (and saves them to calibration_variables.json),
+        unless they change the detections in the last frame observed.
+        Returns: the thresholds in use afterwards.
+        """
+        thresholds = self.thresholds()
+        current = current_thresholds()
+        changed = {name: value for name, value in thresholds.items() if value != current[name]}
+        if not changed:
+            return current
+        if not self.keeps_detections(thresholds):
+            return current
+        print(f"Retuned color thresholds: {changed}")
+        apply_thresholds(thresholds)
+        if save:
+            save_color_thresholds()
+        return thresholds
+
+def qrcode_rects(qrcodes):
+    """
+    Returns: (x, y, w, h) of each QR code, from the (data, center, top_left) found by find_qrcodes.
+    """
+    rects = []
+    for _, (center_x, center_y), (right, top) in qrcodes:
+        w, h = 2 * (right - center_x), 2 * (center_y - top) # top_left is the top right corner of the code's rect
+        rects.append((right - w, top, w, h))
+    return rects
+
+def observe_frame(tuner, frame, holders=None, leg_contours=None, conveyor_contours=None, image=None):
+    """
+    Observes a FrameAnalysis's detections. Anything not given is detected with the current thresholds.
+    - image: the frame's pixels before anything was drawn on them (find_leg_contours draws on frame.image),
+      if they have been kept.
+    QR codes are the ones find_holders already decoded, rather than decoding the whole frame again.
+    """
+    holders = frame.find_holders() if holders is None else holders
+    leg_contours = frame.leg_contours() if leg_contours is None else leg_contours
+    conveyor_contours = frame.conveyor_contours() if conveyor_contours is None else conveyor_contours
+    qrcodes = frame.qrcodes if frame.qrcodes is not None else frame.find_qrcodes()
+    # codes decoded from a retried capture aren't where they were in this frame
+    rects = qrcode_rects(qrcodes) if frame.qrcode_frame is frame else None
+    tuner.observe(frame.image if image is None else image, holder_contours=[holder['contour'] for holder in holders],
+                  leg_contours=leg_contours, conveyor_contours=conveyor_contours, qrcode_rects=rects)
+
+def tune_from_frame(image, passes=2):
+    """
+    Bootstraps thresholds from one frame: detects with the current thresholds, fits new ones to what was found,
+    and repeats with the new thresholds. Saves the result to calibration_variables.json.
+    Returns: the thresholds applied.
+    """
+    tuner = ColorTuner(decay=0.0) # only the latest pass counts
+    for _ in range(passes):
+        observe_frame(tuner, FrameAnalysis(image))
+        thresholds = tuner.retune(save=False)
+    save_color_thresholds()
+    return thresholds
+
+if __name__ == "__main__":
+    image = cv2.imread(sys.argv[1]) if len(sys.argv) > 1 else capture_image()
+    print(tune_from_frame(image))
@@ -0,0 +1,120 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from image_analysis import capture_image
+from recording import MEASUREMENT, record_event
+
+# Runs the move -> capture -> analyse -> decide loops of the rotation. A frame taken mid-move would be blurred and
+# measure a stale position, and the next move can't be decided before its measurement, so the overlap is what is
+# left: a worker thread waits on each move and captures the next frame the moment the motor stops, then measures
+# it straight away, while the main thread does the previous frame's follow-up work (drawing and saving debug
+# images, logging) during the move. The timing of every iteration is printed, with how much follow-up was hidden.
+
+class IterationTiming:
+    """
+    Timing of one loop iteration, in seconds.
+    - move: from submitting the move to the motor stopping.
+    - wall: from deciding the move to the next measurement being ready.
+    - hidden: follow-up time that ran while the worker moved, captured and measured.
+    """
+
+    def __init__(self, iteration, steps):
+        self.iteration = iteration
+        self.steps = steps
+        self.decide = self.move = self.capture = self.measure = self.follow_up = self.wall = 0.0
+
+    @property
+    def hidden(self):
+        return min(self.follow_up, self.move + self.capture + self.measure)
+
+    def __str__(self):
+        return (f"iteration {self.iteration}: {self.steps} steps, decide {self.decide:.3f}s, move {self.move:.3f}s, "
+                f"capture {self.capture:.3f}s, measure {self.measure:.3f}s, follow up {self.follow_up:.3f}s, "
+                f"wall {self.wall:.3f}s, follow up hidden {self.hidden:.3f}s")
+
+class ControlLoop:
+    """
+    Moves one axis until `decide` says to stop.
+    - motion: the MotionCoordinator that moves the axis.
+    - measure(image): returns the measurement `decide` needs, e.g. a leg or holder position. Runs on the worker thread.
+    - decide(measurement): returns the signed steps to move next, or 0 to stop.
+    - follow_up(image, measurement): optional, called for each frame while the move it led to is running
+      (drawing and saving debug images, etc).
+    - capture: function taking a frame, capture_image by default.
+    After run(), `image` is the last frame captured and `timings` holds an IterationTiming per move.
+    """
+
+    def __init__(self, motion, axis, measure, decide, follow_up=None, capture=capture_image, name=None):
+        self.motion = motion
+        self.axis = axis
+        self.measure = measure
+        self.decide = decide
+        self.follow_up = follow_up
+        self.capture = capture
+        self.name = name or f"{axis} conveyor"
+        self.image = None
+        self.timings = []
+        self.hit_iteration_limit = False
+
+    def _capture_and_measure(self, move, timing, move_started):
+        # worker thread: waits for the move, then captures and measures as soon as the motor stops
+        move.result()
+        timing.move = time.perf_counter() - move_started
+
+        started = time.perf_counter()
+        image = self.capture()
+        timing.capture = time.perf_counter() - started
+
+        started = time.perf_counter()
+        measurement = self.measure(image)
+        timing.measure = time.perf_counter() - started
+        return image, measurement
+
+    def run(self, measurement, image=None, max_iterations=None):
+        """
+        Runs the loop from an existing measurement (of `image`, if given).
+        Returns: the last measurement.
+        """
+        self.image = image
+        self.timings = []
+        self.hit_iteration_limit = False
+        record_event(MEASUREMENT, loop=self.name, iteration=0, value=measurement)
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="control-loop") as worker:
+            while True:
+                started = time.perf_counter()
+                steps = self.decide(measurement)
+                if not steps:
+                    break
+                if max_iterations is not None and len(self.timings) >= max_iterations:
+                    self.hit_iteration_limit = True
+                    break
+                timing = IterationTiming(len(self.timings) + 1, steps)
+                timing.decide = time.perf_counter() - started
+
+                move_started = time.perf_counter()
+                move = self.motion.move(self.axis, steps)
+                next_frame = worker.submit(self._capture_and_measure, move, timing, move_started)
+
+                if self.follow_up is not None and self.image is not None: # overlaps the move, capture and measure
+                    follow_up_started = time.perf_counter()
+                    self.follow_up(self.image, measurement)
+                    timing.follow_up = time.perf_counter() - follow_up_started
+
+                self.image, measurement = next_frame.result()
+                timing.wall = time.perf_counter() - started
+                self.timings.append(timing)
+                record_event(MEASUREMENT, loop=self.name, iteration=timing.iteration, value=measurement)
+                print(f"{self.name} {timing}")
+
+        self.report()
+        return measurement
+
+    def report(self):
+        if not self.timings:
+            return
+        wall = sum(timing.wall for timing in self.timings)
+        motor = sum(timing.move for timing in self.timings)
+        vision = sum(timing.capture + timing.measure for timing in self.timings)
+        hidden = sum(timing.hidden for timing in self.timings)
+        print(f"{self.name}: {len(self.timings)} iterations in {wall:.2f}s (motor {motor:.2f}s, capture and measure "
+              f"{vision:.2f}s, follow up hidden {hidden:.2f}s)")
@@ -0,0 +1,100 @@
+import json
+import os
+import numpy as np
+from calibration_store import write_json_atomically
+from camera import CAMERA_ENV_VAR
+from image_analysis import FrameAnalysis
+
+# The conveyor frame doesn't move, so its borders and the left/right split are detected once and saved with a
+# fingerprint of the camera pose: gray profiles across each border, sampled along a few lines. Later runs compare the
+# same few lines of a new frame with the saved profiles, and only run the full detection when they don't match
+# (the camera was moved, or a different camera is in use).
+
+CONVEYOR_GEOMETRY_PATH = "conveyor_geometry.json"
+FINGERPRINT_LINES = 12 # lines sampled across each border
+FINGERPRINT_HALF_LENGTH = 40 # pixels sampled on each side of a border, along each line
+MIN_PROFILE_CORRELATION = 0.8 # normalized correlation for a line's profile to match the saved one
+MIN_MATCHING_FRACTION = 0.6 # of the lines across each border - holders passing over the conveyor hide some
+FLAT_PROFILE_NORM = 20.0 # gray levels of variation along a line below which its profile is flat
+
+GRAY_WEIGHTS = np.array([0.114, 0.587, 0.299]) # B, G, R - as cv2.COLOR_BGR2GRAY
+
+def border_profiles(image, geometry):
+    """
+    Samples gray profiles across each conveyor border.
+    - geometry: (threshold, left, right, top, bottom) from get_conveyor_threshold. left/right are rows, top/bottom columns.
+    Returns: dict of border name -> array of profiles (one row per line), only converting the sampled pixels to gray.
+    """
+    height, width = image.shape[:2]
+    _, left, right, top, bottom = geometry
+    half = FINGERPRINT_HALF_LENGTH
+    columns = np.linspace(bottom, top, FINGERPRINT_LINES + 2)[1:-1].astype(int) # lines across the row borders
+    rows = np.linspace(left, right, FINGERPRINT_LINES + 2)[1:-1].astype(int) # lines across the column borders
+
+    profiles = {}
+    for name, row in (('left', left), ('right', right)):
+        span = np.clip(np.arange(row - half, row + half), 0, height - 1)
+        profiles[name] = image[span[:, None], columns[None, :]].astype(np.float64) @ GRAY_WEIGHTS # span x lines
+        profiles[name] = profiles[name].T
+    for name, column in (('top', top), ('bottom', bottom)):
+        span = np.clip(np.arange(column - half, column + half), 0, width - 1)
+        profiles[name] = image[rows[:, None], span[None, :]].astype(np.float64) @ GRAY_WEIGHTS # lines x span
+    return profiles
+
+def profiles_match(saved, current):
+    """
+    Returns: True if enough lines across every border have the same shape of profile as when the geometry was saved.
+    Profiles are normalized first, so a change of lighting alone doesn't fail the check.
+    """
+    for name, saved_profiles in saved.items():
+        a = np.asarray(saved_profiles, dtype=np.float64)
+        b = np.asarray(current[name], dtype=np.float64)
+        if a.shape != b.shape:
+            return False
+        a = a - a.mean(axis=1, keepdims=True)
+        b = b - b.mean(axis=1, keepdims=True)
+        norm_a, norm_b = np.linalg.norm(a, axis=1), np.linalg.norm(b, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = np.where(norm_a * norm_b > 0, (a * b).sum(axis=1) / (norm_a * norm_b), 0.0)
+        flat = (norm_a < FLAT_PROFILE_NORM) & (norm_b < FLAT_PROFILE_NORM) # e.g. a line that misses the border in both
+        if np.mean((correlation >= MIN_PROFILE_CORRELATION) | flat) < MIN_MATCHING_FRACTION:
+            print(f"Conveyor geometry: {name} border no longer matches")
+            return False
+    return True
+
+def camera_fingerprint(image):
+    return {'camera': os.environ.get(CAMERA_ENV_VAR, ""), 'frame_size': list(image.shape[:2])}
+
+def load_conveyor_geometry(path=CONVEYOR_GEOMETRY_PATH):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_conveyor_geometry(image, geometry, path=CONVEYOR_GEOMETRY_PATH):
+    saved = {
+        'geometry': [int(value) for value in geometry],
+        'fingerprint': camera_fingerprint(image),
+        'profiles': {name: np.round(profiles, 1).tolist() for name, profiles in border_profiles(image, geometry).items()},
+    }
+    write_json_atomically(path, saved) # a crash mid-write mustn't leave a truncated file for the next run to load
+
+def get_conveyor_geometry(image, frame=None, path=CONVEYOR_GEOMETRY_PATH):
+    """
+    Returns: (threshold, left, right, top, bottom) as get_conveyor_threshold, from the saved geometry when the
+    camera pose still matches, otherwise detected on `image` (or its FrameAnalysis `frame`) and saved.
+    Raises ValueError if the conveyors have to be detected and aren't found.
+    """
+    saved = load_conveyor_geometry(path)
+    if saved is not None and saved.get('fingerprint') == camera_fingerprint(image):
+        geometry = tuple(saved['geometry'])
+        if profiles_match(saved['profiles'], border_profiles(image, geometry)):
+            print("Conveyor geometry: using saved borders")
+            return geometry
+
+    print("Conveyor geometry: detecting borders")
+    frame = frame if frame is not None else FrameAnalysis(image)
+    geometry = tuple(int(value) for value in frame.get_conveyor_threshold())
+    save_conveyor_geometry(image, geometry, path)
+    return geometry
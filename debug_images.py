@@ -0,0 +1,118 @@
+import atexit
+import os
+import queue
+import threading
+import cv2
+
+# Debug images written by the vision code and the control scripts (masks, contours, targets drawn on frames).
+# JPEG encoding and SD card writes take a big share of a loop iteration, so images go through one sink, chosen with
+# the GROBOT_DEBUG_IMAGES environment variable:
+#   GROBOT_DEBUG_IMAGES=full        - every image is written (default)
+#   GROBOT_DEBUG_IMAGES=sampled[:N] - every Nth image of each name is written (the first always is)
+#   GROBOT_DEBUG_IMAGES=off         - nothing is written
+# Images are encoded and written on a background thread. If it falls behind, new images are dropped rather than
+# holding up the caller.
+DEBUG_IMAGES_ENV_VAR = "GROBOT_DEBUG_IMAGES"
+DEFAULT_SAMPLE_EVERY = 10 # images of each name per image written, in sampled mode
+MAX_QUEUED_IMAGES = 4 # images waiting to be written before new ones are dropped (full frames are ~35MB each)
+
+OFF = "off"
+SAMPLED = "sampled"
+FULL = "full"
+
+class DebugImageSink:
+    """
+    Writes debug images on a background thread.
+    - mode: OFF, SAMPLED or FULL.
+    - sample_every: in SAMPLED mode, write one in this many images of each name.
+    - max_queued: bound on images waiting to be written. Images saved while it is full are dropped.
+    """
+
+    def __init__(self, mode=FULL, sample_every=DEFAULT_SAMPLE_EVERY, max_queued=MAX_QUEUED_IMAGES):
+        if mode not in (OFF, SAMPLED, FULL):
+            raise ValueError(f"Unknown debug image mode: {mode}")
+        self.mode = mode
+        self.sample_every = max(int(sample_every), 1)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.counts = {} # images saved per name, for sampling
+        self.written = 0
+        self.dropped = 0
+        self.thread = None
+
+    def save(self, path, image, copy=True):
+        """
+        Queues `image` to be written to `path`, if the mode and sampling allow it.
+        - copy: copy the image first. Pass False only if the caller won't draw on it afterwards.
+        Returns: True if the image was queued.
+        """
+        if self.mode == OFF:
+            return False
+        count = self.counts.get(path, 0)
+        self.counts[path] = count + 1
+        if self.mode == SAMPLED and count % self.sample_every:
+            return False
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write_images, name="debug-images", daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait((path, image.copy() if copy else image))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _write_images(self):
+        while True:
+            path, image = self.queue.get()
+            try:
+                if not cv2.imwrite(path, image):
+                    print(f"Failed to write debug image {path}")
+                self.written += 1
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # waits until every queued image has been written
+        if self.thread is not None:
+            self.queue.join()
+
+    def __str__(self):
+        return f"debug images ({self.mode}): {self.written} written, {self.dropped} dropped"
+
+def debug_sink_from_spec(spec):
+    """
+    Builds a sink from a GROBOT_DEBUG_IMAGES value (see top of file).
+    """
+    mode, _, sample_every = spec.partition(":")
+    if mode == SAMPLED and sample_every:
+        return DebugImageSink(SAMPLED, int(sample_every))
+    return DebugImageSink(mode or FULL)
+
+_sink = None
+
+def get_debug_sink():
+    """
+    Returns the active sink, creating it from GROBOT_DEBUG_IMAGES on first use.
+    """
+    global _sink
+    if _sink is None:
+        _sink = debug_sink_from_spec(os.environ.get(DEBUG_IMAGES_ENV_VAR, ""))
+        atexit.register(flush_debug_images) # the writer is a daemon thread, so write what's queued before exiting
+    return _sink
+
+def set_debug_sink(sink):
+    global _sink
+    if _sink is not None and _sink is not sink:
+        _sink.flush()
+    _sink = sink
+
+def save_debug_image(path, image, copy=True):
+    """
+    Saves a debug image through the active sink. See DebugImageSink.save.
+    """
+    return get_debug_sink().save(path, image, copy)
+
+def flush_debug_images():
+    if _sink is not None:
+        _sink.flush()
@@ -1,8 +1,15 @@
-import os
 import cv2
 import numpy as np
 from pyzbar.pyzbar import decode
 import gc
+import time
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from functools import cached_property
+from camera import get_camera
+from debug_images import save_debug_image
+from recording import record_frame
 
 
 # Define holder color range in HSV (red) - because red is at both ends of the hue spectrum, need two ranges
@@ -21,10 +28,513 @@ MIN_HOLDER_AREA = 80000
 MIN_LEG_AREA = 4500
 
 NUM_QRCODES = 1  # Set this to however many QR codes you expect
+QR_CACHE_SIZE = 8  # number of recent frames whose QR decode results are kept
+
+# QR decoding around holders: "roi" decodes padded crops around each detected holder, "full" decodes the whole frame
+QR_DECODE_MODE = "roi"
+QR_MATCH_DISTANCE = 450  # pixels - furthest a QR code's top-left corner can be from its holder's center
+QR_ROI_PADDING = 120  # pixels added around the matching distance, so a code whose corner is just in range is decoded whole
+QR_ROI_FALLBACK_TO_FULL_FRAME = True  # decode the full frame if the crops yield fewer than NUM_QRCODES codes
+
+# When fewer than NUM_QRCODES codes are found, every preprocessing variant (see QR_PREPROCESSING) is tried on the frame
+# before capturing another one. Gives up - returning the most codes found - after these limits.
+QR_MAX_CAPTURES = 3  # frames decoded per find_qrcodes call, including the one it was called on
+QR_RETRY_TIME_BUDGET = 15.0  # seconds - no new capture or variant is started after this
+
+# Pyramid detection: color masks and contours are found on a frame downscaled by this factor, then only the
+# winning contours are refined at full resolution. 1 runs everything at full resolution.
+DETECTION_DOWNSCALE = 1
+PYRAMID_REFINE_MARGIN = 8  # full-resolution pixels added around a contour's scaled-up bounding rect before refining
+MIN_CONVEYOR_AREA = 200000 # minimum number of dark pixels for a contour to be considered part of the conveyor
+CONVEYOR_DARK_THRESHOLD = 60 # equalized gray levels at or below this are conveyor (changed intensity from 50)
+QR_THRESHOLD = 150 # equalized gray levels below this are blacked out before decoding QR codes
+CORNER_CANVAS_PADDING = 8  # pixels of blank canvas around a holder's outline, so corners on its edge aren't clipped
+
+# QR decode results per frame, keyed on the image buffer - see `get_cached_qrcodes`
+_qrcode_cache = OrderedDict()
+_qr_decode_calls = 0
 
 def capture_image(path="captured_image.jpg"):
-    os.system(f"rpicam-still --output {path} --nopreview")
-    return cv2.imread(path)
+    # captures through the active camera backend - see camera.py. path is only used by file-based backends
+    image = get_camera().capture(path)
+    record_frame(image) # if the run is being recorded - see recording.py
+    return image
+
+# ----------- QR CODE CACHE -------------
+def _image_key(image):
+    # identifies the image buffer: data pointer, shape and strides
+    return image.__array_interface__['data'][0], image.shape, image.strides
+
+def get_cached_qrcodes(image, regions=None):
+    """
+    Returns the QR codes already decoded for this exact image buffer, or None if it hasn't been decoded.
+    - regions: the hashable regions a crop-only decode should cover, or None for the whole frame. A whole-frame
+      decode answers any request. A crop-only decode answers requests for the same regions, and whole-frame
+      requests once it found NUM_QRCODES codes - decoding the rest of the frame would stop there too.
+    Entries hold a weak reference to the image, so a new frame that reuses a freed buffer's address is a miss.
+    """
+    key = _image_key(image)
+    entry = _qrcode_cache.get(key)
+    if entry is None:
+        return None
+    image_ref, qrcode_info, partial, covered = entry
+    if image_ref() is not image:
+        del _qrcode_cache[key]
+        return None
+    if covered is not None and covered != regions and (regions is not None or partial):
+        return None
+    _qrcode_cache.move_to_end(key)
+    if partial:
+        print(f"Reusing the {len(qrcode_info)} QR codes found in this frame before, short of {NUM_QRCODES}")
+    return list(qrcode_info)
+
+def cache_qrcodes(image, qrcode_info, regions=None, partial=False):
+    """
+    Stores the QR codes decoded for an image (or only its `regions`), evicting the least recently used frame once
+    QR_CACHE_SIZE is reached. One entry is kept per frame, recording the regions it covered (None for the whole frame).
+    - partial: True if the decode gave up short of NUM_QRCODES codes.
+    """
+    key = _image_key(image)
+    _qrcode_cache[key] = (weakref.ref(image), list(qrcode_info), partial, regions)
+    _qrcode_cache.move_to_end(key)
+    while len(_qrcode_cache) > QR_CACHE_SIZE:
+        _qrcode_cache.popitem(last=False)
+
+def clear_qrcode_cache():
+    _qrcode_cache.clear()
+
+def qr_decode_calls():
+    # pyzbar decodes run so far, whole frames and crops alike - see benchmark_vision.py --qrcodes
+    return _qr_decode_calls
+
+# ----------- COLOR MASKS -------------
+def holder_mask(hsv_equalized):
+    # red is at both ends of the hue spectrum, so two ranges are combined
+    mask1 = cv2.inRange(hsv_equalized, HOLDER_COLOR_LOWER_THRESHOLD_HSV, HOLDER_COLOR_UPPER_THRESHOLD_HSV)
+    mask2 = cv2.inRange(hsv_equalized, HOLDER_COLOR_LOWER_THRESHOLD_HSV_2, HOLDER_COLOR_UPPER_THRESHOLD_HSV_2)
+    return cv2.bitwise_or(mask1, mask2)
+
+def leg_mask(hsv):
+    return cv2.inRange(hsv, LEG_COLOR_LOWER_THRESHOLD_HSV, LEG_COLOR_UPPER_THRESHOLD_HSV)
+
+def conveyor_mask(gray_equalized):
+    _, binary_mask = cv2.threshold(gray_equalized, CONVEYOR_DARK_THRESHOLD, 255, cv2.THRESH_BINARY_INV)
+    return binary_mask
+
+def equalization_lut(channel):
+    """
+    Builds the lookup table cv2.equalizeHist would apply to this channel.
+    Lets a histogram taken on a downscaled plane equalize full-resolution crops consistently with each other. The
+    result only approximates equalizing the full-resolution frame - downscaling changes the histogram.
+    """
+    hist = cv2.calcHist([channel], [0], None, [256], [0, 256]).ravel()
+    cdf = hist.cumsum()
+    first = np.flatnonzero(hist)[0]
+    if hist[first] == cdf[-1]: # single intensity - nothing to spread
+        return np.full(256, first, dtype=np.uint8)
+    lut = np.rint((cdf - hist[first]) * 255.0 / (cdf[-1] - hist[first]))
+    lut[:first] = 0
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+def shift_along_x(image, dx):
+    # translates an image along x, repeating the edge pixels into the uncovered area
+    height, width = image.shape[:2]
+    translation = np.float32([[1, 0, dx], [0, 1, 0]])
+    return cv2.warpAffine(image, translation, (width, height), borderMode=cv2.BORDER_REPLICATE)
+
+# ----------- DETECTION RECORDS -------------
+# A decoded QR code. Still a (data, center, top_left) tuple, so indexing and unpacking work as before.
+QRDetection = namedtuple('QRDetection', ['data', 'center', 'top_left'])
+
+LEFT_CONVEYOR = "left"
+RIGHT_CONVEYOR = "right"
+
+# Holder attributes under the keys of the dicts find_holders used to return
+HOLDER_KEYS = {'contour': 'contour', 'is_empty': 'is_empty', 'holder_center': 'center', 'id': 'id'}
+
+class Holder:
+    """
+    A detected holder, with its bounding rect, center and area worked out once.
+    - id: data of the holder's QR code, or None if it is empty.
+    Can also be read like the old holder info dicts: holder['contour'], holder['holder_center'], holder['id'], holder['is_empty'].
+    """
+    __slots__ = ('contour', 'rect', 'center', 'area', 'id')
+
+    def __init__(self, contour, id=None, rect=None, area=None):
+        self.contour = contour
+        self.rect = rect if rect is not None else cv2.boundingRect(contour)
+        x, y, w, h = self.rect
+        self.center = (x + w // 2, y + h // 2)
+        self.area = area if area is not None else cv2.contourArea(contour)
+        self.id = id
+
+    @property
+    def is_empty(self):
+        return self.id is None
+
+    def __getitem__(self, key):
+        return getattr(self, HOLDER_KEYS[key])
+
+    def keys(self):
+        return HOLDER_KEYS.keys()
+
+    def translated(self, dx):
+        """
+        Returns: a copy of the holder moved dx pixels along x.
+        """
+        dx = round(dx)
+        x, y, w, h = self.rect
+        contour = self.contour + np.array([dx, 0], dtype=self.contour.dtype)
+        return Holder(contour, self.id, rect=(x + dx, y, w, h), area=self.area)
+
+    def __repr__(self):
+        return f"Holder(center={self.center}, id={self.id!r})"
+
+# ----------- FRAME ANALYSIS -------------
+class FrameAnalysis:
+    """
+    Runs the detectors on a single captured frame.
+    - The HSV, equalized-V, gray and equalized-gray planes are computed lazily, at most once per frame.
+    - Every detector reuses those planes instead of converting the full-resolution image again.
+    - With downscale > 1, masks and contours are found on a downscaled frame (area thresholds scaled to match)
+      and only the winning contours are refined at full resolution, so returned coordinates keep full precision.
+    Build one per captured image and call the detectors on it.
+    """
+
+    def __init__(self, image, downscale=None):
+        self.image = image
+        self.downscale = DETECTION_DOWNSCALE if downscale is None else downscale
+        self.qrcode_frame = self # frame the last find_qrcodes result was decoded from
+        self.qrcodes = None # the last find_qrcodes result
+
+    @cached_property
+    def hsv(self):
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
+
+    @cached_property
+    def hsv_channels(self):
+        return cv2.split(self.hsv)
+
+    @cached_property
+    def v_equalized(self):
+        return cv2.equalizeHist(self.hsv_channels[2])
+
+    @cached_property
+    def hsv_equalized(self):
+        # HSV image with the V channel equalized - used for holder (red) detection
+        h, s, _ = self.hsv_channels
+        return cv2.merge((h, s, self.v_equalized))
+
+    @cached_property
+    def gray(self):
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def gray_equalized(self):
+        return cv2.equalizeHist(self.gray)
+
+    # ---- downscaled planes used by the pyramid path ----
+    @cached_property
+    def small_image(self):
+        height, width = self.image.shape[:2]
+        size = (width // self.downscale, height // self.downscale)
+        return cv2.resize(self.image, size, interpolation=cv2.INTER_AREA)
+
+    @cached_property
+    def small_hsv(self):
+        return cv2.cvtColor(self.small_image, cv2.COLOR_BGR2HSV)
+
+    @cached_property
+    def small_v_lut(self):
+        return equalization_lut(cv2.extractChannel(self.small_hsv, 2))
+
+    @cached_property
+    def small_hsv_equalized(self):
+        return self._equalize_v(self.small_hsv)
+
+    @cached_property
+    def small_gray(self):
+        return cv2.cvtColor(self.small_image, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def small_gray_lut(self):
+        return equalization_lut(self.small_gray)
+
+    def _equalize_v(self, hsv):
+        # equalizes V with the histogram of the downscaled frame, so every crop gets the same mapping
+        # (close to, but not exactly, equalizing the full-resolution frame)
+        h, s, v = cv2.split(hsv)
+        return cv2.merge((h, s, cv2.LUT(v, self.small_v_lut)))
+
+    def crop_hsv_equalized(self, crop):
+        """
+        Returns: HSV of a BGR crop of this frame, with V equalized by the downscaled frame's histogram, as holder_mask expects.
+        """
+        return self._equalize_v(cv2.cvtColor(crop, cv2.COLOR_BGR2HSV))
+
+    def _pyramid_contours(self, small_mask, full_res_mask, min_area=0, keep=None):
+        """
+        Finds contours on a downscaled mask, then refines each winner at full resolution.
+        - small_mask: binary mask of the downscaled frame.
+        - full_res_mask: function taking a BGR crop of the full frame and returning its binary mask.
+        - min_area: full-resolution area threshold, applied to the small mask (scaled down) and again to the refined
+          contours, which can come out smaller than their coarse outline.
+        - keep: if set, only the largest `keep` contours are refined.
+        Returns: list of full-resolution contours.
+        """
+        scale = self.downscale
+        contours, _ = cv2.findContours(small_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours = [cnt for cnt in contours if cv2.contourArea(cnt) > min_area / scale ** 2]
+        if keep is not None:
+            contours = sorted(contours, key=cv2.contourArea, reverse=True)[:keep]
+
+        height, width = self.image.shape[:2]
+        refined = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            x0 = max(x * scale - PYRAMID_REFINE_MARGIN, 0)
+            y0 = max(y * scale - PYRAMID_REFINE_MARGIN, 0)
+            x1 = min((x + w) * scale + PYRAMID_REFINE_MARGIN, width)
+            y1 = min((y + h) * scale + PYRAMID_REFINE_MARGIN, height)
+            crop_contours, _ = cv2.findContours(full_res_mask(self.image[y0:y1, x0:x1]), cv2.RETR_EXTERNAL,
+                                                cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+            if crop_contours:
+                contour = max(crop_contours, key=cv2.contourArea)
+            else: # blob vanished at full resolution - fall back to the scaled-up coarse contour
+                contour = contour * scale
+            if cv2.contourArea(contour) > min_area:
+                refined.append(contour)
+        return refined
+
+    def holder_contours(self):
+        """
+        Returns: contours of red areas larger than MIN_HOLDER_AREA (potential holders).
+        """
+        if self.downscale > 1:
+            red_mask = holder_mask(self.small_hsv_equalized)
+            save_debug_image('red_mask_equalized.jpg', red_mask, copy=False)
+            return self._pyramid_contours(
+                red_mask,
+                lambda crop: holder_mask(self.crop_hsv_equalized(crop)),
+                min_area=MIN_HOLDER_AREA)
+
+        # bgr_eq = cv2.cvtColor(self.hsv_equalized, cv2.COLOR_HSV2BGR)
+        # cv2.imwrite('equalized_hsv_image.jpg', bgr_eq)  # Save the equalized BGR image for debugging
+        red_mask = holder_mask(self.hsv_equalized)
+        save_debug_image('red_mask_equalized.jpg', red_mask, copy=False)
+
+        # Find contours of red areas (potential holders)
+        contours, _ = cv2.findContours(red_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return [cnt for cnt in contours if cv2.contourArea(cnt) > MIN_HOLDER_AREA]
+
+    def leg_contours(self):
+        """
+        Returns: the two largest green contours (the legs), without drawing them.
+        """
+        if self.downscale > 1:
+            return self._pyramid_contours(
+                leg_mask(self.small_hsv),
+                lambda crop: leg_mask(cv2.cvtColor(crop, cv2.COLOR_BGR2HSV)),
+                keep=2)
+
+        contours, _ = cv2.findContours(leg_mask(self.hsv), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # filter to the two largest contours
+        return sorted(contours, key=cv2.contourArea, reverse=True)[:2]
+
+    def conveyor_contours(self):
+        """
+        Returns: contours of dark areas larger than MIN_CONVEYOR_AREA (the conveyors).
+        """
+        if self.downscale > 1:
+            return self._pyramid_contours(
+                conveyor_mask(cv2.LUT(self.small_gray, self.small_gray_lut)),
+                lambda crop: conveyor_mask(cv2.LUT(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY), self.small_gray_lut)),
+                min_area=MIN_CONVEYOR_AREA)
+
+        # cv2.imwrite('equalized_conveyor_image.jpg', self.gray_equalized)  # Save the equalized image for debugging
+        contours = cv2.findContours(conveyor_mask(self.gray_equalized), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        return [cnt for cnt in contours if cv2.contourArea(cnt) > MIN_CONVEYOR_AREA]
+
+    def find_leg_contours(self):
+        """
+        Detects contours of legs in the frame. See `find_leg_contours`.
+        Returns: list of contours.
+        """
+        contours = self.leg_contours()
+        if not contours:
+            raise ValueError("No leg contours found.")
+
+        # draw leg contours in blue
+        cv2.drawContours(self.image, contours, -1, (255, 0, 0), 3)
+
+        for contour in contours:
+            cv2.drawContours(self.image, [contour], -1, (0, 255, 0), 3)
+
+        save_debug_image('image_with_leg_contours.jpg', self.image)
+
+        return contours
+
+    def get_conveyor_threshold(self):
+        """
+        Returns the threshold that splits the conveyors. See `get_conveyor_threshold`.
+        Returns: threshold, left, right, top, bottom.
+        """
+        conveyor_left, conveyor_right, conveyor_top, conveyor_bottom = self.find_borders_of_conveyors()
+        distance = conveyor_right - conveyor_left
+        middle_threshold = conveyor_right - distance // 2
+        # draw a horizontal line on the image at threshold
+        # cv2.line(self.image, (0, middle_threshold), (self.image.shape[1], middle_threshold), (255, 0, 0), 2)  # Blue line
+        # cv2.imwrite('image_with_conveyor_threshold.jpg', self.image)  # Save the image with the threshold line for debugging
+        return middle_threshold, conveyor_left, conveyor_right, conveyor_top, conveyor_bottom
+
+    def find_borders_of_conveyors(self):
+        """
+        Finds the edges of the conveyors from the dark regions of the equalized gray frame.
+        See `find_borders_of_conveyors`.
+        Returns: (left, right, top, bottom).
+        Raises ValueError if no conveyor is found.
+        """
+        contours = self.conveyor_contours()
+        # cv2.drawContours(image, contours, -1, (255, 0, 0), 3)
+        if not contours:
+            raise ValueError("No conveyor contours found.")
+        rects = np.array([cv2.boundingRect(cnt) for cnt in contours])
+        conveyor_bottom = int(rects[:, 0].min())
+        conveyor_top = int((rects[:, 0] + rects[:, 2]).max())
+        conveyor_left = int(rects[:, 1].min())
+        conveyor_right = int((rects[:, 1] + rects[:, 3]).max())
+
+        # cv2.imwrite('image_with_conveyor_contours.jpg', image)  # Save the image with the contours for debugging
+
+        return conveyor_left, conveyor_right, conveyor_top, conveyor_bottom
+
+    def find_holders(self, max_dist_between_holder_center_and_barcode=QR_MATCH_DISTANCE):
+        """
+        Detects holders in the frame and pairs them with nearby QR codes. See `find_holders`.
+        Returns: list of Holder.
+        """
+        holders = [Holder(contour) for contour in self.holder_contours()]
+        print(f"Number of holder contours found: {len(holders)}")
+
+        # Detect qrcodes - in ROI mode only the areas a holder's code can be matched from are decoded
+        if QR_DECODE_MODE == "roi":
+            qrcodes = self.find_qrcodes(regions=[qr_search_region(holder.center, max_dist_between_holder_center_and_barcode)
+                                                 for holder in holders])
+        else:
+            qrcodes = self.find_qrcodes()
+        if self.qrcode_frame is not self: # decoded from a new capture - pair them with the holders in that frame
+            holders = [Holder(contour) for contour in self.qrcode_frame.holder_contours()]
+            print(f"Number of holder contours found in the new capture: {len(holders)}")
+
+        for holder in holders:
+            print(f"Holder center: {holder.center}")
+
+        # Pair each holder with the nearest qrcode in range, each qrcode going to one holder at most
+        # qrcode[2] is the top left corner of the qrcode
+        matches = match_holders_to_qrcodes([holder.center for holder in holders], [qrcode[2] for qrcode in qrcodes], max_dist_between_holder_center_and_barcode)
+        for holder, match in zip(holders, matches):
+            if match is not None:
+                holder.id = qrcodes[match][0]
+
+        return holders
+
+    def find_qrcodes(self, regions=None, fallback_to_full_frame=QR_ROI_FALLBACK_TO_FULL_FRAME):
+        """
+        Detects QR codes in the frame. If fewer than NUM_QRCODES are found, the other QR_PREPROCESSING variants are
+        tried, then new captures, up to QR_MAX_CAPTURES frames and QR_RETRY_TIME_BUDGET seconds. See `find_qrcodes`.
+        Results are cached per image buffer, so holder classification, conveyor splitting and the
+        top/bottom QR helpers share one decode of the same frame. A frame's best result is cached even when it is
+        short of NUM_QRCODES (marked partial), so asking again doesn't repeat the retries. Codes decoded from a new
+        capture are cached against that capture, and `qrcode_frame` is set to the FrameAnalysis the returned codes
+        were decoded from - this frame, or a new capture. The returned codes are also kept in `qrcodes`.
+
+        Parameters:
+            regions (list of (x, y, w, h) or None): If given, only padded crops around these rects are decoded.
+            fallback_to_full_frame (bool): Decode the whole frame when the regions yield fewer than NUM_QRCODES codes.
+
+        Returns: list of (data, center, top_left) tuples.
+        """
+        self.qrcode_frame = self
+        regions = tuple(tuple(int(value) for value in region) for region in regions) if regions else None
+        cached_qrcodes = get_cached_qrcodes(self.image, regions)
+        if cached_qrcodes is not None:
+            self.qrcodes = cached_qrcodes
+            return cached_qrcodes
+
+        if regions:
+            qrcode_info = self.find_qrcodes_in_regions(regions)
+            if len(qrcode_info) >= NUM_QRCODES:
+                cache_qrcodes(self.image, qrcode_info, regions)
+                self.qrcodes = qrcode_info
+                return qrcode_info
+            if not fallback_to_full_frame:
+                self.qrcodes = qrcode_info
+                return qrcode_info
+            print(f"Found {len(qrcode_info)} QR codes around holders, expected {NUM_QRCODES}, decoding full frame...")
+
+        deadline = time.monotonic() + QR_RETRY_TIME_BUDGET
+        best_qrcode_info = qrcode_info if regions else [] # the codes are kept with the frame they were decoded from
+        best_frame = self
+        frame = self
+
+        for capture in range(QR_MAX_CAPTURES):
+            equalized = frame.gray_equalized
+            save_debug_image('equalized_qr_image.jpg', equalized, copy=False)  # Save the equalized image for debugging
+            frame_qrcode_info = best_qrcode_info if frame is self else []
+
+            # Try the preprocessing variants on this frame before spending another capture, the last one to work first
+            for variant in list(_qr_variant_order):
+                preprocessed = QR_PREPROCESSING[variant](frame.gray, equalized)
+                save_debug_image(f'{variant}_qr_image.jpg', preprocessed, copy=False)  # Save the preprocessed image for debugging
+                qrcode_info = decode_qrcodes(preprocessed)
+                if len(qrcode_info) > len(frame_qrcode_info):
+                    frame_qrcode_info = qrcode_info
+                if len(qrcode_info) >= NUM_QRCODES:
+                    print(f"Correct number of QR codes found ({variant}).")
+                    prefer_qr_variant(variant)
+                    break
+                if time.monotonic() > deadline:
+                    break
+
+            if frame is self or len(frame_qrcode_info) > len(best_qrcode_info):
+                best_qrcode_info, best_frame = frame_qrcode_info, frame
+            complete = len(frame_qrcode_info) >= NUM_QRCODES
+            if frame is self or complete:
+                # a frame's own best is cached even when short, so asking again doesn't repeat the captures
+                cache_qrcodes(frame.image, frame_qrcode_info, partial=not complete)
+            if complete or capture == QR_MAX_CAPTURES - 1 or time.monotonic() > deadline:
+                break
+            print(f"Found {len(best_qrcode_info)} QR codes, expected {NUM_QRCODES}, retrying...")
+            frame = FrameAnalysis(capture_image('retrying_image_to_detect_all_qrcodes.jpg'))
+
+        if len(best_qrcode_info) < NUM_QRCODES:
+            print(f"Error: found {len(best_qrcode_info)} QR codes, expected {NUM_QRCODES}. Giving up after {capture + 1} captures.")
+        self.qrcode_frame = best_frame
+        self.qrcodes = best_qrcode_info
+        return best_qrcode_info
+
+    def find_qrcodes_in_regions(self, regions, padding=QR_ROI_PADDING):
+        """
+        Decodes QR codes only inside padded crops around the given (x, y, w, h) rects.
+        Codes found in overlapping crops are only reported once.
+        Returns: list of (data, center, top_left) tuples in full-frame coordinates.
+        """
+        frame_height, frame_width = self.gray_equalized.shape[:2]
+        qrcode_info = []
+        seen = set()
+
+        for x, y, w, h in regions:
+            x0, y0 = max(x - padding, 0), max(y - padding, 0)
+            x1, y1 = min(x + w + padding, frame_width), min(y + h + padding, frame_height)
+            crop = QR_PREPROCESSING[_qr_variant_order[0]](self.gray[y0:y1, x0:x1], self.gray_equalized[y0:y1, x0:x1])
+
+            for data, center, top_left in decode_qrcodes(crop, offset=(x0, y0)):
+                key = (data, round(center[0]), round(center[1]))
+                if key not in seen:
+                    seen.add(key)
+                    qrcode_info.append(QRDetection(data, center, top_left))
+
+        return qrcode_info
 
 # ----------- LEG DETECTION -------------
 def find_leg_contours(image):
@@ -35,25 +545,7 @@ def find_leg_contours(image):
     - Draws and saves the mask and contour outline.
     Returns: list of contours.
     """
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    mask = cv2.inRange(hsv, LEG_COLOR_LOWER_THRESHOLD_HSV, LEG_COLOR_UPPER_THRESHOLD_HSV)
-
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not contours:
-        raise ValueError("No leg contours found.")  
-        
-    # filter to the two largest contours
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)[:2]
-    
-    # draw leg contours in blue
-    cv2.drawContours(image, contours, -1, (255, 0, 0), 3)
-    
-    for contour in contours:
-        cv2.drawContours(image, [contour], -1, (0, 255, 0), 3)
-    
-    cv2.imwrite('image_with_leg_contours.jpg', image)
-    
-    return contours
+    return FrameAnalysis(image).find_leg_contours()
 
 def find_leg_top_conveyor(leg_contours):
     """
@@ -86,20 +578,7 @@ def get_conveyor_threshold(image):
     Uses vertical bounds from `find_left_and_right_of_conveyors`.
     Returns: threshold, left, right bounds.
     """
-    conveyor_left, conveyor_right, conveyor_top, conveyor_bottom = find_borders_of_conveyors(image)
-    distance = conveyor_right - conveyor_left
-    middle_threshold = conveyor_right - distance // 2
-    # draw a horizontal line on the image at threshold 
-    # cv2.line(image, (0, middle_threshold), (image.shape[1], middle_threshold), (255, 0, 0), 2)  # Blue line
-    # draw a horizontal like at conveyor left and right
-    # cv2.line(image, (0, conveyor_left), (image.shape[1], conveyor_left), (0, 255, 0), 2)  # Green line
-    # cv2.line(image, (0, conveyor_right), (image.shape[1], conveyor_right), (0, 255, 0), 2)  # Green line
-    
-    # # draw a vertical line at conveyor top and bottom
-    # cv2.line(image, (conveyor_top, 0), (conveyor_top, image.shape[0]), (0, 255, 0), 2)  # Green line
-    # cv2.line(image, (conveyor_bottom, 0), (conveyor_bottom, image.shape[0]), (0, 255, 0), 2)  # Green line
-    # cv2.imwrite('image_with_conveyor_threshold.jpg', image)  # Save the image with the threshold line for debugging
-    return middle_threshold, conveyor_left, conveyor_right, conveyor_top, conveyor_bottom
+    return FrameAnalysis(image).get_conveyor_threshold()
 
 # def find_top_and_bottom_of_conveyors(image):
 #     """
@@ -129,51 +608,11 @@ def get_conveyor_threshold(image):
 
 def find_borders_of_conveyors(image):
     """
-    Finds left and right edges of conveyors by scanning rows for darkness.
-    Returns: (left, right) row indices.
+    Finds the edges of conveyors from the dark regions of the frame.
+    Returns: (left, right, top, bottom) - left/right are row indices, top/bottom column indices.
+    Raises ValueError if no conveyor is found.
     """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # equalize the image
-    equalized = cv2.equalizeHist(gray)
-    # cv2.imwrite('equalized_conveyor_image.jpg', equalized)  # Save the equalized image for debugging
-    _, binary_mask = cv2.threshold(equalized, 60, 255, cv2.THRESH_BINARY_INV) # changed intesnity from 50
-    
-    # binary_mask = np.where(gray < 50, 1, 0) # Create a binary mask where intensity < 50 is set to 1, and others are set to 0
-    # threshold = 500 # minimum number of dark pixels for a column to be part of a conveyor
- 
-     # Bottom (leftmost dark column)
-    # conveyor_bottom = next((i for i, col in enumerate(binary_mask.T) if np.sum(col) >= threshold), 0)
- 
-    #  # Top (rightmost dark column)
-    # conveyor_top = next((i for i in range(binary_mask.shape[1] - 1, -1, -1)
-    #                       if np.sum(binary_mask[:, i]) >= threshold), 0)
-    
-    # # have to get left and right differently because shadows from lighting extend the boundaries of the contour otherwise
-    # threshold = 100000 # minimum number of dark pixels for a row to be considered part of the conveyor - times 255 because black pixels were set to white (255) in the binary mask
-    # conveyor_left = next(
-    #     (i for i, row in enumerate(binary_mask) if np.count_nonzero(row == 255) >= threshold), 0
-    # )
-
-    # conveyor_right = next(
-    #     (i for i in range(binary_mask.shape[0] - 1, -1, -1)
-    #     if np.count_nonzero(binary_mask[i] == 255) >= threshold), 0
-    # )
-    # get the contours of the mask
-    contours = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-    min_area = 200000 # minimum number of dark pixels for a contour to be considered part of the conveyor
-    contours = [cnt for cnt in contours if cv2.contourArea(cnt) > min_area]
-    # cv2.drawContours(image, contours, -1, (255, 0, 0), 3)
-    if not contours:
-        print("No conveyor contours found")
-        return 0, 0
-    conveyor_bottom = min([cv2.boundingRect(cnt)[0] for cnt in contours])
-    conveyor_top = max([cv2.boundingRect(cnt)[0] + cv2.boundingRect(cnt)[2] for cnt in contours])
-    conveyor_left = min([cv2.boundingRect(cnt)[1] for cnt in contours])
-    conveyor_right = max([cv2.boundingRect(cnt)[1] + cv2.boundingRect(cnt)[3] for cnt in contours])
-    
-    # cv2.imwrite('image_with_conveyor_contours.jpg', image)  # Save the image with the contours for debugging
-
-    return conveyor_left, conveyor_right, conveyor_top, conveyor_bottom
+    return FrameAnalysis(image).find_borders_of_conveyors()
 
 # ----------- HOLDER DETECTION -------------
 def get_bottom_left_corner(corners):
@@ -203,104 +642,79 @@ def top_holder_left_conveyor(holders_divided_into_conveyors):
     Returns the holder on the left conveyor with the largest x (i.e., furthest right in the image, closest to top of conveyors in real life).
     """
     left_conveyor_holders, _ = holders_divided_into_conveyors
-    if not left_conveyor_holders:
-        return None
-
-    top_holder = max(left_conveyor_holders, key=lambda h: h['holder_center'][0])
-    return top_holder
+    return max(left_conveyor_holders, key=lambda h: h['holder_center'][0], default=None)
 
 def top_holder_right_conveyor(holders_divided_into_conveyors):
     """
     Returns the holder on the right conveyor with the largest x (i.e., furthest right in the image, closest to top of conveyors in real life).
     """
     _, right_conveyor_holders = holders_divided_into_conveyors
-    if not right_conveyor_holders:
-        return None
-
-    top_holder = max(right_conveyor_holders, key=lambda h: h['holder_center'][0])
-    return top_holder
+    return max(right_conveyor_holders, key=lambda h: h['holder_center'][0], default=None)
 
 def bottom_holder_right_conveyor(holders_divided_into_conveyors):
     """
-    Returns the holder on the right conveyor with the largest x (i.e., furthest right in the image, closest to top of conveyors in real life).
+    Returns the holder on the right conveyor with the smallest x (i.e., furthest left in the image, closest to bottom of conveyors in real life).
     """
     _, right_conveyor_holders = holders_divided_into_conveyors
-    if not right_conveyor_holders:
-        return None
-
-    top_holder = min(right_conveyor_holders, key=lambda h: h['holder_center'][0])
-    return top_holder
+    return min(right_conveyor_holders, key=lambda h: h['holder_center'][0], default=None)
 
 def bottom_holder_left_conveyor(holders_divided_into_conveyors):
     """
-    Returns the holder on the left conveyor with the largest x (i.e., furthest right in the image, closest to top of conveyors in real life).
+    Returns the holder on the left conveyor with the smallest x (i.e., furthest left in the image, closest to bottom of conveyors in real life).
     """
     left_conveyor_holders, _ = holders_divided_into_conveyors
-    if not left_conveyor_holders:
-        return None
-
-    top_holder = min(left_conveyor_holders, key=lambda h: h['holder_center'][0])
-    return top_holder
+    return min(left_conveyor_holders, key=lambda h: h['holder_center'][0], default=None)
 
 def top_holder_with_qrcode(holders):
     """
-    Loops through holders and returns the top-most non-empty holder.
-    Removes empty holders from the list.
+    Returns the top-most (largest x) non-empty holder, or None if every holder is empty.
     """
-    top_holder_with_qrcode = None
-
-    while top_holder_with_qrcode is None:
-        if not holders:
-            print("Error: No holders found.")
-            break
-
-        top_candidate = max(holders, key=lambda h: h['holder_center'][0])
-        if top_candidate['is_empty']:
-            holders.remove(top_candidate)
-        else:
-            top_holder_with_qrcode = top_candidate
-
+    top_holder_with_qrcode = max((h for h in holders if not h['is_empty']), key=lambda h: h['holder_center'][0], default=None)
     if top_holder_with_qrcode:
         print("Top holder with qrcode: ", top_holder_with_qrcode['holder_center'])
+    else:
+        print("Error: No holders found.")
     return top_holder_with_qrcode
 
 def bottom_holder_with_qrcode(holders):
     """
-    Loops through holders and returns the top-most non-empty holder.
-    Removes empty holders from the list.
+    Returns the bottom-most (smallest x) non-empty holder, or None if every holder is empty.
     """
-    bottom_holder_with_qrcode = None
-
-    while bottom_holder_with_qrcode is None:
-        top_candidate = min(holders, key=lambda h: h['holder_center'][0])
-        if top_candidate['is_empty']:
-            holders.remove(top_candidate)
-        else:
-            bottom_holder_with_qrcode = top_candidate
-
+    bottom_holder_with_qrcode = min((h for h in holders if not h['is_empty']), key=lambda h: h['holder_center'][0], default=None)
     if bottom_holder_with_qrcode:
         print("Bottom holder with qrcode: ", bottom_holder_with_qrcode['holder_center'])
+    else:
+        print("Error: No holders found.")
     return bottom_holder_with_qrcode
 
 def extract_holder_corners(image, contour, num_corners=8, quality_level=0.02, min_distance=20):
+    """
+    Finds corners on the outline of a holder's approximated polygon.
+    The outline is drawn on a single channel canvas the size of the contour's bounding rect (plus CORNER_CANVAS_PADDING)
+    instead of a blank copy of the whole frame, which gives the same corners for a fraction of the memory and time.
+    Returns: array of (x, y) corners in frame coordinates, or [] if none were found.
+    """
     approx = cv2.approxPolyDP(contour, 0.005* cv2.arcLength(contour, True), True) # change from 0.01
-    blank_image = np.zeros_like(image)
-    cv2.drawContours(blank_image, [approx], -1, (255, 255, 255), 1)
-    gray = cv2.cvtColor(blank_image, cv2.COLOR_BGR2GRAY)
-    cv2.imwrite(f'contour_image_{num_corners}.jpg', gray)  # Save the contour image for debugging
-    corners = cv2.goodFeaturesToTrack(gray, maxCorners=num_corners, qualityLevel=quality_level, minDistance=min_distance)
+    x, y, w, h = cv2.boundingRect(approx)
+    x0, y0 = x - CORNER_CANVAS_PADDING, y - CORNER_CANVAS_PADDING
+    canvas = np.zeros((h + 2 * CORNER_CANVAS_PADDING, w + 2 * CORNER_CANVAS_PADDING), dtype=np.uint8)
+    cv2.drawContours(canvas, [approx], -1, 255, 1, offset=(-x0, -y0))
+    save_debug_image(f'contour_image_{num_corners}.jpg', canvas, copy=False)  # Save the contour image for debugging
+    corners = cv2.goodFeaturesToTrack(canvas, maxCorners=num_corners, qualityLevel=quality_level, minDistance=min_distance)
 
-    return np.intp(corners).reshape(-1, 2) if corners is not None else [] # reshape the corners into array of points (cv2 returns it with weird structure to suit 3D stuff)
+    if corners is None:
+        return []
+    return np.intp(corners).reshape(-1, 2) + np.array([x0, y0]) # reshape the corners into array of points (cv2 returns it with weird structure to suit 3D stuff)
 
 def divide_holders_into_conveyors(conveyor_threshold, holders_from_find_holders):
     """
     Divides detected holders into left or right conveyors based on y-coordinate.
-    Returns: (left_holders, right_holders)
+    Returns: (left_holders, right_holders), each sorted by x (bottom of the conveyor first).
     """
     left_conveyor_holders = []
     right_conveyor_holders = []
 
-    for holder in holders_from_find_holders:
+    for holder in sorted(holders_from_find_holders, key=lambda h: h['holder_center'][0]):
         _, y = holder['holder_center']
         if y < conveyor_threshold:
             left_conveyor_holders.append(holder)
@@ -309,8 +723,79 @@ def divide_holders_into_conveyors(conveyor_threshold, holders_from_find_holders)
 
     return left_conveyor_holders, right_conveyor_holders
 
+class HolderIndex:
+    """
+    One frame's holders, divided into conveyors and sorted by x (bottom of the conveyor first), so the top and bottom
+    holders - with or without a QR code - are looked up rather than searched for.
+    Conveyors are LEFT_CONVEYOR (y < conveyor_threshold) and RIGHT_CONVEYOR.
+    """
+
+    def __init__(self, holders, conveyor_threshold):
+        left, right = divide_holders_into_conveyors(conveyor_threshold, holders)
+        self.holders = {LEFT_CONVEYOR: left, RIGHT_CONVEYOR: right}
+        self.with_qrcode = {conveyor: [h for h in hs if not h['is_empty']] for conveyor, hs in self.holders.items()}
+        self.xs = {conveyor: [h['holder_center'][0] for h in hs] for conveyor, hs in self.holders.items()}
+
+    def _candidates(self, conveyor, with_qrcode):
+        return self.with_qrcode[conveyor] if with_qrcode else self.holders[conveyor]
+
+    def top(self, conveyor, with_qrcode=False):
+        holders = self._candidates(conveyor, with_qrcode)
+        return holders[-1] if holders else None
+
+    def bottom(self, conveyor, with_qrcode=False):
+        holders = self._candidates(conveyor, with_qrcode)
+        return holders[0] if holders else None
+
+    def nearest(self, conveyor, x):
+        """
+        Returns: the holder on `conveyor` whose center is nearest x, or None if it has none.
+        """
+        xs = self.xs[conveyor]
+        i = bisect_left(xs, x)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(xs)]
+        if not candidates:
+            return None
+        return self.holders[conveyor][min(candidates, key=lambda j: abs(xs[j] - x))]
+
+    def divided(self):
+        # (left_holders, right_holders), as divide_holders_into_conveyors returns
+        return self.holders[LEFT_CONVEYOR], self.holders[RIGHT_CONVEYOR]
+
+def match_holders_to_qrcodes(holder_centers, qrcode_positions, max_distance):
+    """
+    Pairs holders with qrcodes, nearest pairs first, so two holders can't claim the same qrcode.
+    Distances between every holder and qrcode are computed at once as a matrix.
+    Returns: for each holder, the index of its qrcode in `qrcode_positions`, or None if none is within max_distance.
+    """
+    matches = [None] * len(holder_centers)
+    if not holder_centers or not qrcode_positions:
+        return matches
+
+    holders = np.asarray(holder_centers, dtype=np.float64).reshape(-1, 1, 2)
+    qrcodes = np.asarray(qrcode_positions, dtype=np.float64).reshape(1, -1, 2)
+    distances = np.sqrt(((holders - qrcodes) ** 2).sum(axis=2)) # holders x qrcodes
+
+    claimed = np.zeros(distances.shape[1], dtype=bool)
+    for flat_index in np.argsort(distances, axis=None, kind="stable"):
+        holder, qrcode = divmod(int(flat_index), distances.shape[1])
+        if distances[holder, qrcode] >= max_distance:
+            break # the rest are further still
+        if matches[holder] is None and not claimed[qrcode]:
+            matches[holder] = qrcode
+            claimed[qrcode] = True
+    return matches
+
+def qr_search_region(holder_center, max_distance=QR_MATCH_DISTANCE):
+    """
+    Returns: (x, y, w, h) of the square around a holder's center that a QR code's top-left corner must be in to be
+    matched to it (see `match_holders_to_qrcodes`). find_qrcodes_in_regions adds QR_ROI_PADDING for the code's body.
+    """
+    x, y = holder_center
+    return x - max_distance, y - max_distance, 2 * max_distance, 2 * max_distance
+
 # Finds all holders, returns the contours and empty status
-def find_holders(image, max_dist_between_holder_center_and_barcode=450):
+def find_holders(image, max_dist_between_holder_center_and_barcode=QR_MATCH_DISTANCE):
     """
     Detects holder regions (red-colored contours) in the input image and determines whether 
     each holder is empty or occupied based on proximity to a detected QR code.
@@ -322,76 +807,14 @@ def find_holders(image, max_dist_between_holder_center_and_barcode=450):
      for the holder to be considered "occupied".
 
     Returns:
-        holders_info (list of dict): A list where each dictionary contains information about a detected holder:
+        holders_info (list of Holder): A list of the detected holders, each readable as a dict with:
             - 'contour' (numpy.ndarray): The contour of the holder region.
             - 'is_empty' (bool): True if no qrcode
      was found near the holder, otherwise False.
             - 'holder_center' (tuple of int): The (x, y) coordinates of the center of the holder's bounding box.
             - 'id' (str or None): The decoded string from the nearby QR code if present; otherwise None.
     """
-    # Convert image to HSV for better color filtering
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        
-    # Split channels
-    h, s, v = cv2.split(hsv)
-
-    # Equalize the V channel
-    v_eq = cv2.equalizeHist(v)
-
-    # Merge back and convert to HSV image
-    hsv_eq = cv2.merge((h, s, v_eq))
-    
-    # bgr_eq = cv2.cvtColor(hsv_eq, cv2.COLOR_HSV2BGR)
-    # cv2.imwrite('equalized_hsv_image.jpg', bgr_eq)  # Save the equalized BGR image for debugging
-    # Now apply your red masks
-    mask1 = cv2.inRange(hsv_eq, HOLDER_COLOR_LOWER_THRESHOLD_HSV, HOLDER_COLOR_UPPER_THRESHOLD_HSV)
-    mask2 = cv2.inRange(hsv_eq, HOLDER_COLOR_LOWER_THRESHOLD_HSV_2, HOLDER_COLOR_UPPER_THRESHOLD_HSV_2)
-    red_mask = cv2.bitwise_or(mask1, mask2)
-
-    cv2.imwrite('red_mask_equalized.jpg', red_mask)
-
-    # Find contours of red areas (potential holders)
-    contours, _ = cv2.findContours(red_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    holder_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > MIN_HOLDER_AREA]
-    print(f"Number of holder contours found: {len(holder_contours)}")
-
-    # Detect qrcodes
-    qrcodes = find_qrcodes(image)
-
-    holders_info = []
-
-    # Analyze each potential holder
-    for holder_contour in holder_contours:
-        x, y, w, h = cv2.boundingRect(holder_contour)
-        holder_center = (x + w // 2, y + h // 2)
-        print(f"Holder center: {holder_center}")
-
-        # near_barcode = (holder_center[0], holder_center[1] + 450)
-        near_barcode = (holder_center[0], holder_center[1])
-        # draw a circle of radius max_dist_between_holder_center_and_barcode
-        # cv2.circle(image, near_barcode, max_dist_between_holder_center_and_barcode, (0, 255, 0), 2)  # Green circle
-        # cv2.imwrite('image_with_holder_circles.jpg', image)  # Save the image with the circles for debugging
-        
-        # Determine if a qrcode is nearby
-        barcode_close = False
-        closest_barcode = None
-
-        for qrcode in qrcodes:
-            distance = np.linalg.norm(np.array(near_barcode) - np.array(qrcode[2]))  # qrcode[2] is the top left corner of the qrcode
-            if distance < max_dist_between_holder_center_and_barcode:
-                barcode_close = True
-                closest_barcode = qrcode
-                break
-
-        # Save holder info
-        holders_info.append({
-            'contour': holder_contour,
-            'is_empty': not barcode_close,
-            'holder_center': holder_center,
-            'id': closest_barcode[0] if barcode_close else None
-        })
-
-    return holders_info
+    return FrameAnalysis(image).find_holders(max_dist_between_holder_center_and_barcode)
 
 # -------- QR CODE DETECTION ----------------
 def get_bottom_qr_right_conveyor(image, conveyor_threshold):
@@ -438,10 +861,69 @@ def qrs_divided_into_conveyors(image, conveyor_threshold):
     right = [b for b in qrcodes if b[1][1] >= conveyor_threshold]
     return left, right 
  
+def threshold_for_qrcodes(equalized, threshold=None):
+    # blacks out everything darker than QR_THRESHOLD so the QR modules stand out from the conveyor
+    threshold = QR_THRESHOLD if threshold is None else threshold
+    return np.where(equalized < threshold, 0, equalized).astype(np.uint8)
+
+def clahe_for_qrcodes(gray):
+    # local contrast equalization, for frames lit unevenly enough that one global histogram washes codes out
+    return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(gray)
+
+# Preprocessing tried before decoding, each taking (gray, equalized gray) of a frame or crop
+QR_PREPROCESSING = {
+    'threshold': lambda gray, equalized: threshold_for_qrcodes(equalized),
+    'threshold_dark': lambda gray, equalized: threshold_for_qrcodes(equalized, QR_THRESHOLD - 50), # dim frames
+    'threshold_bright': lambda gray, equalized: threshold_for_qrcodes(equalized, QR_THRESHOLD + 50), # glare
+    'equalized': lambda gray, equalized: equalized,
+    'clahe': lambda gray, equalized: clahe_for_qrcodes(gray),
+    'inverted': lambda gray, equalized: cv2.bitwise_not(equalized), # codes that show up light on dark
+}
+
+# variant names, the one that last found every QR code first
+_qr_variant_order = list(QR_PREPROCESSING)
+
+def prefer_qr_variant(variant):
+    """
+    Moves a preprocessing variant to the front, so later frames (and the crops around holders) try it first.
+    """
+    if _qr_variant_order[0] != variant:
+        print(f"QR preprocessing: now trying {variant} first")
+        _qr_variant_order.remove(variant)
+        _qr_variant_order.insert(0, variant)
+
+def decode_qrcodes(thresholded, offset=(0, 0)):
+    """
+    Decodes QR codes in a preprocessed (thresholded) image or crop.
+    - offset is the (x, y) of the crop in the full frame, so results are in full-frame coordinates.
+    Returns: list of (data, center, top_left) tuples.
+    """
+    global _qr_decode_calls
+    _qr_decode_calls += 1
+    offset_x, offset_y = offset
+    qrcode_info = []
+
+    for qr in decode(thresholded):
+        data = qr.data.decode("utf-8")
+        x, y, w, h = qr.rect
+        x, y = x + offset_x, y + offset_y
+        center = (x + w / 2, y + h / 2)
+        top_left = (x+w, y)
+        # draw a dot at top left of barcode
+        # cv2.circle(image, top_left, 5, (0, 255, 0), -1)  # Green circle
+        qrcode_info.append(QRDetection(data, center, top_left))
+
+        print(f"QR Code Data: {data}")
+        print(f"QR Code Center: ({center[0]:.1f}, {center[1]:.1f})")
+        print(f"QR Code Top Left: ({top_left[0]:.1f}, {top_left[1]:.1f})")
+
+    return qrcode_info
+
 def find_qrcodes(image):
     """
-    Detects QR codes in an image using pyzbar, retries capturing a new image if the expected number of QR codes 
-    is not found, and returns their center coordinates along with the decoded QR code data.
+    Detects QR codes in an image using pyzbar, retries with other preprocessing and then new captures (within
+    QR_MAX_CAPTURES and QR_RETRY_TIME_BUDGET) if the expected number of QR codes is not found, and returns their
+    center coordinates along with the decoded QR code data - the most found if never the expected number.
 
     Parameters:
         image (numpy.ndarray): The input image in which QR codes need to be detected.
@@ -451,46 +933,7 @@ def find_qrcodes(image):
             - data (str): The decoded data from the QR code.
             - center (tuple): The (x, y) coordinates of the QR code's center.
     """
-    num_qrcodes_found = 0
-    qrcode_info = []
-
-    while num_qrcodes_found < NUM_QRCODES:
-        # Preprocess for better QR detection
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        # blurred = cv2.GaussianBlur(gray, (3, 3), 0)
-
-        equalized = cv2.equalizeHist(gray)
-        cv2.imwrite('equalized_qr_image.jpg', equalized)  # Save the equalized image for debugging
-        
-        thresholded = np.where(equalized < 150, 0, equalized).astype(np.uint8)
-        cv2.imwrite('thresholded_qr_image.jpg', thresholded)  # Save the thresholded image for debugging
-
-        # Decode QR codes
-        detected_qrcodes = decode(thresholded)
-        num_qrcodes_found = len(detected_qrcodes)
-        qrcode_info = []
-
-        for qr in detected_qrcodes:
-            data = qr.data.decode("utf-8")
-            x, y, w, h = qr.rect
-            center = (x + w / 2, y + h / 2)
-            top_left = (x+w, y)
-            # draw a dot at top left of barcode
-            # cv2.circle(image, top_left, 5, (0, 255, 0), -1)  # Green circle
-            qrcode_info.append((data, center, top_left))
-
-            print(f"QR Code Data: {data}")
-            print(f"QR Code Center: ({center[0]:.1f}, {center[1]:.1f})")
-            print(f"QR Code Top Left: ({top_left[0]:.1f}, {top_left[1]:.1f})")
-
-        if num_qrcodes_found < NUM_QRCODES:
-            print(f"Found {num_qrcodes_found} QR codes, expected {NUM_QRCODES}, retrying...")
-            image_path = 'retrying_image_to_detect_all_qrcodes.jpg'
-            os.system(f"rpicam-still --output {image_path} --nopreview")
-            image = cv2.imread(image_path)
-
-    print("Correct number of QR codes found.")
-    return qrcode_info
+    return FrameAnalysis(image).find_qrcodes()
 
 if __name__ == "__main__":
     gc.collect()  # Run garbage collection to free up memory
@@ -0,0 +1,141 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bottom_conveyor_motor_code
+from motion_planner import AXIS_PROFILES
+from motor_driver import BOTTOM_AXIS, GPIO, LEFT_AXIS, RIGHT_AXIS, TOP_AXIS
+from recording import MOVE, record_event
+from step_engine import get_step_backend, merge_waveforms, run_waveform
+import top_conveyor_motor_code
+import vertical_conveyor_left_motor_code
+import vertical_conveyor_right_motor_code
+
+# Runs moves on several axes at the same time. The motor modules each call GPIO.cleanup() in their set up and
+# clean up, which would reset the pins of any other axis that is moving, so the coordinator sets up every axis's
+# pins once, moves the axes with waveforms, and only cleans up when it is closed.
+
+# per axis: (function building a move's waveform, output pins, driver enable pins pulled HIGH while set up)
+AXIS_DRIVERS = {
+    LEFT_AXIS: (
+        vertical_conveyor_left_motor_code.left_conveyor_waveform,
+        (vertical_conveyor_left_motor_code.DIR_PIN, vertical_conveyor_left_motor_code.STEP_PIN),
+        (vertical_conveyor_left_motor_code.SLEEP_PIN, vertical_conveyor_left_motor_code.RESET_PIN),
+    ),
+    RIGHT_AXIS: (
+        vertical_conveyor_right_motor_code.right_conveyor_waveform,
+        (vertical_conveyor_right_motor_code.DIR_PIN, vertical_conveyor_right_motor_code.STEP_PIN),
+        (vertical_conveyor_right_motor_code.SLEEP_PIN, vertical_conveyor_right_motor_code.RESET_PIN),
+    ),
+    TOP_AXIS: (
+        top_conveyor_motor_code.top_conveyor_waveform,
+        (top_conveyor_motor_code.IN1, top_conveyor_motor_code.IN2, top_conveyor_motor_code.IN3, top_conveyor_motor_code.IN4),
+        (),
+    ),
+    BOTTOM_AXIS: (
+        bottom_conveyor_motor_code.bottom_conveyor_waveform,
+        (bottom_conveyor_motor_code.IN1, bottom_conveyor_motor_code.IN2, bottom_conveyor_motor_code.IN3, bottom_conveyor_motor_code.IN4),
+        (),
+    ),
+}
+
+class MotionCoordinator:
+    """
+    Owns the GPIO set up of all four axes and moves them, each move returning a Future that completes when the
+    motor has stopped. Steps are signed: positive is up for the vertical conveyors and forward for top/bottom.
+    - move(): starts one axis moving. Moves on the same axis run one after another, moves on different axes
+      overlap when the step backend can emit from several threads (RPi.GPIO), otherwise they queue.
+    - move_together(): merges moves on different axes into one waveform, so they overlap on every backend (pigpio too).
+    Moves use the axis's MotionProfile from AXIS_PROFILES unless given a profile.
+    Use as a context manager, or call set_up() and clean_up().
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=len(AXIS_DRIVERS), thread_name_prefix="motion")
+        self.axis_locks = {axis: threading.Lock() for axis in AXIS_DRIVERS}
+        self.emit_lock = threading.Lock() # held while emitting on backends that play one waveform at a time
+        self.last_direction = {axis: 0 for axis in AXIS_DRIVERS} # 1 or -1 for the last move submitted on each axis, for backlash
+
+    def __enter__(self):
+        self.set_up()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.clean_up()
+
+    def set_up(self):
+        GPIO.setmode(GPIO.BCM)
+        for _, pins, enable_pins in AXIS_DRIVERS.values():
+            for pin in pins + enable_pins:
+                GPIO.setup(pin, GPIO.OUT)
+            for pin in enable_pins:
+                GPIO.output(pin, GPIO.HIGH) # enable driver by pulling SLEEP and RESET HIGH
+
+    def clean_up(self):
+        self.executor.shutdown(wait=True) # let moves already started finish
+        for _, _, enable_pins in AXIS_DRIVERS.values():
+            for pin in enable_pins:
+                GPIO.output(pin, GPIO.LOW) # disable driver by pulling SLEEP and RESET LOW
+        GPIO.cleanup()
+
+    def waveform(self, axis, steps, profile=None):
+        build_waveform, _, _ = AXIS_DRIVERS[axis]
+        return build_waveform(steps, profile=profile or AXIS_PROFILES[axis])
+
+    def _emit(self, waveform):
+        if not len(waveform):
+            return
+        if getattr(get_step_backend(), "concurrent", False):
+            run_waveform(waveform)
+        else:
+            with self.emit_lock:
+                run_waveform(waveform)
+
+    def _note_direction(self, axis, steps):
+        if steps:
+            self.last_direction[axis] = 1 if steps > 0 else -1
+
+    def _run_move(self, axis, steps, profile):
+        with self.axis_locks[axis]:
+            self._emit(self.waveform(axis, steps, profile))
+
+    def move(self, axis, steps, profile=None):
+        """
+        Starts moving one axis by signed `steps`.
+        Returns: Future that completes when the move has finished (call .result() to wait, raising any error from the move).
+        """
+        self._note_direction(axis, steps)
+        record_event(MOVE, axis=axis, steps=steps)
+        return self.executor.submit(self._run_move, axis, steps, profile)
+
+    def _run_together(self, moves, profiles):
+        locks = [self.axis_locks[axis] for axis in sorted(moves)] # always taken in the same order, so two calls can't deadlock
+        for lock in locks:
+            lock.acquire()
+        try:
+            waveforms = [self.waveform(axis, steps, profiles.get(axis)) for axis, steps in moves.items()]
+            if any(len(waveform) for waveform in waveforms):
+                self._emit(merge_waveforms(waveforms))
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def move_together(self, moves, profiles=None):
+        """
+        Starts moving several axes at once, from a dict of axis -> signed steps (and optionally axis -> MotionProfile).
+        Returns: dict of axis -> Future. All of them complete when the longest move has finished.
+        """
+        for axis, steps in moves.items():
+            self._note_direction(axis, steps)
+        record_event(MOVE, moves=moves)
+        job = self.executor.submit(self._run_together, dict(moves), profiles or {})
+        return {axis: job for axis in moves}
+
+def wait_for(futures):
+    """
+    Waits for moves to finish, from a Future or a dict/list of them (as returned by move() and move_together()).
+    """
+    if isinstance(futures, dict):
+        futures = futures.values()
+    elif not isinstance(futures, (list, tuple, set)):
+        futures = [futures]
+    for future in futures:
+        future.result()
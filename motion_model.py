@@ -0,0 +1,134 @@
+import json
+import numpy as np
+from calibration import AXIS_SPEED_KEYS, CALIBRATION_SWEEP_KEY
+
+# Predicts the steps a move needs from the pixel error, so an alignment can be made in one move and checked with a
+# single frame, instead of re-capturing after each partial move. Every move made through a PIDController with a
+# model is logged to MOTION_HISTORY_PATH, and the models are refitted from that history: per-direction pixels per step
+# (the conveyors don't move the same distance per step both ways) and backlash (steps lost when the direction reverses).
+
+MOTION_HISTORY_PATH = "motion_history.jsonl"
+MIN_STEPS_TO_OBSERVE = 20 # steps - smaller moves are mostly detection noise, so aren't logged
+MIN_OBSERVATIONS_TO_FIT = 4 # per direction - until then the calibrated pixels per step is used
+MAX_HISTORY_PER_AXIS = 200 # most recent moves used in a fit, so the model follows the belts as they wear
+
+class AxisMotionModel:
+    """
+    Pixels of error a move of an axis removes, per step. Errors and steps are signed the same way: positive steps
+    reduce a positive error.
+    - pixels_per_step: {1: positive direction, -1: negative direction}.
+    - backlash_steps: steps taken up by slack before the axis moves, after reversing direction.
+    """
+
+    def __init__(self, axis, pixels_per_step_positive, pixels_per_step_negative=None, backlash_steps=0.0,
+                 history_path=MOTION_HISTORY_PATH):
+        self.axis = axis
+        self.pixels_per_step = {1: pixels_per_step_positive, -1: pixels_per_step_negative or pixels_per_step_positive}
+        self.backlash_steps = backlash_steps
+        self.history_path = history_path
+        self.observations = [] # (steps, pixels, reversed_direction)
+
+    def steps_for(self, pixels, last_direction=0):
+        """
+        Returns: signed steps (not rounded) to remove `pixels` of error, after a move in `last_direction` (1, -1 or 0 if unknown).
+        """
+        if pixels == 0:
+            return 0.0
+        direction = 1 if pixels > 0 else -1
+        steps = abs(pixels) / self.pixels_per_step[direction]
+        if last_direction and last_direction != direction:
+            steps += self.backlash_steps
+        return direction * steps
+
+    def pixels_for(self, steps, reversed_direction=False):
+        """
+        Returns: signed pixels of error a move of `steps` is expected to remove.
+        """
+        if steps == 0:
+            return 0.0
+        direction = 1 if steps > 0 else -1
+        moved = max(abs(steps) - (self.backlash_steps if reversed_direction else 0.0), 0.0)
+        return direction * moved * self.pixels_per_step[direction]
+
+    def observe(self, steps, pixels, reversed_direction):
+        """
+        Records that a move of `steps` removed `pixels` of error, logs it to the history file and refits the model.
+        """
+        if abs(steps) < MIN_STEPS_TO_OBSERVE:
+            return
+        self.observations.append((steps, pixels, reversed_direction))
+        if self.history_path is not None:
+            with open(self.history_path, "a") as file:
+                file.write(json.dumps({"axis": self.axis, "steps": steps, "pixels": pixels, "reversed": reversed_direction}) + "\n")
+        self.fit()
+
+    def fit(self):
+        """
+        Least squares fit of |pixels| = pixels_per_step * (|steps| - backlash * reversed), per direction.
+        Directions with fewer than MIN_OBSERVATIONS_TO_FIT moves keep their current pixels per step.
+        """
+        observations = np.array(self.observations[-MAX_HISTORY_PER_AXIS:], dtype=float).reshape(-1, 3)
+        backlash_estimates = []
+        for direction in (1, -1):
+            rows = observations[np.sign(observations[:, 0]) == direction]
+            rows = rows[np.sign(rows[:, 1]) == direction] # moves that went the wrong way were misdetections
+            if len(rows) < MIN_OBSERVATIONS_TO_FIT:
+                continue
+            steps, pixels, reversed_direction = np.abs(rows[:, 0]), np.abs(rows[:, 1]), rows[:, 2]
+            if reversed_direction.any() and not reversed_direction.all():
+                (slope, lost_pixels), *_ = np.linalg.lstsq(np.column_stack((steps, -reversed_direction)), pixels, rcond=None)
+                if slope > 0:
+                    backlash_estimates.append(lost_pixels / slope)
+            else:
+                slope = (steps * pixels).sum() / (steps * steps).sum() # through the origin
+            if slope > 0:
+                self.pixels_per_step[direction] = float(slope)
+        if backlash_estimates:
+            self.backlash_steps = max(float(np.mean(backlash_estimates)), 0.0)
+
+    def __str__(self):
+        return (f"{self.axis} motion model: {self.pixels_per_step[1]:.3f} px/step positive, "
+                f"{self.pixels_per_step[-1]:.3f} px/step negative, backlash {self.backlash_steps:.1f} steps, "
+                f"{len(self.observations)} moves")
+
+def load_history(history_path=MOTION_HISTORY_PATH):
+    """
+    Returns: dict of axis -> list of (steps, pixels, reversed_direction) logged moves, oldest first.
+    """
+    history = {}
+    try:
+        with open(history_path, "r") as file:
+            for line in file:
+                try:
+                    move = json.loads(line)
+                    history.setdefault(move["axis"], []).append((move["steps"], move["pixels"], move["reversed"]))
+                except (json.JSONDecodeError, KeyError):
+                    continue # skip a line cut short by a crash mid-write
+    except FileNotFoundError:
+        pass
+    return history
+
+def sweep_backlash_steps(calibration_variables, axis):
+    """
+    Returns: backlash in steps from the axis's last calibration sweep (its negative intercepts), or 0 if it has none.
+    """
+    fits = calibration_variables.get(CALIBRATION_SWEEP_KEY, {}).get(axis, {}).values()
+    backlash = [-fit["intercept"] / fit["slope"] for fit in fits if fit["slope"] > 0]
+    return max(float(np.mean(backlash)), 0.0) if backlash else 0.0
+
+def load_motion_models(calibration_variables, history_path=MOTION_HISTORY_PATH):
+    """
+    Builds a model for each axis from its calibrated pixels per step and sweep backlash, refitted with the logged
+    move history.
+    Returns: dict of axis -> AxisMotionModel.
+    """
+    history = load_history(history_path)
+    models = {}
+    for axis, (positive_key, negative_key) in AXIS_SPEED_KEYS.items():
+        model = AxisMotionModel(axis, calibration_variables[positive_key], calibration_variables[negative_key],
+                                backlash_steps=sweep_backlash_steps(calibration_variables, axis), history_path=history_path)
+        model.observations = history.get(axis, [])[-MAX_HISTORY_PER_AXIS:]
+        model.fit()
+        print(model)
+        models[axis] = model
+    return models
@@ -0,0 +1,91 @@
+import numpy as np
+from motor_driver import BOTTOM_AXIS, LEFT_AXIS, RIGHT_AXIS, TOP_AXIS
+
+# Turns a step count into a velocity profile - ramping up from a safe start speed, cruising, and ramping down -
+# so the conveyors can cruise faster than the fixed delay=0.001 without stalling when starting under a loaded tray.
+
+RAMP_SAMPLES = 2000 # time samples used to integrate a ramp
+
+class MotionProfile:
+    """
+    Speed limits for one axis. Speeds are in steps per second, where a step is one step of the axis's move function.
+    - start_speed: speed the move starts and ends at (must be safe to start at from rest).
+    - max_speed: cruising speed.
+    - acceleration: steps/s^2.
+    - jerk: steps/s^3. None gives a trapezoidal profile (instant changes of acceleration), otherwise an S-curve.
+    """
+
+    def __init__(self, start_speed, max_speed, acceleration, jerk=None):
+        self.start_speed = start_speed
+        self.max_speed = max(max_speed, start_speed)
+        self.acceleration = acceleration
+        self.jerk = jerk
+
+# Per-axis limits. The start speeds are the old fixed speeds (STEP/DIR: 2 x 0.001 s per step, ULN2003: 8 x 0.001 s).
+AXIS_PROFILES = {
+    LEFT_AXIS: MotionProfile(start_speed=500, max_speed=1000, acceleration=2000, jerk=20000),
+    RIGHT_AXIS: MotionProfile(start_speed=500, max_speed=1000, acceleration=2000, jerk=20000),
+    TOP_AXIS: MotionProfile(start_speed=125, max_speed=200, acceleration=400),
+    BOTTOM_AXIS: MotionProfile(start_speed=125, max_speed=200, acceleration=400),
+}
+
+def acceleration_ramp(profile, peak_speed):
+    """
+    Samples the speed-up from the profile's start speed to peak_speed.
+    Returns: (times, positions) arrays - positions in steps travelled since the start of the ramp.
+    """
+    speed_change = peak_speed - profile.start_speed
+    if speed_change <= 0:
+        return np.zeros(1), np.zeros(1)
+
+    if profile.jerk is None:
+        duration = speed_change / profile.acceleration
+        times = np.linspace(0, duration, RAMP_SAMPLES)
+        acceleration = np.full(RAMP_SAMPLES, profile.acceleration)
+    else:
+        # jerk-limited: acceleration ramps up, holds (if there's room to reach full acceleration), then ramps down
+        if speed_change >= profile.acceleration ** 2 / profile.jerk:
+            jerk_time = profile.acceleration / profile.jerk
+            hold_time = speed_change / profile.acceleration - jerk_time
+        else:
+            jerk_time = np.sqrt(speed_change / profile.jerk)
+            hold_time = 0.0
+        duration = 2 * jerk_time + hold_time
+        times = np.linspace(0, duration, RAMP_SAMPLES)
+        acceleration = profile.jerk * np.minimum(np.minimum(times, duration - times), jerk_time)
+
+    speeds = profile.start_speed + cumulative_integral(acceleration, times)
+    return times, cumulative_integral(speeds, times)
+
+def cumulative_integral(values, times):
+    # trapezoidal cumulative integral, starting at 0
+    return np.concatenate(([0.0], np.cumsum((values[1:] + values[:-1]) / 2 * np.diff(times))))
+
+def step_intervals(steps, profile):
+    """
+    Plans a move of `steps` steps.
+    The peak speed is lowered (by bisection) until the speed-up and slow-down ramps fit in the move.
+    Returns: array with the time (seconds) each step should take.
+    """
+    steps = max(int(steps), 0)
+    if steps == 0:
+        return np.zeros(0)
+
+    low, high = profile.start_speed, profile.max_speed
+    times, positions = acceleration_ramp(profile, high)
+    if 2 * positions[-1] > steps:
+        for _ in range(30):
+            peak_speed = (low + high) / 2
+            times, positions = acceleration_ramp(profile, peak_speed)
+            if 2 * positions[-1] > steps:
+                high = peak_speed
+            else:
+                low = peak_speed
+        high = low
+        times, positions = acceleration_ramp(profile, high)
+
+    ramp_steps = int(positions[-1])
+    ramp_times = np.interp(np.arange(1, ramp_steps + 1), positions, times)
+    ramp_intervals = np.diff(np.concatenate(([0.0], ramp_times)))
+    cruise_intervals = np.full(steps - 2 * ramp_steps, 1 / high)
+    return np.concatenate((ramp_intervals, cruise_intervals, ramp_intervals[::-1]))
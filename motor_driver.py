@@ -0,0 +1,169 @@
+import os
+
+# Selects the GPIO backend used by the motor modules, with the GROBOT_MOTORS environment variable:
+#   GROBOT_MOTORS=gpio - real pins through RPi.GPIO (default)
+#   GROBOT_MOTORS=sim  - simulated pins that count the steps each axis takes, so the control code runs off-device
+MOTOR_BACKEND_ENV_VAR = "GROBOT_MOTORS"
+
+# Axis names, shared by the motor modules, the simulation and calibration
+LEFT_AXIS = "left"
+RIGHT_AXIS = "right"
+TOP_AXIS = "top"
+BOTTOM_AXIS = "bottom"
+
+class StepDirAxis:
+    """
+    Simulated driver with STEP/DIR inputs (the vertical conveyors).
+    A rising edge on the step pin moves one step, in the direction given by the dir pin.
+    - positive_dir_level: dir pin level that the move function uses for positive (up) steps.
+    """
+
+    def __init__(self, name, step_pin, dir_pin, positive_dir_level):
+        self.name = name
+        self.step_pin = step_pin
+        self.dir_pin = dir_pin
+        self.positive_dir_level = positive_dir_level
+        self.pins = (step_pin, dir_pin)
+        self.reset()
+
+    def reset(self):
+        self.position = 0 # net steps, positive in the move function's positive direction
+        self.steps_positive = 0
+        self.steps_negative = 0
+
+    def record(self, steps):
+        # steps: signed number of steps taken
+        self.position += steps
+        if steps > 0:
+            self.steps_positive += steps
+        else:
+            self.steps_negative -= steps
+
+    def on_output(self, pin, previous_level, level, levels):
+        if pin == self.step_pin and level and not previous_level:
+            self.record(1 if levels.get(self.dir_pin, 0) == self.positive_dir_level else -1)
+
+class PhaseAxis:
+    """
+    Simulated ULN2003 driver (the top and bottom conveyors).
+    Steps are counted by following the coil pattern through the phase sequence - one step is a full pass
+    through the sequence, matching the step counts passed to the step functions.
+    - positive_order: +1 if the forward step function walks the sequence in order, -1 if in reverse.
+    """
+
+    def __init__(self, name, pins, sequence, positive_order):
+        self.name = name
+        self.pins = tuple(pins)
+        self.sequence = [tuple(phase) for phase in sequence]
+        self.positive_order = positive_order
+        self.phase_index = None
+        self.reset()
+
+    def reset(self):
+        self.phases = 0
+        self.phases_positive = 0
+        self.phases_negative = 0
+
+    @property
+    def position(self):
+        return self.phases / len(self.sequence)
+
+    @property
+    def steps_positive(self):
+        return self.phases_positive / len(self.sequence)
+
+    @property
+    def steps_negative(self):
+        return self.phases_negative / len(self.sequence)
+
+    def record(self, steps):
+        # steps: signed number of full sequence passes taken
+        phases = round(steps * len(self.sequence))
+        self.phases += phases
+        if phases > 0:
+            self.phases_positive += phases
+        else:
+            self.phases_negative -= phases
+
+    def on_output(self, pin, previous_level, level, levels):
+        if pin != self.pins[-1]: # the step functions write every coil in order, so the pattern is complete on the last one
+            return
+        pattern = tuple(levels.get(p, 0) for p in self.pins)
+        if pattern not in self.sequence:
+            return
+        index = self.sequence.index(pattern)
+        if self.phase_index is not None and index != self.phase_index:
+            delta = (index - self.phase_index) % len(self.sequence)
+            if delta == 1:
+                self.record(self.positive_order / len(self.sequence))
+            elif delta == len(self.sequence) - 1:
+                self.record(-self.positive_order / len(self.sequence))
+        self.phase_index = index
+
+# simulated axes by name, registered by the motor modules at import time
+SIMULATED_AXES = {}
+
+def register_step_dir_axis(name, step_pin, dir_pin, positive_dir_level):
+    SIMULATED_AXES[name] = StepDirAxis(name, step_pin, dir_pin, positive_dir_level)
+
+def register_phase_axis(name, pins, sequence, positive_order):
+    SIMULATED_AXES[name] = PhaseAxis(name, pins, sequence, positive_order)
+
+def reset_simulated_axes():
+    for axis in SIMULATED_AXES.values():
+        axis.reset()
+
+class SimulatedGPIO:
+    """
+    Stand-in for the RPi.GPIO module.
+    Keeps pin levels in memory and forwards every output to the simulated axes wired to that pin.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.levels = {}
+        self.mode = None
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=LOW):
+        self.levels[pin] = initial if direction == self.OUT else self.levels.get(pin, self.LOW)
+
+    def output(self, pin, level):
+        if isinstance(pin, (list, tuple)): # RPi.GPIO also takes lists of pins and levels
+            levels = level if isinstance(level, (list, tuple)) else [level] * len(pin)
+            for p, l in zip(pin, levels):
+                self.output(p, l)
+            return
+        level = int(bool(level))
+        previous_level = self.levels.get(pin, self.LOW)
+        self.levels[pin] = level
+        for axis in SIMULATED_AXES.values():
+            if pin in axis.pins:
+                axis.on_output(pin, previous_level, level, self.levels)
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def cleanup(self, *pins):
+        # like RPi.GPIO, resets the pins - the simulated axes keep their positions
+        for pin in pins or list(self.levels):
+            self.levels.pop(pin, None)
+        self.mode = None
+
+def is_simulated():
+    return os.environ.get(MOTOR_BACKEND_ENV_VAR, "gpio") == "sim"
+
+if is_simulated():
+    GPIO = SimulatedGPIO()
+else:
+    import RPi.GPIO as GPIO
@@ -0,0 +1,111 @@
+import math
+
+# Turns a pixel error measured in a frame into the steps to move an axis by. One controller is kept per axis (and
+# direction where calibration has separate speeds), so its integral and previous error don't leak between phases.
+
+INTEGRAL_LIMIT = 2000 # pixels - the integral is clamped to +-this so a long approach can't wind it up
+MAX_STEPS_PER_MOVE = 3000 # steps - output saturation, so one bad detection can't run an axis far off
+
+class PIDTrace:
+    """
+    One update of a controller: the error, each term's contribution (in steps) and the steps output.
+    """
+
+    def __init__(self, iteration, error, feed_forward, integral, derivative, steps):
+        self.iteration = iteration
+        self.error = error
+        self.feed_forward = feed_forward
+        self.integral = integral
+        self.derivative = derivative
+        self.steps = steps
+
+    def __str__(self):
+        return (f"iteration {self.iteration}: error {self.error:.1f}px, feed forward {self.feed_forward:.1f}, "
+                f"integral {self.integral:.1f}, derivative {self.derivative:.1f} -> {self.steps} steps")
+
+class PIDController:
+    """
+    PID control in steps for one axis.
+    - pixels_per_step: the axis's calibrated speed. The proportional term is the feed-forward estimate of the
+      steps needed to close the error (error / pixels_per_step), scaled by Kp.
+    - Ki, Kd: steps per pixel of accumulated error / per pixel of change in error since the last update.
+    - deadband: pixels - errors this small give 0 steps (the axis is on target).
+    - min_steps: smallest move made for an error outside the deadband, so rounding down can't stall the loop.
+    - max_steps: output saturation. The integral isn't accumulated while the output is saturated.
+    - integral_limit: pixels - clamp on the accumulated error.
+    - model: optional AxisMotionModel. The feed-forward then comes from the model (per-direction pixels per step and
+      backlash) instead of pixels_per_step, and the first update is the whole predicted move (no integral or
+      derivative), so a loop only needs its verification frame when the prediction lands within tolerance.
+      Each move's outcome is observed by the model on the next update.
+    Every update is printed and kept in `traces`.
+    """
+
+    def __init__(self, name, pixels_per_step, Kp=1.0, Ki=0.005, Kd=0.05, deadband=0, min_steps=1,
+                 max_steps=MAX_STEPS_PER_MOVE, integral_limit=INTEGRAL_LIMIT, model=None):
+        self.name = name
+        self.pixels_per_step = pixels_per_step
+        self.model = model
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+        self.deadband = deadband
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.integral_limit = integral_limit
+        self.reset()
+
+    def reset(self):
+        # call before each new alignment, so the previous one's integral and error aren't carried over
+        self.integral = 0.0
+        self.previous_error = None
+        self.previous_steps = 0
+        self.previous_reversed = False
+        self.traces = []
+
+    def expected_correction(self):
+        """
+        Returns: pixels of error the last update's move is expected to remove (0 before the first move).
+        """
+        if self.model is not None:
+            return self.model.pixels_for(self.previous_steps, self.previous_reversed)
+        return self.previous_steps * self.pixels_per_step
+
+    def update(self, error, last_direction=0):
+        """
+        Returns: signed steps to move to reduce `error` (pixels), rounded to the nearest step. 0 once within the deadband.
+        - last_direction: direction of the axis's last move (1, -1 or 0 if unknown), for the model's backlash.
+        """
+        if self.model is not None and self.previous_steps:
+            self.model.observe(self.previous_steps, self.previous_error - error, self.previous_reversed)
+
+        if abs(error) <= self.deadband:
+            steps = 0
+            feed_forward = integral_term = derivative_term = 0.0
+        else:
+            derivative = 0.0 if self.previous_error is None else error - self.previous_error
+            integral = min(max(self.integral + error, -self.integral_limit), self.integral_limit)
+
+            if self.model is not None:
+                feed_forward = self.Kp * self.model.steps_for(error, last_direction)
+            else:
+                feed_forward = self.Kp * error / self.pixels_per_step
+            if self.model is not None and self.previous_error is None:
+                integral_term = derivative_term = 0.0 # open loop first: the predicted move alone
+            else:
+                integral_term = self.Ki * integral
+                derivative_term = self.Kd * derivative
+            output = feed_forward + integral_term + derivative_term
+
+            if abs(output) <= self.max_steps:
+                self.integral = integral # anti-windup: only integrate while the output isn't saturated
+            steps = int(math.copysign(min(round(abs(output)), self.max_steps), output))
+            if abs(steps) < self.min_steps:
+                steps = int(math.copysign(self.min_steps, output if output else error))
+        self.previous_error = error
+        self.previous_steps = steps
+        self.previous_reversed = bool(steps and last_direction and (steps > 0) != (last_direction > 0))
+
+        trace = PIDTrace(len(self.traces) + 1, error, feed_forward, integral_term, derivative_term, steps)
+        self.traces.append(trace)
+        print(f"PID {self.name} {trace}")
+        return steps
@@ -0,0 +1,221 @@
+import atexit
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import zlib
+import cv2
+import numpy as np
+from camera import Camera
+
+# Records a run so it can be replayed without the hardware (see replay_rotation.py). Turned on with the
+# GROBOT_RECORD environment variable, naming the directory to record to:
+#   GROBOT_RECORD=<dir>             - record every frame captured, motor move and control loop measurement
+#   GROBOT_RECORD_FORMAT=raw | png  - frames stored as raw pixels (default, fastest) or lossless PNG (smaller)
+# The directory holds:
+#   frames.dat    - the frames, one after another, read back through a memory map
+#   events.jsonl  - one JSON line per event, in the order they happened. Frame events give their frame's offset,
+#                   size and shape in frames.dat.
+#   state/        - copies of the files the run reads its calibration from, taken when recording starts
+# Frames and events are written on a background thread. Unlike debug images nothing is dropped - a capture waits
+# if the writer falls behind. If writing fails (e.g. the disk is full) the recording stops there and the run carries on.
+RECORD_ENV_VAR = "GROBOT_RECORD"
+RECORD_FORMAT_ENV_VAR = "GROBOT_RECORD_FORMAT"
+FRAMES_FILE = "frames.dat"
+EVENTS_FILE = "events.jsonl"
+STATE_DIRECTORY = "state"
+STATE_FILES = ("calibration_variables.json", "calibration_history.jsonl", "conveyor_geometry.json", "motion_history.jsonl") # read at the start of a run
+MAX_QUEUED_FRAMES = 4 # frames waiting to be written before a capture waits for the writer
+MAX_INLINE_ARRAY = 16 # elements - larger arrays in events are stored as their shape and a checksum
+
+RAW = "raw"
+PNG = "png"
+
+START = "start"
+FRAME = "frame"
+MOVE = "move"
+MEASUREMENT = "measurement"
+
+def jsonable(value):
+    """
+    Returns: `value` as something json.dumps takes - numpy scalars as numbers, small arrays as lists, and large arrays
+    (contours, images) as their shape and a checksum, so replays can still be compared with them.
+    """
+    if isinstance(value, np.ndarray):
+        if value.size <= MAX_INLINE_ARRAY:
+            return value.tolist()
+        return {"shape": list(value.shape), "crc32": zlib.crc32(np.ascontiguousarray(value).tobytes())}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(key): jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+class Recorder:
+    """
+    Records frames and events to `directory`.
+    - frame_format: RAW or PNG.
+    `events` keeps every event recorded (without frame pixels), for comparing a replay with its recording.
+    """
+
+    def __init__(self, directory, frame_format=RAW):
+        if frame_format not in (RAW, PNG):
+            raise ValueError(f"Unknown frame format: {frame_format}")
+        self.directory = directory
+        self.frame_format = frame_format
+        self.events = []
+        self.frames = 0
+        self.lock = threading.Lock() # frames are captured on control loop threads, moves on the main thread
+        self.queue = queue.Queue(maxsize=MAX_QUEUED_FRAMES)
+        self.thread = None
+        self.error = None # the exception that stopped the writer, if writing failed
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._snapshot_state()
+            self.frames_file = open(os.path.join(directory, FRAMES_FILE), "wb")
+            self.events_file = open(os.path.join(directory, EVENTS_FILE), "w")
+            self.thread = threading.Thread(target=self._write, name="recorder", daemon=True)
+            self.thread.start()
+
+    def _snapshot_state(self):
+        state_directory = os.path.join(self.directory, STATE_DIRECTORY)
+        os.makedirs(state_directory, exist_ok=True)
+        for path in STATE_FILES:
+            if os.path.exists(path):
+                shutil.copy2(path, state_directory)
+
+    def record(self, kind, image=None, **fields):
+        """
+        Records an event of `kind` (START, FRAME, MOVE, MEASUREMENT or any other name) with `fields`, and `image` for frames.
+        """
+        with self.lock:
+            event = {"seq": len(self.events), "time": round(time.time(), 3), "kind": kind, **jsonable(fields)}
+            self.events.append(event)
+            if image is not None:
+                event["frame"] = self.frames
+                self.frames += 1
+            if self.thread is not None and self.error is None:
+                # queued under the lock, so the writer sees events in sequence order
+                self.queue.put((dict(event), None if image is None else image.copy()))
+
+    def _write(self):
+        offset = 0
+        while True:
+            event, image = self.queue.get()
+            try:
+                if self.error is not None:
+                    continue # writing failed - keep draining the queue so captures don't wait on it forever
+                if image is not None:
+                    data = image.tobytes() if self.frame_format == RAW else cv2.imencode(".png", image)[1].tobytes()
+                    self.frames_file.write(data)
+                    event.update(offset=offset, nbytes=len(data), shape=list(image.shape), dtype=str(image.dtype), format=self.frame_format)
+                    offset += len(data)
+                self.events_file.write(json.dumps(event) + "\n")
+            except Exception as error:
+                self.error = error
+                print(f"Recording stopped after {event['seq']} events: {error}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # waits until everything recorded so far is on disk
+        if self.thread is not None:
+            self.queue.join()
+            if self.error is None:
+                self.frames_file.flush()
+                self.events_file.flush()
+
+    def __str__(self):
+        return f"recording ({self.directory}): {self.frames} frames, {len(self.events)} events"
+
+def recorder_from_env():
+    directory = os.environ.get(RECORD_ENV_VAR, "")
+    if not directory:
+        return None
+    return Recorder(directory, os.environ.get(RECORD_FORMAT_ENV_VAR, "") or RAW)
+
+_recorder = None
+_recorder_checked = False
+
+def get_recorder():
+    """
+    Returns the active recorder, creating it from GROBOT_RECORD on first use, or None if nothing is being recorded.
+    """
+    global _recorder, _recorder_checked
+    if not _recorder_checked:
+        _recorder_checked = True
+        _recorder = recorder_from_env()
+        if _recorder is not None:
+            atexit.register(_recorder.flush) # the writer is a daemon thread, so write what's queued before exiting
+            _recorder.record(START, argv=sys.argv) # the script's flags, for replaying it the same way
+            print(f"Recording to {_recorder.directory}")
+    return _recorder
+
+def set_recorder(recorder):
+    global _recorder, _recorder_checked
+    if _recorder is not None and _recorder is not recorder:
+        _recorder.flush()
+    _recorder = recorder
+    _recorder_checked = True
+
+def record_frame(image):
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.record(FRAME, image)
+
+def record_event(kind, **fields):
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.record(kind, **fields)
+
+# ---- REPLAY ----
+
+def load_events(directory):
+    """
+    Returns: the events recorded to `directory`, in sequence order. A last line cut short by a crash is skipped.
+    """
+    events = []
+    with open(os.path.join(directory, EVENTS_FILE), "r") as file:
+        for line in file:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return sorted(events, key=lambda event: event["seq"])
+
+class RecordingCamera(Camera):
+    """
+    Serves the frames of a recording, in the order they were captured. Frames are read through a memory map, so only
+    the frames served are read from disk.
+    """
+
+    def __init__(self, directory):
+        self.frame_events = [event for event in load_events(directory) if event["kind"] == FRAME and "offset" in event]
+        if not self.frame_events:
+            raise ValueError(f"No frames recorded in {directory}")
+        self.frames = np.memmap(os.path.join(directory, FRAMES_FILE), dtype=np.uint8, mode="r")
+        self.index = 0
+
+    def frame(self, index):
+        event = self.frame_events[index]
+        data = self.frames[event["offset"]:event["offset"] + event["nbytes"]]
+        if event["format"] == PNG:
+            return cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+        return np.array(data).view(event["dtype"]).reshape(event["shape"]) # a copy - callers draw on frames
+
+    def capture(self, path=None):
+        if self.index >= len(self.frame_events):
+            raise RuntimeError("No more recorded frames to replay.")
+        image = self.frame(self.index)
+        self.index += 1
+        return image
+
+    def close(self):
+        self.frames = None
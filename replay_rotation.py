@@ -0,0 +1,97 @@
+import argparse
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+
+# Replays a recorded run of rotate_plant_anticlockwise.py (see recording.py) with no hardware: the recorded frames
+# are served in order, the motors are simulated, and the run starts from the calibration files recorded with it,
+# copied to a temporary working directory so the replay doesn't change the real ones. The moves and control loop
+# measurements of the replay are compared with the recording, so a change to the vision or control code can be
+# checked against a real run - the replay should match it until the first decision the change was meant to alter.
+# Time limits (e.g. the QR retry budget) can still make a slower or faster replay take a different path.
+# usage: python replay_rotation.py <recording directory>
+
+COMPARED_KINDS = ("move", "measurement")
+UNCOMPARED_FIELDS = ("seq", "time", "frame", "offset", "nbytes", "shape", "dtype", "format")
+
+def comparable(events):
+    return [{key: value for key, value in event.items() if key not in UNCOMPARED_FIELDS}
+            for event in events if event["kind"] in COMPARED_KINDS]
+
+def compare_events(recorded, replayed):
+    """
+    Returns: (number of moves and measurements that matched, (recorded event, replayed event) at the first
+    mismatch or None). A missing event on one side is None.
+    """
+    recorded, replayed = comparable(recorded), comparable(replayed)
+    for i in range(max(len(recorded), len(replayed))):
+        expected = recorded[i] if i < len(recorded) else None
+        actual = replayed[i] if i < len(replayed) else None
+        if expected != actual:
+            return i, (expected, actual)
+    return len(recorded), None
+
+def replay_rotation(directory, script="rotate_plant_anticlockwise.py", argv=None):
+    """
+    Runs `script` against the recording in `directory`, with GROBOT_MOTORS=sim.
+    - argv: the script's arguments, the recorded ones by default.
+    Returns: (seconds, recorded events, replayed events, error the replay raised or None).
+    """
+    os.environ["GROBOT_MOTORS"] = "sim" # must be set before the motor modules are imported
+    os.environ.setdefault("GROBOT_DEBUG_IMAGES", "off")
+    directory = os.path.abspath(directory)
+    script = os.path.abspath(script)
+    from camera import set_camera
+    from recording import START, STATE_DIRECTORY, Recorder, RecordingCamera, load_events, set_recorder
+
+    recorded = load_events(directory)
+    if argv is None:
+        starts = [event for event in recorded if event["kind"] == START]
+        argv = starts[0]["argv"][1:] if starts else []
+    set_camera(RecordingCamera(directory))
+    replayed = Recorder(None) # keeps the replay's events in memory
+    set_recorder(replayed)
+
+    error = None
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="grobot-replay-") as replay_directory:
+        state_directory = os.path.join(directory, STATE_DIRECTORY)
+        if os.path.isdir(state_directory):
+            for name in os.listdir(state_directory):
+                shutil.copy2(os.path.join(state_directory, name), replay_directory)
+        os.chdir(replay_directory)
+        sys.path.insert(0, os.path.dirname(script)) # the script's modules, now it isn't run from its own directory
+        sys.argv = [script] + list(argv)
+        start = time.perf_counter()
+        try:
+            runpy.run_path(script, run_name="__main__")
+        except Exception as exception: # the recorded run may have stopped the same way
+            error = exception
+        finally:
+            seconds = time.perf_counter() - start
+            os.chdir(working_directory)
+    return seconds, recorded, replayed.events, error
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded rotation with no hardware and compare it with the recording.")
+    parser.add_argument('recording', help='Directory recorded with GROBOT_RECORD.')
+    parser.add_argument('--script', default='rotate_plant_anticlockwise.py', help='Script to replay.')
+    args = parser.parse_args()
+
+    seconds, recorded, replayed, error = replay_rotation(args.recording, args.script)
+    matched, mismatch = compare_events(recorded, replayed)
+    frames = sum(event["kind"] == "frame" for event in replayed)
+    print(f"Replay time: {seconds:.2f} s, {frames} of {sum(event['kind'] == 'frame' for event in recorded)} recorded frames used")
+    if error is not None:
+        print(f"Replay stopped with {type(error).__name__}: {error}")
+    if mismatch is None:
+        print(f"Replay matches the recording: {matched} moves and measurements")
+    else:
+        expected, actual = mismatch
+        print(f"Replay diverges after {matched} matching moves and measurements")
+        print(f"  recorded: {expected}")
+        print(f"  replayed: {actual}")
+        sys.exit(1)
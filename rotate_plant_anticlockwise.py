@@ -1,53 +1,42 @@
 import os
 import cv2
-from bottom_conveyor_motor_code import clean_up_bottom_conveyor, set_up_bottom_conveyor, step_bottom_conveyor_backward, step_bottom_conveyor_forward
-import pigpio
-import RPi.GPIO as GPIO
+# import pigpio  # needed by the servo light trigger below
+from motor_driver import BOTTOM_AXIS, GPIO, LEFT_AXIS, RIGHT_AXIS, TOP_AXIS
+from motion_coordinator import MotionCoordinator
+from control_loop import ControlLoop
+from pid_controller import PIDController
+from motion_model import load_motion_models
+from change_detector import ConveyorChangeDetector, HolderCache
+from tracker import ContourTracker, holder_plane, leg_plane
+from color_tuning import ColorTuner, load_color_thresholds, observe_frame, tune_from_frame
+from conveyor_geometry import get_conveyor_geometry
+from calibration_sweep import calibrate_axes_sweep
 import argparse
 import gc
 import numpy as np
 import time
 import threading
-from image_analysis import bottom_holder_left_conveyor, bottom_holder_right_conveyor, bottom_holder_with_qrcode, capture_image, divide_holders_into_conveyors, extract_holder_corners, find_holders, find_leg_bottom_conveyor, find_leg_contours, find_leg_top_conveyor, get_bottom_left_corner, get_bottom_qr_right_conveyor, get_leftmost_corner, get_rightmost_corner, get_top_left_corner, get_top_qr_left_conveyor, top_holder_left_conveyor, top_holder_right_conveyor, get_conveyor_threshold, get_bottom_edge_of_holder, top_holder_with_qrcode
-from calibration import BOTTOM_CONVEYOR_SPEED_BACKWARD, BOTTOM_CONVEYOR_SPEED_FORWARD, TOP_CONVEYOR_SPEED_BACKWARD, TOP_CONVEYOR_SPEED_FORWARD, calibrate_bottom_conveyor_motor, calibrate_top_conveyor_motor, calibrate_vertical_conveyor_motors, load_variables, LEFT_CONVEYOR_SPEED, RIGHT_CONVEYOR_SPEED
+from image_analysis import LEFT_CONVEYOR, RIGHT_CONVEYOR, FrameAnalysis, HolderIndex, bottom_holder_left_conveyor, bottom_holder_right_conveyor, bottom_holder_with_qrcode, capture_image, divide_holders_into_conveyors, extract_holder_corners, find_holders, find_leg_bottom_conveyor, find_leg_contours, find_leg_top_conveyor, get_bottom_left_corner, get_bottom_qr_right_conveyor, get_leftmost_corner, get_rightmost_corner, get_top_left_corner, get_top_qr_left_conveyor, top_holder_left_conveyor, top_holder_right_conveyor, get_conveyor_threshold, get_bottom_edge_of_holder, top_holder_with_qrcode
+from camera import close_camera
+from debug_images import flush_debug_images, get_debug_sink, save_debug_image
+from recording import get_recorder
+from calibration import BOTTOM_CONVEYOR_SPEED_BACKWARD, BOTTOM_CONVEYOR_SPEED_FORWARD, TOP_CONVEYOR_SPEED_BACKWARD, TOP_CONVEYOR_SPEED_FORWARD, load_variables, LEFT_CONVEYOR_SPEED, RIGHT_CONVEYOR_SPEED
 from servo_motor_code import clean_up_servo, set_up_servo, sweep_servo
 import servo_motor_code
-from top_conveyor_motor_code import clean_up_top_conveyor, set_up_top_conveyor, step_top_conveyor_backward, step_top_conveyor_forward
-from vertical_conveyor_left_motor_code import move_left_conveyor, set_up_left_conveyor, clean_up_left_conveyor
-from vertical_conveyor_right_motor_code import move_right_conveyor, set_up_right_conveyor, clean_up_right_conveyor
 
 # running with flag --calibrate in command line will trigger calibration before movement
 parser = argparse.ArgumentParser(description="Run plant position updater with optional calibration.")
 parser.add_argument('--calibrate', action='store_true', help='Run motor calibration before starting.')
+parser.add_argument('--tune-colors', action='store_true', help='Fit the color thresholds to the first frame before starting.')
 args = parser.parse_args()
 
 DISTANCE_BELOW_TARGET_HOLDER_TO_SLIDE_ACROSS = 17 # pixels - max vertical distance between holders to be able to slide across
 
-# variables for PID control - used to move conveyor to align holders before sliding tray across
-previous_error = 0
-integral = 0
+# ends of the band the right holder's top edge is aligned into, in pixels above the left holder's bottom edge
+RIGHT_HOLDER_ALIGN_MIN = -22
+RIGHT_HOLDER_ALIGN_MAX = 0
 
-def pid_control(error, Kp=0.7, Ki=0.005, Kd=0.05): # error is the difference between the target value and the current value
-    global previous_error, integral # integral used to be 0.1
-
-    print("Error: ", error)
-
-    integral += error
-    derivative = error - previous_error
-    previous_error = error
-
-    print('Integral: ', integral)
-    print('Derivative: ', derivative)
-    print('K_p:', Kp)
-    print('K_i:', Ki)
-    print('K_d:', Kd)
-
-    # Calculate how much to move the conveyor
-    adjustment = Kp * error + Ki * integral + Kd * derivative
-    print("Adjustment: ", adjustment)
-    return adjustment
-
-def update_bottom_left_plant_position(image, conveyor_threshold):
+def update_bottom_left_plant_position(image, conveyor_threshold, holder_finder=find_holders, tracker=None, expected_shift=0.0):
     """
     Identifies the x-coordinate of the bottom edge of the bottom holder with a visible QR code 
     on the left-side conveyor.
@@ -55,18 +44,28 @@ def update_bottom_left_plant_position(image, conveyor_threshold):
     Args:
         image (np.ndarray): The input image from the conveyor camera.
         conveyor_threshold (int): Pixel value separating left and right conveyors.
+        holder_finder (function): find_holders, or a HolderCache's find_holders to reuse the last frame's holders.
+        tracker (ContourTracker or None): If given, the holder is tracked from the last detection while it can be,
+            and the tracker is seeded from each full detection.
+        expected_shift (float): Pixels along x the holder should have moved since the last frame, for the tracker.
 
     Returns:
         int: X-coordinate of the bottom edge of the topmost right conveyor holder with a barcode.
         id (str or None): The decoded string from the holder's QR code if present; otherwise None.
     """
-    holders = find_holders(image)
-    left_holders, _ = divide_holders_into_conveyors(conveyor_threshold, holders)
-    bottom_plant = bottom_holder_with_qrcode(left_holders)
-    bottom = get_bottom_edge_of_holder(bottom_plant['contour'])
-    return bottom[0][0], bottom_plant['id']
-
-def update_top_right_plant_position(image, conveyor_threshold):
+    if tracker is not None and tracker.track(image, expected_shift) is not None:
+        bottom = get_bottom_edge_of_holder(tracker.shifted(tracker.contour))
+        return bottom[0][0], tracker.label
+
+    bottom_plant = HolderIndex(holder_finder(image), conveyor_threshold).bottom(LEFT_CONVEYOR, with_qrcode=True)
+    if bottom_plant is None:
+        raise ValueError("No holder with a QR code found on the left conveyor.")
+    if tracker is not None:
+        tracker.seed(image, bottom_plant.contour, label=bottom_plant.id)
+    bottom = get_bottom_edge_of_holder(bottom_plant.contour)
+    return bottom[0][0], bottom_plant.id
+
+def update_top_right_plant_position(image, conveyor_threshold, holder_finder=find_holders):
     """
     Identifies the x-coordinate of the bottom edge of the topmost holder with a visible barcode 
     on the right-side conveyor.
@@ -74,20 +73,77 @@ def update_top_right_plant_position(image, conveyor_threshold):
     Args:
         image (np.ndarray): The input image from the conveyor camera.
         conveyor_threshold (int): Pixel value separating left and right conveyors.
+        holder_finder (function): find_holders, or a HolderCache's find_holders to reuse the last frame's holders.
 
     Returns:
         int: X-coordinate of the bottom edge of the topmost right conveyor holder with a barcode.
         id (str or None): The decoded string from the holder's QR code if present; otherwise None.
     """
-    holders = find_holders(image)
-    _, right_holders = divide_holders_into_conveyors(conveyor_threshold, holders)
-    top_plant = top_holder_with_qrcode(right_holders)
-    bottom = get_bottom_edge_of_holder(top_plant['contour'])
-    return bottom[0][0], top_plant['id']
+    top_plant = HolderIndex(holder_finder(image), conveyor_threshold).top(RIGHT_CONVEYOR, with_qrcode=True)
+    if top_plant is None:
+        raise ValueError("No holder with a QR code found on the right conveyor.")
+    bottom = get_bottom_edge_of_holder(top_plant.contour)
+    return bottom[0][0], top_plant.id
+
+def track_leg_contours(image, tracker, pick_leg, expected_shift=0.0):
+    """
+    Returns: the leg contours, with the leg picked by `pick_leg` tracked from the last detection while it can be
+    (expected to have moved `expected_shift` pixels along y). Otherwise the legs are detected again and the tracker
+    seeded from them.
+    """
+    if tracker is not None and tracker.track(image, expected_shift) is not None:
+        return tracker.tracked_contours()
+    leg_contours = find_leg_contours(image)
+    if tracker is not None:
+        tracker.seed(image, pick_leg(leg_contours), leg_contours)
+    return leg_contours
+
+def top_leg_contour(leg_contours):
+    return max(leg_contours, key=lambda c: cv2.boundingRect(c)[0]) # the leg find_leg_top_conveyor measures
+
+def bottom_leg_contour(leg_contours):
+    return min(leg_contours, key=lambda c: cv2.boundingRect(c)[0]) # the leg find_leg_bottom_conveyor measures
+
+def find_top_leg_position(image, tracker=None, expected_shift=0.0):
+    """
+    Returns: (leg contours, y-coordinate of the top left of the top conveyor leg).
+    """
+    leg_contours = track_leg_contours(image, tracker, top_leg_contour, expected_shift)
+    _, top_left_y = find_leg_top_conveyor(leg_contours)
+    return leg_contours, top_left_y
+
+def find_bottom_leg_position(image, tracker=None, expected_shift=0.0):
+    """
+    Returns: (leg contours, y-coordinate of the top right of the bottom conveyor leg).
+    """
+    leg_contours = track_leg_contours(image, tracker, bottom_leg_contour, expected_shift)
+    _, top_right_y = find_leg_bottom_conveyor(leg_contours)
+    return leg_contours, top_right_y
+
+def find_top_left_corner_bottom_right_holder(image, conveyor_threshold, holder_finder=find_holders, tracker=None, expected_shift=0.0):
+    """
+    Returns: (x, y) of the top left corner of the bottom holder on the right conveyor.
+    With a tracker, the holder is tracked from the last detection (its corner moved with it, expected by
+    `expected_shift` pixels along x) while it can be.
+    """
+    if tracker is not None and tracker.track(image, expected_shift) is not None:
+        return tracker.shifted(tracker.label)
+
+    bottom_holder_right = HolderIndex(holder_finder(image), conveyor_threshold).bottom(RIGHT_CONVEYOR)
+
+    print('finding corners for right contour')
+    corners_right = extract_holder_corners(image, bottom_holder_right.contour, 8, 0.02, 10)
+    top_left_corner = get_top_left_corner(corners_right)
+    if tracker is not None:
+        tracker.seed(image, bottom_holder_right.contour, label=tuple(top_left_corner))
+    return top_left_corner
+
+motion = MotionCoordinator() # sets up the pins of all four axes once, instead of each move setting up and cleaning up GPIO
 
 # ----------- TURN ON LIGHTS BY RUNNING SERVO MOTOR IN SEPARATE THREAD TO TRIGGER MOTION SENSOR --------
 try:
     GPIO.cleanup()  # Clean up GPIO settings
+    motion.set_up()
     gc.collect() # run garbage collector to free up memory
     # os.system("sudo pigpiod")
     # time.sleep(1)  # Give it a second to start
@@ -99,20 +155,42 @@ try:
 
     if args.calibrate:
         print("Running motor calibration...")
-        calibrate_vertical_conveyor_motors()
-        calibrate_top_conveyor_motor()
-        calibrate_bottom_conveyor_motor()
+        calibrate_axes_sweep(motion) # all four axes at once, measured from shared frames
+        # the single-axis calibrate_* routines in calibration.py set up and clean up GPIO themselves, which resets
+        # the coordinator's pins - set them up again so swapping one in can't leave the drivers disabled
+        motion.set_up()
         print("Calibration complete.")
     else:
         print("Skipping calibration.")
 
     # # ----------- TAKE INITIAL IMAGE AND LOAD CALIBRATION VARIABLES ------------------
+    load_color_thresholds() # fitted to the lighting on earlier runs, if they have been tuned
     image = capture_image()
+    if args.tune_colors:
+        tune_from_frame(image)
+    color_tuner = ColorTuner() # refits the thresholds from each set up frame's detections as the lighting drifts
+    frame = FrameAnalysis(image) # shares color conversions between the detectors run on the initial image
     calibration_variables = load_variables() 
 
+    # PID controllers used to move conveyors to align holders before sliding trays across - one per axis, fed forward
+    # by the axis's motion model (calibrated pixels per step, refined from logged moves), so the first move of each
+    # alignment is the whole predicted move and later ones only correct what the verification frame shows is left
+    motion_models = load_motion_models(calibration_variables)
+    top_conveyor_pid = PIDController("top conveyor", calibration_variables[TOP_CONVEYOR_SPEED_FORWARD], model=motion_models[TOP_AXIS])
+    left_conveyor_pid = PIDController("left conveyor", calibration_variables[LEFT_CONVEYOR_SPEED], model=motion_models[LEFT_AXIS])
+    right_conveyor_pid = PIDController("right conveyor", calibration_variables[RIGHT_CONVEYOR_SPEED], model=motion_models[RIGHT_AXIS],
+                                       deadband=(RIGHT_HOLDER_ALIGN_MAX - RIGHT_HOLDER_ALIGN_MIN) / 2) # aims for the middle of the band
+    bottom_conveyor_pid = PIDController("bottom conveyor", calibration_variables[BOTTOM_CONVEYOR_SPEED_FORWARD], model=motion_models[BOTTOM_AXIS])
+    # moving the legs out of the way only needs to get past a target, so they move by the model's prediction alone
+    top_leg_pid = PIDController("top conveyor leg", calibration_variables[TOP_CONVEYOR_SPEED_BACKWARD], Ki=0, Kd=0, model=motion_models[TOP_AXIS])
+    bottom_leg_pid = PIDController("bottom conveyor leg", calibration_variables[BOTTOM_CONVEYOR_SPEED_BACKWARD], Ki=0, Kd=0, model=motion_models[BOTTOM_AXIS])
+
     # # ---------- FIND OUTLINES OF CONVEYOR TO GET TARGET LOCATION FOR TOP RIGHT TRAY -----------
-    conveyor_threshold, conveyors_left, conveyors_right, top_conveyor, bottom_conveyor = get_conveyor_threshold(image) # find threshold between left and right conveyor
-    leg_contours = find_leg_contours(image)
+    conveyor_threshold, conveyors_left, conveyors_right, top_conveyor, bottom_conveyor = get_conveyor_geometry(image, frame) # saved borders, unless the camera has moved
+    clean_image = image.copy() # find_leg_contours draws on the image, the color tuner observes it undrawn
+    leg_contours = frame.find_leg_contours()
+    # tells when only the conveyor being moved has changed between frames, so its holders can be shifted instead of re-detected
+    change_detector = ConveyorChangeDetector({LEFT_AXIS: (conveyors_left, conveyor_threshold), RIGHT_AXIS: (conveyor_threshold, conveyors_right)})
     top_conveyor_leg_top_left_x, top_conveyor_leg_top_left_y  = find_leg_top_conveyor(leg_contours)
     # # draw a circle at top conveyor leg top left
     # # cv2.circle(image, (top_conveyor_leg_top_left_x, top_conveyor_leg_top_left_y), 10, (255, 0, 0), 5)  # Green circle
@@ -162,21 +240,20 @@ try:
 
     # # --------- FIND DESIRED POSITION FOR TOP LEFT HOLDER -----------
     # get corners of each holder
-    holders = find_holders(image)
-    holders_divided_into_conveyors = divide_holders_into_conveyors(conveyor_threshold, holders_from_find_holders=holders) # TODO - this is a bit sus, need to check if it work
-    top_holder_right = top_holder_right_conveyor(holders_divided_into_conveyors)
-    top_holder_left = top_holder_left_conveyor(holders_divided_into_conveyors)
+    holders = frame.find_holders()
+    observe_frame(color_tuner, frame, holders, leg_contours, conveyor_contours=[], image=clean_image)
+    color_tuner.retune()
+    holder_index = HolderIndex(holders, conveyor_threshold)
+    top_holder_right = holder_index.top(RIGHT_CONVEYOR)
+    top_holder_left = holder_index.top(LEFT_CONVEYOR)
+    top_right_plant_id = top_holder_right.id # checked against the left conveyor once the tray has been pushed across
     image_with_contours = image.copy()
 
     print('finding corners for right holder')
-    corners_right = extract_holder_corners(image, top_holder_right['contour'], 20, 0.04, 45)
-
-    gc.collect() # run garbage collector to free up memory
+    corners_right = extract_holder_corners(image, top_holder_right.contour, 20, 0.04, 45)
 
     print('finding corners for left contour')
-    corners_left = extract_holder_corners(image, top_holder_left['contour'], 8, 0.02, 20)
-
-    gc.collect() # run garbage collector to free up memory
+    corners_left = extract_holder_corners(image, top_holder_left.contour, 8, 0.02, 20)
 
     print('got corners - drawing')
 
@@ -190,7 +267,7 @@ try:
         cv2.circle(image_with_contours, (x, y), 10, (0, 0, 255), -1)  # Red circle for left corners
 
     # Save the image with detected corners
-    cv2.imwrite("image_with_corners.jpg", image_with_contours)
+    save_debug_image("image_with_corners.jpg", image_with_contours, copy=False)
     print("Image with corners saved as image_with_corners.jpg")
 
     del image_with_contours
@@ -259,7 +336,6 @@ try:
     # integral = 0
 
     # ------- ROTATE TOP CONVEYOR TO SLIDE TRAY ACROSS -----------
-    set_up_top_conveyor()
     additional_distance_to_push_tray_across = 125
     target = bottom_left_corner_left_holder[1] - additional_distance_to_push_tray_across
     distance_from_target = top_conveyor_leg_top_left_y - target
@@ -267,24 +343,24 @@ try:
     cv2.line(image, (0, conveyor_threshold), (image.shape[1], conveyor_threshold), (0, 255, 0), 2)  # Green line
     # draw a horizontal line at top_conveyor_leg_top_left_y
     cv2.line(image, (0, top_conveyor_leg_top_left_y), (image.shape[1], top_conveyor_leg_top_left_y), (0, 0, 255), 2)  # Red line
-    cv2.imwrite("before_move_top_conveyor.jpg", image)
-
-    while(distance_from_target > 0):
-        steps_to_take = int(pid_control(distance_from_target, Kp=(1/calibration_variables[TOP_CONVEYOR_SPEED_FORWARD])))
-        if(steps_to_take == 0):
-            print("No steps to take")
-            break
-        print("Steps to take: ", steps_to_take)
-        step_top_conveyor_forward(steps_to_take)
-
-        image = capture_image()
+    save_debug_image("before_move_top_conveyor.jpg", image)
 
-        # find new position of top conveyor leg
-        leg_contours = find_leg_contours(image)
-        top_conveyor_leg_top_left_x, top_conveyor_leg_top_left_y = find_leg_top_conveyor(leg_contours)
+    def top_conveyor_forward_steps(leg_position):
+        _, top_conveyor_leg_top_left_y = leg_position
         distance_from_target = top_conveyor_leg_top_left_y - target
-
         print("Distance from top conveyor target: ", distance_from_target)
+        if(distance_from_target <= 0):
+            return 0
+        return top_conveyor_pid.update(distance_from_target, motion.last_direction[TOP_AXIS]) # forward
+
+    # seeded by the first full detection, then shared by both top conveyor loops. Each PID's error falls as the leg's y does.
+    top_leg_tracker = ContourTracker("y", leg_plane)
+
+    top_conveyor_pid.reset()
+    top_conveyor_loop = ControlLoop(motion, TOP_AXIS, lambda image: find_top_leg_position(image, top_leg_tracker, -top_conveyor_pid.expected_correction()),
+                                    top_conveyor_forward_steps, name="top conveyor push")
+    leg_contours, top_conveyor_leg_top_left_y = top_conveyor_loop.run((leg_contours, top_conveyor_leg_top_left_y), image)
+    image = top_conveyor_loop.image
 
     print('finished moving top conveyor to target')
 
@@ -292,37 +368,29 @@ try:
     target_location = get_rightmost_corner(corners_right)[1] + 10
     print("Target location to move top leg out of way: ", target_location)
     del corners_right
-    gc.collect()
     # draw a horizontal line at target
     cv2.line(image, (0, target_location), (image.shape[1], target_location), (255, 0, 0), 2) 
     # draw a horizontal line at top_conveyor_left_top_left_y
     cv2.line(image, (0, top_conveyor_leg_top_left_y), (image.shape[1], top_conveyor_leg_top_left_y), (0, 0, 255), 2)  # Red line 
-    cv2.imwrite("before_move_top_conveyor_leg.jpg", image)
-    num_moves = 0
-    
-    while(top_conveyor_leg_top_left_y < target_location):
+    save_debug_image("before_move_top_conveyor_leg.jpg", image)
+
+    def top_leg_out_of_way_steps(leg_position):
+        _, top_conveyor_leg_top_left_y = leg_position
+        if(top_conveyor_leg_top_left_y >= target_location):
+            return 0
         print("Top conveyor leg y value: ", top_conveyor_leg_top_left_y)
         distance_to_target = (target_location - top_conveyor_leg_top_left_y)
         print("Distance to target location: ", distance_to_target)
-        steps_to_take = abs(int(distance_to_target // calibration_variables[TOP_CONVEYOR_SPEED_BACKWARD]))
-        if(steps_to_take == 0):
-            print("No steps to take")
-            break
-        print("Steps to take: ", steps_to_take)
-        step_top_conveyor_backward(steps_to_take)
-
-        image = capture_image()
-
-        # find new position of top conveyor leg
-        leg_contours = find_leg_contours(image)
-        top_conveyor_leg_top_left_x, top_conveyor_leg_top_left_y = find_leg_top_conveyor(leg_contours)
-        
-        if(num_moves > 5): # if get stuck in loop moving up, target is probably too high
-            print("STUCK IN LOOP - TARGET LIKELY WRONG")
-            break
-        num_moves += 1
-        
-    clean_up_top_conveyor()
+        return top_leg_pid.update(-distance_to_target, motion.last_direction[TOP_AXIS]) # backward
+
+    top_leg_pid.reset()
+    top_leg_loop = ControlLoop(motion, TOP_AXIS, lambda image: find_top_leg_position(image, top_leg_tracker, -top_leg_pid.expected_correction()),
+                               top_leg_out_of_way_steps, name="top conveyor leg")
+    leg_contours, top_conveyor_leg_top_left_y = top_leg_loop.run((leg_contours, top_conveyor_leg_top_left_y), image, max_iterations=7)
+    image = top_leg_loop.image
+    if(top_leg_loop.hit_iteration_limit): # if get stuck in loop moving up, target is probably too high
+        print("STUCK IN LOOP - TARGET LIKELY WRONG")
+
     print("Finished moving top conveyor leg out of the way")
 
     # check tray has moved to other conveyor
@@ -338,7 +406,9 @@ try:
     bottom_conveyor_leg_top_right_x, bottom_conveyor_leg_top_right_y  = find_leg_bottom_conveyor(leg_contours)
     target_location_for_bottom_tray = int(bottom_conveyor_leg_top_right_x - 350) 
     
-    bottom_of_bottom_holder_left_conveyor_x_coord, bottom_left_plant_id = update_bottom_left_plant_position(image, conveyor_threshold)
+    left_holder_cache = HolderCache(change_detector, LEFT_AXIS)
+    left_holder_tracker = ContourTracker("x", holder_plane)
+    bottom_of_bottom_holder_left_conveyor_x_coord, bottom_left_plant_id = update_bottom_left_plant_position(image, conveyor_threshold, left_holder_cache.find_holders, left_holder_tracker)
     distance_from_bottom_of_holder_to_target = target_location_for_bottom_tray - bottom_of_bottom_holder_left_conveyor_x_coord
 
     print("Moving left conveyor down close enough to slide tray across.")
@@ -347,29 +417,28 @@ try:
     print("Distance to target location to slide across: ", distance_from_bottom_of_holder_to_target)
 
     # ------ USE PID CONTROL TO MOVE BOTTOM HOLDER ON LEFT CONVEYOR DOWN CLOSE ENOUGH TO SLIDE TRAY ACROSS -----------
-    while(distance_from_bottom_of_holder_to_target < -50): # TODO: base target location on end of top conveyor leg for better relability
+    def left_conveyor_down_steps(plant_position):
+        bottom_of_bottom_holder_left_conveyor_x_coord, _ = plant_position
+        distance_from_bottom_of_holder_to_target = target_location_for_bottom_tray - bottom_of_bottom_holder_left_conveyor_x_coord
+        print("target location: ", target_location_for_bottom_tray)
+        print("bottom of bottom holder left conveyor: ",bottom_of_bottom_holder_left_conveyor_x_coord)
+        print("Distance to target location to slide across: ", distance_from_bottom_of_holder_to_target)
+        if(distance_from_bottom_of_holder_to_target >= -50): # TODO: base target location on end of top conveyor leg for better relability
+            return 0
+        return left_conveyor_pid.update(distance_from_bottom_of_holder_to_target, motion.last_direction[LEFT_AXIS])
+
+    def draw_left_conveyor_target(image, plant_position):
         # Visualise current (red) and target (green) location
+        bottom_of_bottom_holder_left_conveyor_x_coord, _ = plant_position
         cv2.line(image, (target_location_for_bottom_tray, 0), (target_location_for_bottom_tray, image.shape[0]), (0, 255, 0), 2)  
         cv2.line(image, (int(bottom_of_bottom_holder_left_conveyor_x_coord), 0), (int(bottom_of_bottom_holder_left_conveyor_x_coord), image.shape[0]), (0, 0, 255), 2) 
-        cv2.imwrite("before_move_left_holder_to_bottom.jpg", image)
-
-        # move conveyor
-        steps_to_take = int(pid_control(distance_from_bottom_of_holder_to_target, Kp=(1/calibration_variables[LEFT_CONVEYOR_SPEED])))
-        set_up_left_conveyor()
-        move_left_conveyor(steps_to_take)
-        clean_up_left_conveyor()
-
-        # capture new image
-        image = capture_image()
+        save_debug_image("before_move_left_holder_to_bottom.jpg", image)
 
-        # find new position of top holder
-        bottom_of_bottom_holder_left_conveyor_x_coord, bottom_left_plant_id = update_bottom_left_plant_position(image, conveyor_threshold)
-
-        # find new distance left to travel
-        print("target location: ", target_location_for_bottom_tray)
-        print("bottom of bottom holder left conveyor: ",bottom_of_bottom_holder_left_conveyor_x_coord)
-        distance_from_bottom_of_holder_to_target = target_location_for_bottom_tray - bottom_of_bottom_holder_left_conveyor_x_coord
-        print("Distance to target location to slide across: ", distance_from_bottom_of_holder_to_target)
+    left_conveyor_pid.reset()
+    left_conveyor_loop = ControlLoop(motion, LEFT_AXIS, lambda image: update_bottom_left_plant_position(image, conveyor_threshold, left_holder_cache.find_holders, left_holder_tracker, left_conveyor_pid.expected_correction()),
+                                     left_conveyor_down_steps, follow_up=draw_left_conveyor_target, name="left conveyor down")
+    bottom_of_bottom_holder_left_conveyor_x_coord, bottom_left_plant_id = left_conveyor_loop.run((bottom_of_bottom_holder_left_conveyor_x_coord, bottom_left_plant_id), image)
+    distance_from_bottom_of_holder_to_target = target_location_for_bottom_tray - bottom_of_bottom_holder_left_conveyor_x_coord
 
     print("Finished moving bottom holder on left conveyor close enough to slide tray across. Distance to target location now ", distance_from_bottom_of_holder_to_target)
     gc.collect() # run garbage collector to free up memory
@@ -378,21 +447,20 @@ try:
     image = capture_image()
 
     # get corners of each holder
-    holders = find_holders(image)
-    holders_divided_into_conveyors = divide_holders_into_conveyors(conveyor_threshold, holders_from_find_holders=holders) # TODO - this is a bit sus, need to check if it work
-    bottom_holder_right = bottom_holder_right_conveyor(holders_divided_into_conveyors)
-    bottom_holder_left = bottom_holder_left_conveyor(holders_divided_into_conveyors)
+    right_holder_cache = HolderCache(change_detector, RIGHT_AXIS)
+    holders = right_holder_cache.find_holders(image)
+    color_tuner.observe(image, holder_contours=[holder.contour for holder in holders])
+    color_tuner.retune()
+    holder_index = HolderIndex(holders, conveyor_threshold)
+    bottom_holder_right = holder_index.bottom(RIGHT_CONVEYOR)
+    bottom_holder_left = holder_index.bottom(LEFT_CONVEYOR)
     image_with_contours = image.copy()
 
     print('finding corners for right holder')
-    corners_right = extract_holder_corners(image, bottom_holder_right['contour'], 8, 0.02, 10)
-
-    gc.collect() # run garbage collector to free up memory
+    corners_right = extract_holder_corners(image, bottom_holder_right.contour, 8, 0.02, 10)
 
     print('finding corners for left contour')
-    corners_left = extract_holder_corners(image, bottom_holder_left['contour'], 20, 0.04, 45)
-
-    gc.collect() # run garbage collector to free up memory
+    corners_left = extract_holder_corners(image, bottom_holder_left.contour, 20, 0.04, 45)
 
     print('got corners - drawing')
 
@@ -406,7 +474,7 @@ try:
         cv2.circle(image_with_contours, (x, y), 10, (0, 0, 255), -1)  # Red circle for left corners
 
     # Save the image with detected corners
-    cv2.imwrite("image_with_corners.jpg", image_with_contours)
+    save_debug_image("image_with_corners.jpg", image_with_contours, copy=False)
     print("Image with corners saved as image_with_corners.jpg")
 
     del image_with_contours
@@ -415,6 +483,8 @@ try:
 
     top_left_corner_right_holder = get_top_left_corner(corners_right)
     del corners_right
+    right_holder_tracker = ContourTracker("x", holder_plane)
+    right_holder_tracker.seed(image, bottom_holder_right.contour, label=tuple(top_left_corner_right_holder))
 
     target_x_value = bottom_left_corner_left_holder[0]
     print("Target x value: ", target_x_value)
@@ -423,54 +493,34 @@ try:
     # visualize positions on image
     cv2.circle(image, (bottom_left_corner_left_holder[0], bottom_left_corner_left_holder[1]), 10, (0, 255, 255), -1)  # Yellow circle for left edge
     cv2.circle(image, (top_left_corner_right_holder[0], top_left_corner_right_holder[1]), 10, (0, 255, 255), -1)  # Yellow circle for right edge
-    cv2.imwrite("image_before_move_left_holder.jpg", image)
+    save_debug_image("image_before_move_left_holder.jpg", image)
 
     distance_below_target = target_x_value - top_left_corner_right_holder[0]
 
     print("Distance between holders: ", distance_below_target)
 
     # ------ USE PID CONTROL TO MOVE RIGHT HOLDER TO ALIGN WITH LEFT HOLDER -----------
-    while(distance_below_target < -22 or distance_below_target > 0):
-        steps_to_take = int(pid_control(distance_below_target, Kp=(1/calibration_variables[RIGHT_CONVEYOR_SPEED])))
-        if(steps_to_take == 0):
-            print("No steps to take")
-            break
-        print("Steps to take: ", steps_to_take)
-        
-        # move conveyor
-        set_up_right_conveyor()
-        move_right_conveyor(steps_to_take)
-        clean_up_right_conveyor()
-
-        #take new image
-        del image
-        gc.collect() # run garbage collector to free up memory
-        image = capture_image()
-
-        # find new left holder position
-        holders = find_holders(image)
-        holders_divided_into_conveyors = divide_holders_into_conveyors(conveyor_threshold, holders_from_find_holders=holders) # TODO - this is a bit sus, need to check if it work
-        bottom_holder_right = bottom_holder_right_conveyor(holders_divided_into_conveyors)
-
-        print('finding corners for right contour')
-        corners_right = extract_holder_corners(image, bottom_holder_right['contour'], 8, 0.02, 10)
-        top_left_corner_right_holder = get_top_left_corner(corners_right)
+    def right_conveyor_align_steps(top_left_corner_right_holder):
+        distance_below_target = target_x_value - top_left_corner_right_holder[0]
+        print("Distance between holders: ", distance_below_target)
+        band_middle = (RIGHT_HOLDER_ALIGN_MIN + RIGHT_HOLDER_ALIGN_MAX) / 2
+        return right_conveyor_pid.update(distance_below_target - band_middle, motion.last_direction[RIGHT_AXIS]) # 0 once inside the band
 
+    def draw_right_conveyor_target(image, top_left_corner_right_holder):
         # visualize on image
         cv2.circle(image, (bottom_left_corner_left_holder[0], bottom_left_corner_left_holder[1]), 10, (0, 255, 255), -1)  # Yellow circle for left edge
         cv2.circle(image, (top_left_corner_right_holder[0], top_left_corner_right_holder[1]), 10, (0, 255, 255), -1)  # Yellow circle for right edge
-        cv2.imwrite("image_before_move_right_holder.jpg", image)
+        save_debug_image("image_before_move_right_holder.jpg", image)
 
-        distance_below_target = target_x_value - top_left_corner_right_holder[0]
-        print("Distance between holders: ", distance_below_target)
+    right_conveyor_pid.reset()
+    right_conveyor_loop = ControlLoop(motion, RIGHT_AXIS, lambda image: find_top_left_corner_bottom_right_holder(image, conveyor_threshold, right_holder_cache.find_holders, right_holder_tracker, right_conveyor_pid.expected_correction()),
+                                      right_conveyor_align_steps, follow_up=draw_right_conveyor_target, name="right conveyor align")
+    top_left_corner_right_holder = right_conveyor_loop.run(top_left_corner_right_holder, image)
+    image = right_conveyor_loop.image
 
     print('finished moving holders together')
-    # reset PID control
-    previous_error = 0
-    integral = 0
 
     # ------- ROTATE BOTTOM CONVEYOR TO SLIDE TRAY ACROSS -----------
-    set_up_bottom_conveyor()
     additional_distance_to_push_tray_across = 120
     target = top_left_corner_right_holder[1] + additional_distance_to_push_tray_across
     distance_from_target = target - bottom_conveyor_leg_top_right_y
@@ -478,55 +528,44 @@ try:
     cv2.line(image, (0, target), (image.shape[1], target), (0, 255, 0), 2)  # Green line
     # draw a horizontal line at top_conveyor_leg_top_left_y
     cv2.line(image, (0, bottom_conveyor_leg_top_right_y), (image.shape[1], bottom_conveyor_leg_top_right_y), (0, 0, 255), 2)  # Red line
-    cv2.imwrite("before_move_bottom_conveyor.jpg", image)
-
-    while(distance_from_target > 0):
-        steps_to_take = int(pid_control(distance_from_target, Kp=(1/calibration_variables[BOTTOM_CONVEYOR_SPEED_FORWARD])))
-        if(steps_to_take == 0):
-            print("No steps to take")
-            break
-        print("Steps to take: ", steps_to_take)
-        step_bottom_conveyor_forward(steps_to_take)
+    save_debug_image("before_move_bottom_conveyor.jpg", image)
 
-        image = capture_image()
-
-        # find new position of top conveyor leg
-        leg_contours = find_leg_contours(image)
-        bottom_conveyor_leg_top_right_x, bottom_conveyor_leg_top_right_y  = find_leg_bottom_conveyor(leg_contours)
+    def bottom_conveyor_forward_steps(leg_position):
+        _, bottom_conveyor_leg_top_right_y = leg_position
         distance_from_target = target - bottom_conveyor_leg_top_right_y
-
         print("Distance from bottom conveyor target: ", distance_from_target)
+        if(distance_from_target <= 0):
+            return 0
+        return bottom_conveyor_pid.update(distance_from_target, motion.last_direction[BOTTOM_AXIS]) # forward
+
+    bottom_leg_tracker = ContourTracker("y", leg_plane) # the bottom PIDs' errors fall as the leg's y rises
+
+    bottom_conveyor_pid.reset()
+    bottom_conveyor_loop = ControlLoop(motion, BOTTOM_AXIS, lambda image: find_bottom_leg_position(image, bottom_leg_tracker, bottom_conveyor_pid.expected_correction()), bottom_conveyor_forward_steps, name="bottom conveyor push")
+    leg_contours, bottom_conveyor_leg_top_right_y = bottom_conveyor_loop.run((leg_contours, bottom_conveyor_leg_top_right_y), image)
+    image = bottom_conveyor_loop.image
 
     print('finished moving bottom conveyor to target')
-    # reset PID control
-    previous_error = 0
-    integral = 0
 
     # --------- MOVE BOTTOM CONVEYOR LEG OUT OF THE WAY OF CONVEYORS -----------
     bottom_conveyor_leg_top_right_x, bottom_conveyor_leg_top_right_y  = find_leg_bottom_conveyor(leg_contours)
     target_location = get_leftmost_corner(corners_left)[1] + 30
     del corners_left
-    gc.collect()
-    num_moves = 0
-    while(bottom_conveyor_leg_top_right_y > target_location):
-        steps_to_take = abs(int((target_location - bottom_conveyor_leg_top_right_y) // calibration_variables[BOTTOM_CONVEYOR_SPEED_BACKWARD]))
-        if(steps_to_take == 0):
-            print("No steps to take")
-            break
-        print("Steps to take: ", steps_to_take)
-        step_bottom_conveyor_backward(steps_to_take)
-
-        image = capture_image()
-
-        # find new position of top conveyor leg
-        leg_contours = find_leg_contours(image)
-        bottom_conveyor_leg_top_right_x, bottom_conveyor_leg_top_right_y  = find_leg_bottom_conveyor(leg_contours)
-        if(num_moves > 5): # if get stuck in loop moving up, target is probably too high
-            print("STUCK IN LOOP - TARGET LIKELY WRONG")
-            break
-        num_moves += 1
-        
-    clean_up_bottom_conveyor()
+
+    def bottom_leg_out_of_way_steps(leg_position):
+        _, bottom_conveyor_leg_top_right_y = leg_position
+        if(bottom_conveyor_leg_top_right_y <= target_location):
+            return 0
+        return bottom_leg_pid.update(target_location - bottom_conveyor_leg_top_right_y, motion.last_direction[BOTTOM_AXIS]) # backward
+
+    bottom_leg_pid.reset()
+    bottom_leg_loop = ControlLoop(motion, BOTTOM_AXIS, lambda image: find_bottom_leg_position(image, bottom_leg_tracker, bottom_leg_pid.expected_correction()),
+                                  bottom_leg_out_of_way_steps, name="bottom conveyor leg")
+    leg_contours, bottom_conveyor_leg_top_right_y = bottom_leg_loop.run((leg_contours, bottom_conveyor_leg_top_right_y), image, max_iterations=7)
+    image = bottom_leg_loop.image
+    if(bottom_leg_loop.hit_iteration_limit): # if get stuck in loop moving up, target is probably too high
+        print("STUCK IN LOOP - TARGET LIKELY WRONG")
+
     print("Finished moving bottom conveyor leg out of the way")
 
     # check tray has moved to other conveyor
@@ -544,13 +583,17 @@ try:
     # clean_up_servo(pi) # Clean up servo motor
 except KeyboardInterrupt:
         print("Caught Ctrl+C, exiting gracefully.")
-        GPIO.cleanup()  # Clean up GPIO settings
-        print("Cleaned up GPIO")
         gc.collect()  # Run garbage collector to free up memory
 finally:
     # Clean up GPIO settings
-    GPIO.cleanup()  # Clean up GPIO settings
+    motion.clean_up()  # waits for any move still running, disables the drivers and cleans up GPIO
     # os.system("sudo killall pigpiod")  # Stop pigpio daemon
+    close_camera()  # Stop the camera stream
+    flush_debug_images()  # write any debug images still queued
+    print(get_debug_sink())
+    if get_recorder() is not None:
+        get_recorder().flush()  # write the rest of the recording, if the run is being recorded
+        print(get_recorder())
     print("Cleaned up GPIO and stopped pigpio daemon")
     gc.collect()  # Run garbage collector to free up memory
 
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+from calibration import AXIS_SPEED_KEYS, load_variables
+from camera import Camera
+from image_analysis import FrameAnalysis, shift_along_x
+from motor_driver import BOTTOM_AXIS, LEFT_AXIS, RIGHT_AXIS, SIMULATED_AXES, TOP_AXIS
+
+# Closes the loop between the simulated motors (GROBOT_MOTORS=sim) and the camera, so a full rotation can run
+# on a normal Linux machine: frames are rendered from one recorded frame, moved by the steps each axis has taken.
+
+DEFAULT_PIXELS_PER_STEP = 1.0 # used for any axis missing from calibration_variables.json
+
+class SimulatedCamera(Camera):
+    """
+    Renders frames from a base frame according to the simulated axis positions.
+    - Vertical conveyors: the left (y < threshold) and right conveyor bands shift along x (up is +x).
+    - Top conveyor: its leg moves along y, forward towards smaller y.
+    - Bottom conveyor: its leg moves along y, forward towards larger y.
+    Pixels per step come from calibration_variables.json, per direction where calibration has both.
+    """
+
+    def __init__(self, base_image, calibration_variables=None):
+        if calibration_variables is None:
+            calibration_variables = load_variables()
+        self.base_image = base_image
+        self.pixels_per_step = {
+            axis: tuple(calibration_variables.get(key, DEFAULT_PIXELS_PER_STEP) for key in keys)
+            for axis, keys in AXIS_SPEED_KEYS.items()
+        }
+        self.frames_captured = 0
+
+        frame = FrameAnalysis(base_image.copy())
+        threshold, conveyors_left, conveyors_right, _, _ = frame.get_conveyor_threshold()
+        self.bands = {LEFT_AXIS: (conveyors_left, threshold), RIGHT_AXIS: (threshold, conveyors_right)}
+
+        leg_contours = frame.leg_contours()
+        self.legs = {
+            TOP_AXIS: cv2.boundingRect(max(leg_contours, key=lambda c: cv2.boundingRect(c)[0])),
+            BOTTOM_AXIS: cv2.boundingRect(min(leg_contours, key=lambda c: cv2.boundingRect(c)[0])),
+        }
+
+        # background without the legs, which are pasted back at their simulated positions
+        self.background = base_image.copy()
+        for x, y, w, h in self.legs.values():
+            ring = np.concatenate([base_image[max(y - 1, 0), x:x + w], base_image[min(y + h, base_image.shape[0] - 1), x:x + w]])
+            self.background[y:y + h, x:x + w] = ring.mean(axis=0)
+
+    def offset(self, axis):
+        """
+        Returns: pixels the axis has moved since the simulation started, positive in its positive direction.
+        """
+        simulated_axis = SIMULATED_AXES[axis]
+        positive_speed, negative_speed = self.pixels_per_step[axis]
+        return simulated_axis.steps_positive * positive_speed - simulated_axis.steps_negative * negative_speed
+
+    def render(self):
+        image = self.background.copy()
+
+        for axis, (y0, y1) in self.bands.items():
+            dx = round(self.offset(axis))
+            if dx:
+                image[y0:y1] = shift_along_x(self.background[y0:y1], dx)
+
+        for axis, direction in ((TOP_AXIS, -1), (BOTTOM_AXIS, 1)):
+            x, y, w, h = self.legs[axis]
+            new_y = int(np.clip(y + round(direction * self.offset(axis)), 0, image.shape[0] - h))
+            image[new_y:new_y + h, x:x + w] = self.base_image[y:y + h, x:x + w]
+
+        return image
+
+    def capture(self, path=None):
+        self.frames_captured += 1
+        return self.render()
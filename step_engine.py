@@ -0,0 +1,232 @@
+import os
+import time
+import numpy as np
+from motor_driver import GPIO, is_simulated
+
+# Generates stepper pulse trains. A whole move is precomputed as a waveform (pin levels plus the time to hold
+# each level), then emitted in bulk by a backend, chosen with the GROBOT_STEP_BACKEND environment variable:
+#   GROBOT_STEP_BACKEND=pigpio - DMA-timed waves through the pigpio daemon (hardware timing, no Python jitter)
+#   GROBOT_STEP_BACKEND=gpio   - RPi.GPIO against absolute deadlines, so jitter doesn't accumulate over a move
+#   unset                      - pigpio when its daemon is running, otherwise gpio
+# With GROBOT_MOTORS=sim the simulated backend is always used.
+STEP_BACKEND_ENV_VAR = "GROBOT_STEP_BACKEND"
+
+MAX_PULSES_PER_WAVE = 5000 # pigpio can only hold a limited number of pulses, so long moves are sent in chunks
+SPIN_THRESHOLD = 0.00015 # seconds - the GPIO backend sleeps until this close to a deadline, then busy-waits the rest
+DIR_SETTLE_SECONDS = 0.01 # DIR is held this long before the first STEP edge when a waveform sets the direction itself
+
+class Waveform:
+    """
+    A precomputed pulse train.
+    - pins: the GPIO pins driven by the waveform, in the order they are written.
+    - levels: (num_pulses, num_pins) array of the level each pin is set to at the start of each pulse.
+    - delays_us: (num_pulses,) array of how long each pulse is held, in microseconds.
+    """
+
+    def __init__(self, pins, levels, delays_us):
+        self.pins = tuple(pins)
+        self.levels = np.asarray(levels, dtype=np.uint8).reshape(-1, len(self.pins))
+        self.delays_us = np.asarray(delays_us, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.delays_us)
+
+    @property
+    def duration(self):
+        # seconds
+        return self.delays_us.sum() / 1e6
+
+def step_delays(steps, delay):
+    """
+    Returns: per-step delays (seconds) as an array, from a single delay or one delay per step.
+    Non-positive step counts give no steps, like range() in the old step loops.
+    """
+    steps = max(int(steps), 0)
+    delays = np.asarray(delay, dtype=float)
+    if delays.ndim == 0:
+        return np.full(steps, float(delays))
+    if len(delays) != steps:
+        raise ValueError(f"Expected {steps} step delays, got {len(delays)}")
+    return delays
+
+def step_dir_waveform(step_pin, steps, delay, dir_pin=None, dir_level=None):
+    """
+    Pulse train for a STEP/DIR driver: each step holds STEP high for `delay`, then low for `delay`.
+    - delay: seconds, or an array with one delay per step.
+    - dir_pin, dir_level: if given, DIR is driven by the waveform too - set to dir_level and held for
+      DIR_SETTLE_SECONDS before the first step - so the move doesn't depend on an earlier GPIO.output.
+    """
+    delays_us = np.rint(step_delays(steps, delay) * 1e6).astype(np.int64)
+    levels = np.tile([[1], [0]], (len(delays_us), 1))
+    delays_us = np.repeat(delays_us, 2)
+    if dir_pin is None or len(delays_us) == 0:
+        return Waveform((step_pin,), levels, delays_us)
+
+    levels = np.vstack(([[0]], levels)) # STEP low while DIR settles
+    delays_us = np.concatenate(([int(DIR_SETTLE_SECONDS * 1e6)], delays_us))
+    dir_levels = np.full((len(levels), 1), dir_level)
+    return Waveform((dir_pin, step_pin), np.hstack((dir_levels, levels)), delays_us) # DIR written before STEP
+
+def phase_waveform(pins, sequence, steps, delay, reverse=False):
+    """
+    Coil pattern train for a ULN2003 driver: each step walks the whole phase sequence, holding every phase for `delay`.
+    - delay: seconds, or an array with one delay per step.
+    - reverse: walk the sequence backwards.
+    """
+    phases = np.asarray(sequence[::-1] if reverse else sequence, dtype=np.uint8)
+    delays_us = np.rint(step_delays(steps, delay) * 1e6).astype(np.int64)
+    levels = np.tile(phases, (len(delays_us), 1))
+    return Waveform(pins, levels, np.repeat(delays_us, len(phases)))
+
+def merge_waveforms(waveforms):
+    """
+    Combines waveforms driving different pins into one that plays them all at the same time, all starting at once.
+    A pin keeps its last level after its own waveform has finished.
+    Returns: the merged Waveform - a new pulse starts whenever any of the waveforms changes pulse.
+    """
+    waveforms = [waveform for waveform in waveforms if len(waveform)]
+    if not waveforms:
+        raise ValueError("No pulses to merge")
+    pins = sum((waveform.pins for waveform in waveforms), ())
+    if len(set(pins)) != len(pins):
+        raise ValueError(f"Merged waveforms must drive different pins, got {pins}")
+
+    starts = [np.cumsum(waveform.delays_us) - waveform.delays_us for waveform in waveforms] # start time of each pulse
+    end = max(waveform.delays_us.sum() for waveform in waveforms)
+    times = np.unique(np.concatenate(starts))
+    levels = np.hstack([
+        waveform.levels[np.searchsorted(pulse_starts, times, side="right") - 1] # pulse playing at each merged time
+        for waveform, pulse_starts in zip(waveforms, starts)
+    ])
+    return Waveform(pins, levels, np.diff(np.append(times, end)))
+
+class GPIOStepBackend:
+    """
+    Emits waveforms with RPi.GPIO, waiting for absolute deadlines so per-pulse overhead doesn't add up over a move.
+    Several threads can emit at once, each on its own pins.
+    """
+
+    concurrent = True
+
+    def run(self, waveform):
+        pins = list(waveform.pins)
+        deadline = time.perf_counter()
+        for levels, delay_us in zip(waveform.levels.tolist(), waveform.delays_us.tolist()):
+            GPIO.output(pins, levels)
+            deadline += delay_us / 1e6
+            wait_until(deadline)
+
+def wait_until(deadline):
+    # sleeping releases the GIL for the other axes' threads and the vision code. Only the last SPIN_THRESHOLD is
+    # spun, as sleep can overshoot by about that much
+    remaining = deadline - time.perf_counter()
+    if remaining > SPIN_THRESHOLD:
+        time.sleep(remaining - SPIN_THRESHOLD)
+    while time.perf_counter() < deadline:
+        pass
+
+class PigpioWaveStepBackend:
+    """
+    Emits waveforms as pigpio waves, which the daemon plays out with DMA timing.
+    Long waveforms are split into chunks, each queued to start as soon as the previous one finishes.
+    The daemon plays one wave at a time, so moves on several axes have to be merged into one waveform first.
+    """
+
+    concurrent = False
+
+    def __init__(self, pi):
+        self.pi = pi
+
+    def _pulses(self, waveform, start, end):
+        import pigpio
+
+        pulses = []
+        for levels, delay_us in zip(waveform.levels[start:end].tolist(), waveform.delays_us[start:end].tolist()):
+            on_mask = off_mask = 0
+            for pin, level in zip(waveform.pins, levels):
+                if level:
+                    on_mask |= 1 << pin
+                else:
+                    off_mask |= 1 << pin
+            pulses.append(pigpio.pulse(on_mask, off_mask, delay_us))
+        return pulses
+
+    def run(self, waveform):
+        import pigpio
+
+        for pin in waveform.pins:
+            self.pi.set_mode(pin, pigpio.OUTPUT)
+
+        previous_wave = None
+        for start in range(0, len(waveform), MAX_PULSES_PER_WAVE):
+            self.pi.wave_add_generic(self._pulses(waveform, start, start + MAX_PULSES_PER_WAVE))
+            wave = self.pi.wave_create()
+            self.pi.wave_send_using_mode(wave, pigpio.WAVE_MODE_ONE_SHOT_SYNC) # starts when the previous chunk ends
+            if previous_wave is not None:
+                while self.pi.wave_tx_at() == previous_wave: # wait for the previous chunk to finish before freeing it
+                    time.sleep(0.001)
+                self.pi.wave_delete(previous_wave)
+            previous_wave = wave
+
+        while self.pi.wave_tx_busy():
+            time.sleep(0.001)
+        if previous_wave is not None:
+            self.pi.wave_delete(previous_wave)
+
+class SimulatedStepBackend:
+    """
+    Plays waveforms into the simulated GPIO pins without waiting, so the simulated axes count the steps instantly.
+    Keeps the time the moves would have taken in `simulated_seconds`.
+    """
+
+    concurrent = False # simulated time assumes moves are played one after another
+
+    def __init__(self):
+        self.simulated_seconds = 0.0
+
+    def run(self, waveform):
+        for levels in waveform.levels.tolist():
+            for pin, level in zip(waveform.pins, levels):
+                GPIO.output(pin, level)
+        self.simulated_seconds += waveform.duration
+
+def step_backend_from_env():
+    """
+    Builds the step backend from GROBOT_STEP_BACKEND (see top of file).
+    """
+    if is_simulated():
+        return SimulatedStepBackend()
+
+    backend = os.environ.get(STEP_BACKEND_ENV_VAR, "")
+    if backend in ("", "pigpio"):
+        try:
+            import pigpio
+            pi = pigpio.pi()
+            if pi.connected:
+                return PigpioWaveStepBackend(pi)
+        except ImportError:
+            pass
+        if backend == "pigpio":
+            raise RuntimeError("pigpio daemon is not running!")
+    if backend in ("", "gpio"):
+        return GPIOStepBackend()
+    raise ValueError(f"Unknown step backend: {backend}")
+
+_step_backend = None
+
+def get_step_backend():
+    global _step_backend
+    if _step_backend is None:
+        _step_backend = step_backend_from_env()
+    return _step_backend
+
+def set_step_backend(backend):
+    global _step_backend
+    _step_backend = backend
+
+def run_waveform(waveform):
+    """
+    Emits a waveform on the active step backend, returning once the last pulse has been held.
+    """
+    if len(waveform):
+        get_step_backend().run(waveform)
@@ -1,5 +1,6 @@
-import RPi.GPIO as GPIO
-import time
+from motor_driver import TOP_AXIS, GPIO, register_phase_axis
+from motion_planner import step_intervals
+from step_engine import phase_waveform, run_waveform
 
 # Define GPIO pins for ULN2003 driver
 IN1 = 26
@@ -23,6 +24,9 @@ seq = [
     [0, 0, 0, 1]
 ]
 
+# lets the simulated GPIO backend count steps on this axis - forward steps walk the sequence in order
+register_phase_axis(TOP_AXIS, (IN1, IN2, IN3, IN4), seq, positive_order=1)
+
 def set_up_top_conveyor():
     # Set GPIO mode and configure pins
     GPIO.setmode(GPIO.BCM)
@@ -31,28 +35,31 @@ def set_up_top_conveyor():
     GPIO.setup(IN3, GPIO.OUT)
     GPIO.setup(IN4, GPIO.OUT)
 
-# Function to move the stepper motor one step
-def step(delay, step_sequence):
-    """Activates motor coils for a single step."""
-    GPIO.output(IN1, step_sequence[0])
-    GPIO.output(IN2, step_sequence[1])
-    GPIO.output(IN3, step_sequence[2])
-    GPIO.output(IN4, step_sequence[3])
-    time.sleep(delay)
-
 # Function to move the stepper motor forward
-def step_top_conveyor_forward(steps, delay=0.001):
-    """Moves the motor forward by a given number of steps."""
-    for _ in range(steps):
-        for step_seq in seq:  # Iterate through the sequence
-            step(delay, step_seq)
+def step_top_conveyor_forward(steps, delay=0.001, profile=None):
+    """Moves the motor forward by a given number of steps, ramping the speed with `profile` (a MotionProfile) if given."""
+    if profile is not None:
+        delay = step_intervals(steps, profile) / len(seq) # each step walks the whole phase sequence
+    run_waveform(phase_waveform((IN1, IN2, IN3, IN4), seq, steps, delay, reverse=False)) # forward through the sequence, emitted in bulk
 
 # Function to move the stepper motor backward
-def step_top_conveyor_backward(steps, delay=0.001):
-    """Moves the motor backward by a given number of steps."""
-    for _ in range(steps):
-        for step_seq in reversed(seq):  # Iterate in reverse
-            step(delay, step_seq)
+def step_top_conveyor_backward(steps, delay=0.001, profile=None):
+    """Moves the motor backward by a given number of steps, ramping the speed with `profile` (a MotionProfile) if given."""
+    if profile is not None:
+        delay = step_intervals(steps, profile) / len(seq) # each step walks the whole phase sequence
+    run_waveform(phase_waveform((IN1, IN2, IN3, IN4), seq, steps, delay, reverse=True)) # reverse through the sequence, emitted in bulk
+
+def top_conveyor_waveform(steps, delay=0.001, profile=None):
+    """
+    Builds the coil pattern train for a move without emitting it, for moving together with other axes (see motion_coordinator.py).
+    Steps are positive for forward, negative for backward.
+    Returns: Waveform on IN1-IN4.
+    """
+    reverse = steps < 0 # forward walks the sequence in order
+    steps = abs(steps)
+    if profile is not None:
+        delay = step_intervals(steps, profile) / len(seq) # each step walks the whole phase sequence
+    return phase_waveform((IN1, IN2, IN3, IN4), seq, steps, delay, reverse=reverse)
 
 def clean_up_top_conveyor():
     GPIO.cleanup()  # Clean up GPIO settings
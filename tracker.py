@@ -0,0 +1,149 @@
+import cv2
+import numpy as np
+from image_analysis import FrameAnalysis, holder_mask, leg_mask
+
+# Follows a holder or leg between loop iterations by template matching, instead of re-running the full segmentation.
+# Each object only moves along one image axis - holders along x with their conveyor, legs along y - so the match
+# is searched for in a narrow window along that axis around where the object was last seen. Matching is done on the
+# object's color mask, so the background sliding past a moving leg doesn't spoil the match.
+
+TRACK_DOWNSCALE = 2 # full-resolution pixels per pixel matched
+TEMPLATE_PADDING = 16 # pixels of background kept around the object, so its edges are in the template
+SEARCH_MARGIN = 200 # pixels searched on each side along the axis of movement
+CROSS_MARGIN = 8 # pixels searched on each side across the axis of movement
+MIN_MATCH_SCORE = 0.8 # normalised correlation below which the object is treated as lost
+EQUALIZATION_DOWNSCALE = 8 # the frame is downscaled by this to build the V equalization holder planes are masked on
+
+AXES = ("x", "y")
+
+class ContourTracker:
+    """
+    Tracks one contour that moves along `axis` ("x" or "y").
+    - plane(crop, frame): turns a BGR crop of a frame (whose FrameAnalysis is `frame`) into the single channel image
+      matched, e.g. the object's color mask. Gray by default.
+    seed() with a full detection, then track() each new frame. When the match is lost, track() returns None and the
+    tracker has to be seeded again from a full detection. seed() refuses a template with nothing to match (e.g. a
+    mask with no foreground), leaving the tracker unseeded so the caller keeps using full detections.
+    """
+
+    def __init__(self, axis, plane=None, search_margin=SEARCH_MARGIN, scale=TRACK_DOWNSCALE):
+        if axis not in AXES:
+            raise ValueError(f"Unknown axis: {axis}")
+        self.axis = axis
+        self.plane = plane
+        self.search_margin = search_margin
+        self.scale = scale
+        self.contour = None
+        self.contours = None
+        self.label = None
+        self.template = None
+        self.displacement = 0.0
+
+    @property
+    def is_seeded(self):
+        return self.template is not None
+
+    def seed(self, image, contour, contours=None, label=None):
+        """
+        Starts tracking `contour` (found in `image`).
+        - contours: the list it was detected in, if the rest should be kept for tracked_contours().
+        - label: anything to keep with the object, e.g. a holder's QR id.
+        Returns: True if the tracker was seeded, False if the template had no variance to match on.
+        """
+        height, width = image.shape[:2]
+        x, y, w, h = cv2.boundingRect(contour)
+        x0, y0 = max(x - TEMPLATE_PADDING, 0), max(y - TEMPLATE_PADDING, 0)
+        x1, y1 = min(x + w + TEMPLATE_PADDING, width), min(y + h + TEMPLATE_PADDING, height)
+        self.rect = (x0, y0, x1, y1)
+        self.template = self._plane(image[y0:y1, x0:x1], FrameAnalysis(image, EQUALIZATION_DOWNSCALE))
+        self.contour = contour
+        self.contours = contours
+        self.label = label
+        self.displacement = 0.0
+        if is_flat(self.template): # every position would match it equally well
+            print("Tracker not seeded: the object's template is blank")
+            self.template = None
+            return False
+        return True
+
+    def _plane(self, crop, frame):
+        plane = self.plane(crop, frame) if self.plane is not None else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(plane, (max(plane.shape[1] // self.scale, 1), max(plane.shape[0] // self.scale, 1)), interpolation=cv2.INTER_AREA)
+
+    def track(self, image, expected=0.0):
+        """
+        Finds the object in a new frame, searching around its last position moved by `expected` pixels (e.g. the
+        move's predicted shift, so a long move doesn't take it out of the search window).
+        Returns: displacement along the axis since it was seeded (full-resolution pixels), or None if it was lost.
+        """
+        if not self.is_seeded:
+            return None
+        height, width = image.shape[:2]
+        x0, y0, x1, y1 = self.rect
+        shift = round(self.displacement + expected)
+        if self.axis == "x":
+            window = (x0 + shift - self.search_margin, y0 - CROSS_MARGIN, x1 + shift + self.search_margin, y1 + CROSS_MARGIN)
+        else:
+            window = (x0 - CROSS_MARGIN, y0 + shift - self.search_margin, x1 + CROSS_MARGIN, y1 + shift + self.search_margin)
+        wx0, wy0 = max(window[0], 0), max(window[1], 0)
+        wx1, wy1 = min(window[2], width), min(window[3], height)
+        if wx1 <= wx0 or wy1 <= wy0:
+            self.template = None # search window entirely out of frame
+            return None
+
+        search = self._plane(image[wy0:wy1, wx0:wx1], FrameAnalysis(image, EQUALIZATION_DOWNSCALE))
+        if search.shape[0] < self.template.shape[0] or search.shape[1] < self.template.shape[1]:
+            self.template = None # moved out of frame
+            return None
+        if is_flat(search): # nothing of the object's plane left in the window
+            print("Tracker lost object (blank search window)")
+            self.template = None
+            return None
+        scores = cv2.matchTemplate(search, self.template, cv2.TM_CCOEFF_NORMED)
+        _, best, _, (best_x, best_y) = cv2.minMaxLoc(scores)
+        if best < MIN_MATCH_SCORE:
+            print(f"Tracker lost object (match {best:.2f})")
+            self.template = None
+            return None
+
+        if self.axis == "x":
+            position = wx0 + (best_x + sub_pixel_peak(scores[best_y, :], best_x)) * self.scale
+            self.displacement = position - x0
+        else:
+            position = wy0 + (best_y + sub_pixel_peak(scores[:, best_x], best_y)) * self.scale
+            self.displacement = position - y0
+        return self.displacement
+
+    def shifted(self, points):
+        """
+        Returns: points (a contour or an (x, y) tuple) from the seed frame, moved by the tracked displacement.
+        """
+        offset = (round(self.displacement), 0) if self.axis == "x" else (0, round(self.displacement))
+        if isinstance(points, tuple):
+            return points[0] + offset[0], points[1] + offset[1]
+        return points + np.array(offset, dtype=points.dtype)
+
+    def tracked_contours(self):
+        """
+        Returns: the contours the tracked one was seeded with, with the tracked one moved to its tracked position.
+        """
+        return [self.shifted(contour) if contour is self.contour else contour for contour in self.contours]
+
+def holder_plane(crop, frame):
+    # masked on V equalized with the whole frame's histogram, as FrameAnalysis.holder_contours does
+    return holder_mask(frame.crop_hsv_equalized(crop))
+
+def leg_plane(crop, frame):
+    return leg_mask(cv2.cvtColor(crop, cv2.COLOR_BGR2HSV))
+
+def is_flat(plane):
+    # a single value throughout, e.g. a mask with no foreground
+    return plane.size == 0 or plane.min() == plane.max()
+
+def sub_pixel_peak(scores, peak):
+    # fits a parabola through the peak and its neighbours
+    if peak <= 0 or peak >= len(scores) - 1:
+        return 0.0
+    left, centre, right = scores[peak - 1], scores[peak], scores[peak + 1]
+    denominator = left - 2 * centre + right
+    return 0.0 if denominator == 0 else 0.5 * (left - right) / denominator
@@ -1,5 +1,7 @@
-import RPi.GPIO as GPIO
+from motor_driver import LEFT_AXIS, GPIO, register_step_dir_axis
 import time
+from motion_planner import step_intervals
+from step_engine import run_waveform, step_dir_waveform
 
 # Define GPIO pins
 DIR_PIN = 7     # Direction control
@@ -7,13 +9,28 @@ STEP_PIN = 8    # Step signal
 SLEEP_PIN = 24   # Sleep mode control
 RESET_PIN = 25   # Reset control
 
-def move_left_conveyor(steps): # steps positive for up, negative for down
+# lets the simulated GPIO backend count steps on this axis - up (positive steps) is CCW, DIR LOW
+register_step_dir_axis(LEFT_AXIS, STEP_PIN, DIR_PIN, positive_dir_level=GPIO.LOW)
+
+def move_left_conveyor(steps, profile=None): # steps positive for up, negative for down. profile: optional MotionProfile to ramp speed
     if(steps > 0):
-        move_stepper(steps, "CCW") # move up
+        move_stepper(steps, "CCW", profile=profile) # move up
     else:
         print("Moving down")
         steps = abs(steps)
-        move_stepper(steps, "CW") # move down
+        move_stepper(steps, "CW", profile=profile) # move down
+
+def left_conveyor_waveform(steps, delay=0.001, profile=None):
+    """
+    Builds the pulse train for a move without emitting it, for moving together with other axes (see motion_coordinator.py).
+    Steps are positive for up, negative for down; the waveform sets DIR itself.
+    Returns: Waveform on DIR_PIN and STEP_PIN.
+    """
+    direction = GPIO.LOW if steps > 0 else GPIO.HIGH
+    steps = abs(steps)
+    if profile is not None:
+        delay = step_intervals(steps, profile) / 2 # STEP is held high then low for half of each step's interval
+    return step_dir_waveform(STEP_PIN, steps, delay, dir_pin=DIR_PIN, dir_level=direction)
 
 def set_up_left_conveyor():
     # Setup GPIO
@@ -34,7 +51,7 @@ def clean_up_left_conveyor():
     GPIO.output(RESET_PIN, GPIO.LOW)
     GPIO.cleanup()
 
-def move_stepper(steps, direction="CW", delay=0.001):
+def move_stepper(steps, direction="CW", delay=0.001, profile=None):
     if direction == "CW":
         GPIO.output(DIR_PIN, GPIO.HIGH)
         print("Direction: CW (HIGH)")
@@ -43,11 +60,9 @@ def move_stepper(steps, direction="CW", delay=0.001):
         print("Direction: CCW (LOW)")
     time.sleep(0.01)  # Add small delay to allow direction change
 
-    for _ in range(steps):
-        GPIO.output(STEP_PIN, GPIO.HIGH)
-        time.sleep(delay)
-        GPIO.output(STEP_PIN, GPIO.LOW)
-        time.sleep(delay)
+    if profile is not None:
+        delay = step_intervals(steps, profile) / 2 # STEP is held high then low for half of each step's interval
+    run_waveform(step_dir_waveform(STEP_PIN, steps, delay)) # whole pulse train precomputed and emitted in bulk
 
 if __name__ == "__main__":
     set_up_left_conveyor()
@@ -1,5 +1,6 @@
-import RPi.GPIO as GPIO
-import time
+from motor_driver import RIGHT_AXIS, GPIO, register_step_dir_axis
+from motion_planner import step_intervals
+from step_engine import run_waveform, step_dir_waveform
 
 # Define GPIO pins
 DIR_PIN = 21     # Direction control
@@ -7,13 +8,28 @@ STEP_PIN = 20   # Step signal
 SLEEP_PIN = 16   # Sleep mode control
 RESET_PIN = 12   # Reset control
 
-def move_right_conveyor(steps): # steps positive for up, negative for down
+# lets the simulated GPIO backend count steps on this axis - up (positive steps) is CW, DIR HIGH
+register_step_dir_axis(RIGHT_AXIS, STEP_PIN, DIR_PIN, positive_dir_level=GPIO.HIGH)
+
+def move_right_conveyor(steps, profile=None): # steps positive for up, negative for down. profile: optional MotionProfile to ramp speed
     if(steps > 0):
-        move_stepper(steps, "CW") # move up
+        move_stepper(steps, "CW", profile=profile) # move up
     else:
         print("Moving down")
         steps = abs(steps)
-        move_stepper(steps, "CCW") # move down
+        move_stepper(steps, "CCW", profile=profile) # move down
+
+def right_conveyor_waveform(steps, delay=0.001, profile=None):
+    """
+    Builds the pulse train for a move without emitting it, for moving together with other axes (see motion_coordinator.py).
+    Steps are positive for up, negative for down; the waveform sets DIR itself.
+    Returns: Waveform on DIR_PIN and STEP_PIN.
+    """
+    direction = GPIO.HIGH if steps > 0 else GPIO.LOW
+    steps = abs(steps)
+    if profile is not None:
+        delay = step_intervals(steps, profile) / 2 # STEP is held high then low for half of each step's interval
+    return step_dir_waveform(STEP_PIN, steps, delay, dir_pin=DIR_PIN, dir_level=direction)
 
 def set_up_right_conveyor():
     # Setup GPIO
@@ -35,16 +51,14 @@ def clean_up_right_conveyor():
     GPIO.cleanup()
 
 # Function to move the stepper motor
-def move_stepper(steps, direction="CW", delay=0.001):
+def move_stepper(steps, direction="CW", delay=0.001, profile=None):
     # Set direction
     GPIO.output(DIR_PIN, GPIO.HIGH if direction == "CW" else GPIO.LOW)
 
     # Pulse the STEP pin
-    for _ in range(steps):
-        GPIO.output(STEP_PIN, GPIO.HIGH)
-        time.sleep(delay)
-        GPIO.output(STEP_PIN, GPIO.LOW)
-        time.sleep(delay)
+    if profile is not None:
+        delay = step_intervals(steps, profile) / 2 # STEP is held high then low for half of each step's interval
+    run_waveform(step_dir_waveform(STEP_PIN, steps, delay)) # whole pulse train precomputed and emitted in bulk
 
 if __name__ == "__main__":
     set_up_right_conveyor()